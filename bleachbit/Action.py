@@ -25,10 +25,9 @@ Actions that perform cleaning
 
 from __future__ import absolute_import, print_function
 
-from bleachbit import Command, FileUtilities, General, Special
+from bleachbit import Command, DeepScan, FileUtilities, General, Special
 from bleachbit import _, expanduser, expandvars
 
-import glob
 import logging
 import os
 import re
@@ -44,6 +43,48 @@ else:
 logger = logging.getLogger(__name__)
 
 
+class RegexRegistry:
+
+    """Compiled regular expressions shared by all actions
+
+    Many actions use the same patterns, so each distinct pattern is
+    compiled once, when the cleaners are loaded."""
+
+    def __init__(self):
+        self.compiled = {}
+        # how many filters use each pattern
+        self.uses = {}
+
+    def __len__(self):
+        return len(self.compiled)
+
+    def compile(self, pattern, flags=0):
+        """Return the compiled pattern"""
+        key = (pattern, flags)
+        ret = self.compiled.get(key)
+        if ret is None:
+            ret = self.compiled[key] = re.compile(pattern, flags)
+        self.uses[key] = self.uses.get(key, 0) + 1
+        return ret
+
+    def dump(self):
+        """Return a list of (pattern, flags, uses) for debugging"""
+        return sorted([(pattern, flags, self.uses[(pattern, flags)])
+                       for (pattern, flags) in self.compiled])
+
+
+regex_registry = RegexRegistry()
+
+
+def _prefiltered(prefilter, search):
+    """Return search() that skips the regex when prefilter rejects"""
+    def prefiltered_search(s):
+        if not prefilter(s):
+            return None
+        return search(s)
+    return prefiltered_search
+
+
 def expand_multi_var(s, variables):
     """Expand string s with potentially-multiple values.
 
@@ -133,14 +174,59 @@ class FileActionProvider(ActionProvider):
             self.ds['cache'] = General.boolstr_to_bool(
                 action_element.getAttribute('cache'))
             self.ds['command'] = action_element.getAttribute('command')
+            self.ds['onefilesystem'] = action_element.hasAttribute('onefilesystem') and \
+                General.boolstr_to_bool(action_element.getAttribute('onefilesystem'))
+            if action_element.hasAttribute('skipfstypes'):
+                self.ds['skipfstypes'] = action_element.getAttribute('skipfstypes').split()
+            else:
+                self.ds['skipfstypes'] = DeepScan.PSEUDO_FSTYPES
+            self.ds['skipdirs'] = action_element.getAttribute('skipdirs') or None
             self.ds['path'] = self.paths[0]
             if not len(self.paths) == 1:
                 logger.warning(
                     'deep scan does not support multi-value variables')
-        if not any([self.object_type, self.regex, self.nregex,
-                    self.wholeregex, self.nwholeregex]):
+        self.filtered = any([self.object_type, self.regex, self.nregex,
+                             self.wholeregex, self.nwholeregex])
+        if not self.filtered:
             # If the filter is not needed, bypass it for speed.
-            self.get_paths = self._get_paths
+            self.get_entries = self._get_entries
+        else:
+            self.entry_filter = self._compose_filter()
+
+    def _compose_filter(self):
+        """Return the filters combined into one function of a PathEntry"""
+        # (search function, whether it must match)
+        basename_tests = []
+        path_tests = []
+        for (pattern, tests, positive) in ((self.regex, basename_tests, True),
+                                           (self.nregex, basename_tests, False),
+                                           (self.wholeregex, path_tests, True),
+                                           (self.nwholeregex, path_tests, False)):
+            if pattern:
+                search = regex_registry.compile(pattern, re_flags).search
+                prefilter = DeepScan.compile_prefilter([pattern], re_flags)
+                if prefilter is not None:
+                    search = _prefiltered(prefilter, search)
+                tests.append((search, positive))
+        object_type = self.object_type
+        basename = os.path.basename
+
+        def entry_filter(entry):
+            path = entry.path
+            if basename_tests:
+                name = basename(path)
+                for (search, positive) in basename_tests:
+                    if (search(name) is None) == positive:
+                        return False
+            for (search, positive) in path_tests:
+                if (search(path) is None) == positive:
+                    return False
+            if 'f' == object_type:
+                return entry.is_file()
+            if 'd' == object_type:
+                return entry.is_dir()
+            return True
+        return entry_filter
 
     def _set_paths(self, raw_path, path_vars):
         """Set the list of paths to work on"""
@@ -165,60 +251,66 @@ class FileActionProvider(ActionProvider):
 
         If a filter is defined and it fails to match, this function
         returns False. Otherwise, this function returns True."""
+        return self.entry_filter(FileUtilities.PathEntry(path))
 
-        if self.regex:
-            if not self.regex_c.search(os.path.basename(path)):
-                return False
-
-        if self.nregex:
-            if self.nregex_c.search(os.path.basename(path)):
-                return False
-
-        if self.wholeregex:
-            if not self.wholeregex_c.search(path):
-                return False
-
-        if self.nwholeregex:
-            if self.nwholeregex_c.search(path):
-                return False
-
-        if self.object_type:
-            if 'f' == self.object_type and not os.path.isfile(path):
-                return False
-            elif 'd' == self.object_type and not os.path.isdir(path):
-                return False
+    def entry_filter(self, entry):
+        """Like path_filter() but take a PathEntry, whose cached file
+        type is used for the type filter
 
+        The constructor replaces this with _compose_filter() when
+        there are filters."""
         return True
 
     def get_paths(self):
-        import itertools
-        for f in itertools.ifilter(self.path_filter, self._get_paths()):
-            yield f
+        for entry in self.get_entries():
+            yield entry.path
 
     def _get_paths(self):
-        """Return a filtered list of files"""
+        """Return an unfiltered list of files"""
+        for entry in self._get_entries():
+            yield entry.path
+
+    def get_entries(self):
+        """Yield a filtered list of PathEntry"""
+        import itertools
+        for entry in itertools.ifilter(self.entry_filter, self._get_entries()):
+            yield entry
+
+    def _get_entries(self):
+        """Yield an unfiltered list of PathEntry"""
 
         def get_file(path):
-            if os.path.lexists(path):
-                yield path
+            # One lstat() tells whether it exists, and it is kept for
+            # getsize() and delete().
+            entry = FileUtilities.PathEntry(path)
+            try:
+                entry.lstat()
+            except OSError:
+                return
+            yield entry
+
+        def get_glob(pathname):
+            for path in FileUtilities.iglob(pathname):
+                yield FileUtilities.PathEntry(path)
 
         def get_walk_all(top):
-            for expanded in glob.iglob(top):
-                for path in FileUtilities.children_in_directory(
-                        expanded, True):
-                    yield path
+            for expanded in FileUtilities.iglob(top):
+                for entry in FileUtilities.children_entries(
+                        expanded, True, FileUtilities.whitelisted):
+                    yield entry
 
         def get_walk_files(top):
-            for expanded in glob.iglob(top):
-                for path in FileUtilities.children_in_directory(expanded, False):
-                    yield path
+            for expanded in FileUtilities.iglob(top):
+                for entry in FileUtilities.children_entries(
+                        expanded, False, FileUtilities.whitelisted):
+                    yield entry
 
         if 'deep' == self.search:
             raise StopIteration
         elif 'file' == self.search:
             func = get_file
         elif 'glob' == self.search:
-            func = glob.iglob
+            func = get_glob
         elif 'walk.all' == self.search:
             func = get_walk_all
         elif 'walk.files' == self.search:
@@ -226,21 +318,9 @@ class FileActionProvider(ActionProvider):
         else:
             raise RuntimeError("invalid search='%s'" % self.search)
 
-        if self.regex:
-            self.regex_c = re.compile(self.regex, re_flags)
-
-        if self.nregex:
-            self.nregex_c = re.compile(self.nregex, re_flags)
-
-        if self.wholeregex:
-            self.wholeregex_c = re.compile(self.wholeregex, re_flags)
-
-        if self.nwholeregex:
-            self.nwholeregex_c = re.compile(self.nwholeregex, re_flags)
-
         for input_path in self.paths:
-            for path in func(input_path):
-                yield path
+            for entry in func(input_path):
+                yield entry
 
     def get_commands(self):
         raise NotImplementedError('not implemented')
@@ -370,8 +450,8 @@ class Delete(FileActionProvider):
     action_key = 'delete'
 
     def get_commands(self):
-        for path in self.get_paths():
-            yield Command.Delete(path)
+        for entry in self.get_entries():
+            yield Command.Delete(entry.path, entry)
 
 
 class Ini(FileActionProvider):
@@ -484,8 +564,8 @@ class Shred(FileActionProvider):
     action_key = 'shred'
 
     def get_commands(self):
-        for path in self.get_paths():
-            yield Command.Shred(path)
+        for entry in self.get_entries():
+            yield Command.Shred(entry.path, entry)
 
 
 class SqliteVacuum(FileActionProvider):
@@ -511,8 +591,8 @@ class Truncate(FileActionProvider):
     action_key = 'truncate'
 
     def get_commands(self):
-        for path in self.get_paths():
-            yield Command.Truncate(path)
+        for entry in self.get_entries():
+            yield Command.Truncate(entry.path, entry)
 
 
 class WinShellChangeNotify(ActionProvider):
@@ -558,3 +638,196 @@ class YumCleanAll(ActionProvider):
             None,
             Unix.yum_clean,
             'yum clean all')
+
+
+#
+# Planning
+#
+
+
+class TraversalPlan:
+
+    """Commands for a list of actions, with overlapping walks merged
+
+    Consecutive delete actions with walk.all or walk.files searches
+    are grouped by root.  A root inside another root is walked as part
+    of the outer root, so each directory is listed once, and each entry
+    goes to the first of the actions that accepts it.  Once that action
+    deletes the entry, the later actions would not have found it
+    anyway.  Other actions run unchanged and keep their place.
+
+    When an unfiltered walk.all action covers the whole walk, and
+    nothing in it is whitelisted, everything under the top is deleted
+    whichever action takes it, so the walk becomes a tree step: one
+    Command.DeleteTree."""
+
+    def __init__(self, providers):
+        # ('action', provider) or ('walk' or 'tree', top, [(root, provider), ...])
+        self.steps = []
+        run = []
+        for provider in providers:
+            if type(provider) is Delete and \
+                    provider.search in ('walk.all', 'walk.files'):
+                run.append(provider)
+                continue
+            self._add_walks(run)
+            run = []
+            self.steps.append(('action', provider))
+        self._add_walks(run)
+
+    @staticmethod
+    def _contains(top, root):
+        """Return whether walking top reaches root"""
+        if root == top:
+            return True
+        if not root.startswith(os.path.join(top, '')):
+            return False
+        # The walk does not follow links or enter whitelisted trees.
+        if os.path.realpath(root) != os.path.join(os.path.realpath(top),
+                                                  os.path.relpath(root, top)):
+            return False
+        parent = root
+        while parent != top:
+            if FileUtilities.whitelisted(parent):
+                return False
+            parent = os.path.dirname(parent)
+        return True
+
+    def _add_walks(self, run):
+        """Plan the walks for consecutive mergeable actions"""
+        roots = []
+        for provider in run:
+            for path in provider.paths:
+                for root in FileUtilities.iglob(path):
+                    roots.append((os.path.normpath(root), provider))
+        walks = []
+        for (root, provider) in roots:
+            outer = [other for (other, _provider) in roots
+                     if other != root and self._contains(other, root)]
+            if outer:
+                top = min(outer, key=len)
+            else:
+                top = root
+            for walk in walks:
+                if walk[1] == top:
+                    walk[2].append((root, provider))
+                    break
+            else:
+                walks.append(('walk', top, [(root, provider)]))
+        for (i, walk) in enumerate(walks):
+            if self._is_tree(walk[1], walk[2]):
+                walks[i] = ('tree',) + walk[1:]
+        self.steps += walks
+
+    @staticmethod
+    def _is_tree(top, members):
+        """Return whether the walk of top deletes everything under it"""
+        for (root, provider) in members:
+            if root == top and 'walk.all' == provider.search and \
+                    not provider.filtered:
+                break
+        else:
+            return False
+        index = FileUtilities.get_whitelist_index()
+        return not (index and index.overlaps(top))
+
+    def dump(self):
+        """Return the plan as text for debugging"""
+        lines = []
+        for step in self.steps:
+            if 'action' == step[0]:
+                provider = step[1]
+                lines.append('action %s search=%s paths=%s' %
+                             (provider.action_key, getattr(provider, 'search', None),
+                              getattr(provider, 'paths', None)))
+                continue
+            lines.append('%s %s' % step[0:2])
+            for (root, provider) in step[2]:
+                lines.append('  %s %s regex=%s nregex=%s' %
+                             (provider.search, root, provider.regex, provider.nregex))
+        return '\n'.join(lines)
+
+    def get_commands(self, batch_size=None):
+        """Yield each command
+
+        With batch_size, the files each delete action or walk finds
+        are yielded as Command.DeleteBatch of up to batch_size files.
+        A batch does not span steps, so a step still sees the changes
+        of the steps before it.  The files come in the order of
+        FileUtilities.inode_order()."""
+        for step in self.steps:
+            if 'action' == step[0]:
+                if batch_size and type(step[1]) is Delete:
+                    entries = FileUtilities.inode_order(step[1].get_entries())
+                    for batch in self._batches(entries, batch_size):
+                        yield batch
+                    continue
+                for cmd in step[1].get_commands():
+                    yield cmd
+            elif 'tree' == step[0]:
+                yield Command.DeleteTree(step[1])
+            else:
+                entries = FileUtilities.inode_order(
+                    self._walk_entries(step[1], step[2]))
+                if batch_size:
+                    for batch in self._batches(entries, batch_size):
+                        yield batch
+                    continue
+                for entry in entries:
+                    yield Command.Delete(entry.path, entry)
+
+    @staticmethod
+    def _batches(entries, batch_size):
+        """Group entries into Command.DeleteBatch"""
+        batch = Command.DeleteBatch()
+        for entry in entries:
+            batch.append(entry.path, entry)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = Command.DeleteBatch()
+        if len(batch):
+            yield batch
+
+    @staticmethod
+    def _walk_entries(top, members):
+        """Walk top once for several actions, and yield the entries
+        to delete"""
+        # (prefix, provider, whether it takes directories)
+        takers = [(os.path.join(root, ''), provider, 'walk.all' == provider.search)
+                  for (root, provider) in members]
+        list_directories = any([taker[2] for taker in takers])
+        for (_dirpath, dirs, files) in FileUtilities.walk_entries(
+                top, FileUtilities.whitelisted):
+            # the same order as children_entries()
+            for (entries, is_dir) in ((dirs, True), (files, False)):
+                if is_dir and not list_directories:
+                    continue
+                for entry in entries:
+                    for (prefix, provider, takes_directories) in takers:
+                        if is_dir and not takes_directories:
+                            continue
+                        if not entry.path.startswith(prefix):
+                            continue
+                        if provider.entry_filter(entry):
+                            yield entry
+                            break
+
+
+# During a Worker run, deletes are grouped into batches of this size.
+batch_size = None
+
+
+def set_batch_size(size):
+    """Group the deletes from plan_commands() into batches of size
+    files, or stop grouping them if size is None"""
+    global batch_size
+    batch_size = size
+
+
+def plan_commands(providers):
+    """Yield the commands of providers using a TraversalPlan"""
+    plan = TraversalPlan(providers)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('action plan:\n%s', plan.dump())
+    for cmd in plan.get_commands(batch_size):
+        yield cmd
@@ -39,9 +39,12 @@ logger = logging.getLogger(__name__)
 class CliCallback:
     """Command line's callback passed to Worker"""
 
-    def __init__(self):
-        """Initialize CliCallback"""
+    def __init__(self, quiet=False):
+        """Initialize CliCallback
+
+        If quiet, the Worker shows only the totals."""
         self.encoding = encoding if encoding else 'UTF8'
+        self.quiet = quiet
 
     def append_text(self, msg, tag=None):
         """Write text to the terminal"""
@@ -82,12 +85,30 @@ def list_cleaners():
         print (cleaner)
 
 
-def preview_or_clean(operations, really_clean):
-    """Preview deletes and other changes"""
-    cb = CliCallback()
-    worker = Worker.Worker(cb, really_clean, operations).run()
-    while worker.next():
-        pass
+def preview_or_clean(operations, really_clean, plan_out=None, plan_in=None,
+                     quiet=False):
+    """Preview deletes and other changes
+
+    plan_out: a preview writes what it finds to this file
+    plan_in: a clean deletes what the preview in this file found,
+        and the operations come from the file
+    quiet: show only the totals, not each file"""
+    cb = CliCallback(quiet)
+    plan = preview_plan = None
+    if plan_in:
+        plan = Worker.PlanReader(plan_in)
+        operations = plan.operations
+    elif plan_out and not really_clean:
+        preview_plan = Worker.PlanWriter(plan_out, operations)
+    try:
+        worker = Worker.Worker(cb, really_clean, operations, plan,
+                               preview_plan).run()
+        while worker.next():
+            pass
+    finally:
+        for f in (plan, preview_plan):
+            if f is not None:
+                f.close()
 
 
 def args_to_operations(args, preset):
@@ -155,8 +176,22 @@ def process_cmd_line():
     parser.add_option("--no-uac", action="store_true", help=uac_help)
     parser.add_option("-p", "--preview", action="store_true",
                       help=_("preview files to be deleted and other changes"))
+    parser.add_option('--preview-jobs', type='int', metavar='N',
+                      help=_('look up N files at once while previewing'))
+    parser.add_option('--delete-order', type='choice', choices=('name', 'inode'),
+                      help=_('delete the files of a directory in the order of their names or of their inodes'))
+    parser.add_option('--change-journal', action='store_true',
+                      help=_('remember directory listings between runs until the directories change'))
+    parser.add_option('-j', '--jobs', type='int', metavar='N',
+                      help=_('delete up to N files at once, depending on the devices'))
+    parser.add_option('--plan-out', metavar='FILE',
+                      help=_('with --preview, write what would be deleted to FILE'))
+    parser.add_option('--plan-in', metavar='FILE',
+                      help=_('with --clean, delete what the preview in FILE found'))
     parser.add_option('--pot', action='store_true',
                       help=optparse.SUPPRESS_HELP)
+    parser.add_option('-q', '--quiet', action='store_true',
+                      help=_('show only the totals, not each file'))
     parser.add_option("--preset", action="store_true",
                       help=_("use options set in the graphical interface"))
     if 'nt' == os.name:
@@ -195,20 +230,46 @@ There is NO WARRANTY, to the extent permitted by law.""" % APP_VERSION)
         from bleachbit.CleanerML import create_pot
         create_pot()
         sys.exit(0)
-    if options.preview or options.clean:
+    if options.plan_out and not options.preview:
+        logger.error('--plan-out requires --preview')
+        sys.exit(1)
+    if options.plan_in and (options.preview or not options.clean):
+        logger.error('--plan-in requires --clean without --preview')
+        sys.exit(1)
+    if options.plan_in:
+        # the operations are in the plan
+        register_cleaners()
+        operations = None
+    elif options.preview or options.clean:
         operations = args_to_operations(args, options.preset)
         if not operations:
             logger.error('No work to do. Specify options.')
             sys.exit(1)
+    if options.preview_jobs:
+        if options.preview_jobs < 1:
+            logger.error('--preview-jobs must be at least 1')
+            sys.exit(1)
+        Options.options.set('preview_workers', options.preview_jobs, commit=False)
+    if options.jobs:
+        if options.jobs < 1:
+            logger.error('--jobs must be at least 1')
+            sys.exit(1)
+        Options.options.set('jobs', options.jobs, commit=False)
+    if options.delete_order:
+        Options.options.set('delete_order', options.delete_order, commit=False)
+    if options.change_journal:
+        Options.options.set('change_journal', True, commit=False)
     if options.preview:
-        preview_or_clean(operations, False)
+        preview_or_clean(operations, False, plan_out=options.plan_out,
+                         quiet=options.quiet)
         sys.exit(0)
     if options.overwrite:
         if not options.clean or options.shred:
             logger.warning('--overwrite is intended only for use with --clean')
         Options.options.set('shred', True, commit=False)
     if options.clean:
-        preview_or_clean(operations, True)
+        preview_or_clean(operations, True, plan_in=options.plan_in,
+                         quiet=options.quiet)
         sys.exit(0)
     if options.gui:
         import gtk
@@ -0,0 +1,346 @@
+# vim: ts=4:sw=4:expandtab
+# -*- coding: UTF-8 -*-
+
+# BleachBit
+# Copyright (C) 2008-2018 Andrew Ziem
+# https://www.bleachbit.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Remember directory listings until Linux inotify reports a change
+"""
+
+from __future__ import absolute_import, print_function
+
+import bleachbit
+
+import errno
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# changes to the names in a directory
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event without the name
+EVENT_HEADER = struct.Struct('iIII')
+
+# A listing is saved for the next run only if its directory was
+# last modified at least this many seconds before it was listed, so a
+# later change cannot leave the modification time as it was.
+SETTLE_SECONDS = 2
+
+# the active journal, or None
+journal = None
+
+
+class Inotify:
+
+    """Minimal wrapper for the Linux inotify system calls"""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self):
+        """Raise OSError for the last failed call"""
+        e = self.get_errno()
+        raise OSError(e, os.strerror(e))
+
+    def add_watch(self, pathname, mask):
+        """Watch a path and return the watch descriptor"""
+        if isinstance(pathname, unicode):
+            pathname = pathname.encode(bleachbit.FSE)
+        wd = self.libc.inotify_add_watch(self.fd, pathname, mask)
+        if wd < 0:
+            self._raise()
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching a watch descriptor"""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Return a list of (wd, mask, name) without blocking"""
+        ret = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return ret
+                raise
+            if not buf:
+                return ret
+            pos = 0
+            while pos < len(buf):
+                (wd, mask, _cookie, length) = EVENT_HEADER.unpack_from(buf, pos)
+                pos += EVENT_HEADER.size
+                name = buf[pos:pos + length].rstrip('\0')
+                pos += length
+                ret.append((wd, mask, name))
+
+    def close(self):
+        """Release the inotify instance"""
+        os.close(self.fd)
+
+
+class ChangeJournal:
+
+    """Cache of directory listings invalidated by inotify
+
+    A directory is watched when it is first listed.  Until inotify
+    reports that a name in it changed, its listing is served from
+    memory.  A directory that cannot be watched, for example because
+    the limit in /proc/sys/fs/inotify/max_user_watches is reached,
+    is always listed again.  When the kernel event queue overflows,
+    all listings are dropped.
+
+    Each listing is stored under a kind, so callers that keep different
+    forms of a listing do not clash.
+
+    Nothing watches a directory between runs of separate processes, so
+    save() writes each listing with the device, inode and modification
+    time of its directory, and load() reads them back.  A saved listing
+    is used only after the directory is watched again and still has
+    the same identity."""
+
+    version = 1
+
+    def __init__(self, inotify=None, pathname=None):
+        if pathname is None:
+            pathname = os.path.join(bleachbit.options_dir, 'listings.index')
+        self.pathname = pathname
+        self.inotify = inotify or Inotify()
+        self.lock = threading.Lock()
+        # watch descriptor to paths, and path to watch descriptor
+        self.paths = {}
+        self.wds = {}
+        # path to {kind: listing}
+        self.listings = {}
+        # path to the count of changes seen, to catch changes made
+        # while a directory was being listed
+        self.generations = {}
+        # path to (st_dev, st_ino, st_mtime) of a listing that may be
+        # saved, and path to (identity, {kind: listing}) from load()
+        self.identities = {}
+        self.saved = {}
+        self.watch_limit = False
+
+    def _poll(self):
+        """Apply the pending events (the lock must be held)"""
+        for (wd, mask, _name) in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                logger.debug('inotify queue overflow, dropping all listings')
+                for path in list(self.wds.keys()):
+                    self._changed(path)
+                self.listings.clear()
+                self.identities.clear()
+                continue
+            for path in list(self.paths.get(wd, ())):
+                self._changed(path)
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED | IN_UNMOUNT):
+                    # The subdirectories are no longer at these paths.
+                    prefix = os.path.join(path, '')
+                    for other in list(self.wds.keys()):
+                        if other == path or other.startswith(prefix):
+                            self._changed(other)
+                            self._forget(other)
+
+    def _changed(self, path):
+        """Drop the listing of a path (the lock must be held)"""
+        self.listings.pop(path, None)
+        self.identities.pop(path, None)
+        self.generations[path] = self.generations.get(path, 0) + 1
+
+    def _forget(self, path):
+        """Stop tracking a path (the lock must be held)"""
+        wd = self.wds.pop(path, None)
+        if wd is None:
+            return
+        paths = self.paths.get(wd)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del self.paths[wd]
+                self.inotify.rm_watch(wd)
+
+    def get(self, path, kind):
+        """Return the listing of path, or None if it must be listed"""
+        with self.lock:
+            self._poll()
+            listing = self.listings.get(path, {}).get(kind)
+            saved = self.saved.pop(path, None) if listing is None else None
+        if saved is not None and kind in saved[1]:
+            # Watch first, so a change after the check is seen.
+            token = self.watch(path)
+            if token is not None and saved[0] == self._identity(path):
+                for (saved_kind, saved_listing) in saved[1].items():
+                    self.put(path, saved_kind, saved_listing, token)
+                return self.get(path, kind)
+        return listing
+
+    @staticmethod
+    def _identity(path):
+        """Return (st_dev, st_ino, st_mtime) of a directory, or None"""
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            return None
+        return (stat.st_dev, stat.st_ino, stat.st_mtime)
+
+    def watch(self, path):
+        """Start watching path before listing it
+
+        Return a token for put(), or None if the path cannot be
+        watched."""
+        with self.lock:
+            if path not in self.wds:
+                try:
+                    wd = self.inotify.add_watch(path, WATCH_MASK)
+                except OSError as e:
+                    if errno.ENOSPC == e.errno and not self.watch_limit:
+                        logger.warning('inotify watch limit reached, listing '
+                                       'unwatched directories in full')
+                        self.watch_limit = True
+                    return None
+                self.wds[path] = wd
+                self.paths.setdefault(wd, set()).add(path)
+            return self.generations.get(path, 0)
+
+    def put(self, path, kind, listing, token):
+        """Remember the listing of path
+
+        token comes from watch(), and the listing is kept only if
+        nothing changed since then."""
+        if token is None:
+            return
+        identity = self._identity(path)
+        with self.lock:
+            self._poll()
+            if path in self.wds and self.generations.get(path, 0) == token:
+                self.listings.setdefault(path, {})[kind] = listing
+                if identity is not None and \
+                        time.time() - identity[2] >= SETTLE_SECONDS:
+                    self.identities[path] = identity
+                else:
+                    self.identities.pop(path, None)
+
+    def load(self):
+        """Read the listings saved by an earlier run"""
+        import marshal
+        self.saved = {}
+        if not os.path.exists(self.pathname):
+            return
+        try:
+            with open(self.pathname, 'rb') as f:
+                data = marshal.load(f)
+            if data['version'] == self.version:
+                self.saved = data['listings']
+        except Exception:
+            # The listings are only a cache, so start over.
+            logger.debug('ignoring saved listings %s', self.pathname, exc_info=True)
+            self.saved = {}
+
+    def save(self):
+        """Write the listings that can be checked in a later run
+
+        Saved listings that this run did not use are dropped."""
+        import marshal
+        with self.lock:
+            self._poll()
+            listings = dict([(path, (identity, self.listings[path]))
+                             for (path, identity) in self.identities.items()
+                             if path in self.listings])
+        data = {'version': self.version, 'listings': listings}
+        dirname = os.path.dirname(self.pathname)
+        try:
+            if not os.path.exists(dirname):
+                from bleachbit.General import makedirs
+                makedirs(dirname)
+            tmp_pathname = self.pathname + '.tmp'
+            with open(tmp_pathname, 'wb') as f:
+                marshal.dump(data, f)
+            if 'nt' == os.name and os.path.exists(self.pathname):
+                os.remove(self.pathname)
+            os.rename(tmp_pathname, self.pathname)
+        except (IOError, OSError):
+            logger.warning('cannot write saved listings %s', self.pathname, exc_info=True)
+
+    def close(self):
+        """Stop watching"""
+        with self.lock:
+            self.inotify.close()
+            self.paths.clear()
+            self.wds.clear()
+            self.listings.clear()
+            self.identities.clear()
+
+
+def enable(pathname=None):
+    """Start the journal with the listings saved by the last run, if
+    the platform supports it
+
+    Return the active journal, or None."""
+    global journal
+    if journal is None and os.path.exists('/proc/sys/fs/inotify'):
+        try:
+            journal = ChangeJournal(pathname=pathname)
+        except (AttributeError, OSError):
+            # AttributeError: libc without inotify
+            logger.debug('cannot start the change journal', exc_info=True)
+        else:
+            journal.load()
+    return journal
+
+
+def save():
+    """Save the listings of the active journal for the next run"""
+    if journal is not None:
+        journal.save()
+
+
+def disable():
+    """Stop the journal"""
+    global journal
+    if journal is not None:
+        journal.close()
+        journal = None
@@ -25,6 +25,7 @@ Perform (or assist with) cleaning operations.
 from __future__ import absolute_import, print_function
 
 from bleachbit import _, expanduser, expandvars
+from bleachbit.Action import plan_commands
 from bleachbit.FileUtilities import children_in_directory
 from bleachbit.Options import options
 from bleachbit import Command, FileUtilities, Memory, Special
@@ -54,6 +55,73 @@ except ImportError:
 backends = {}
 
 
+class ProcessSnapshot:
+
+    """Running programs, shared by the is_running() of all cleaners
+
+    Listing the processes is expensive, so the list of executable
+    names is kept for ttl seconds.  The running-detection globs are
+    kept for as long."""
+
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.time = None
+        self.exenames = None
+        self.pathnames = {}
+
+    def expire(self):
+        """Read the processes again on the next query"""
+        self.time = None
+
+    def _check_age(self):
+        import time
+        now = time.time()
+        if self.time is None or now - self.time > self.ttl:
+            self.time = now
+            self.exenames = None
+            self.pathnames = {}
+
+    def get_exenames(self):
+        """Return the set of names of running executables
+
+        On Windows the names are lowercase."""
+        self._check_age()
+        if self.exenames is None:
+            if 'posix' == os.name:
+                self.exenames = frozenset(Unix.running_exenames())
+            elif 'nt' == os.name:
+                self.exenames = frozenset(Windows.running_process_names())
+        return self.exenames
+
+    def is_exe_running(self, exename):
+        """Return whether an executable is running"""
+        if 'nt' == os.name:
+            exename = exename.lower()
+        return exename in self.get_exenames()
+
+    def pathname_exists(self, pathname):
+        """Return the first existing file matching the glob, or None"""
+        self._check_age()
+        if pathname not in self.pathnames:
+            found = None
+            for globbed in FileUtilities.iglob(FileUtilities.expand_path(pathname)):
+                if os.path.exists(globbed):
+                    found = globbed
+                    break
+            self.pathnames[pathname] = found
+        return self.pathnames[pathname]
+
+
+processes = ProcessSnapshot()
+
+
+def running_cleaners():
+    """Return the IDs of the cleaners whose programs are running
+
+    For example, the GUI can use this to mark them."""
+    return [key for key in sorted(backends) if backends[key].is_running()]
+
+
 class Cleaner:
 
     """Base class for a cleaner"""
@@ -101,10 +169,9 @@ class Cleaner:
 
     def get_commands(self, option_id):
         """Get list of Command instances for option 'option_id'"""
-        for action in self.actions:
-            if option_id == action[0]:
-                for cmd in action[1].get_commands():
-                    yield cmd
+        providers = [action[1] for action in self.actions if option_id == action[0]]
+        for cmd in plan_commands(providers):
+            yield cmd
         if option_id not in self.options:
             raise RuntimeError("Unknown option '%s'" % option_id)
 
@@ -154,21 +221,16 @@ class Cleaner:
         for running in self.running:
             test = running[0]
             pathname = running[1]
-            if 'exe' == test and 'posix' == os.name:
-                if Unix.is_running(pathname):
-                    logger.debug("process '%s' is running", pathname)
-                    return True
-            elif 'exe' == test and 'nt' == os.name:
-                if Windows.is_process_running(pathname):
+            if 'exe' == test and os.name in ('posix', 'nt'):
+                if processes.is_exe_running(pathname):
                     logger.debug("process '%s' is running", pathname)
                     return True
             elif 'pathname' == test:
-                expanded = expanduser(expandvars(pathname))
-                for globbed in glob.iglob(expanded):
-                    if os.path.exists(globbed):
-                        logger.debug(
-                            "file '%s' exists indicating '%s' is running", globbed, self.name)
-                        return True
+                globbed = processes.pathname_exists(pathname)
+                if globbed:
+                    logger.debug(
+                        "file '%s' exists indicating '%s' is running", globbed, self.name)
+                    return True
             else:
                 raise RuntimeError(
                     "Unknown running-detection test '%s'" % test)
@@ -350,7 +412,7 @@ class System(Cleaner):
         # cache
         if 'posix' == os.name and 'cache' == option_id:
             dirname = expanduser("~/.cache/")
-            for filename in children_in_directory(dirname, True):
+            for filename in children_in_directory(dirname, True, self.whitelisted_tree):
                 if not self.whitelisted(filename):
                     yield Command.Delete(filename)
 
@@ -489,7 +551,7 @@ class System(Cleaner):
         if 'posix' == os.name and 'tmp' == option_id:
             dirnames = ['/tmp', '/var/tmp']
             for dirname in dirnames:
-                for path in children_in_directory(dirname, True):
+                for path in children_in_directory(dirname, True, self.whitelisted_tree):
                     is_open = FileUtilities.openfiles.is_open(path)
                     ok = not is_open and os.path.isfile(path) and \
                         not os.path.islink(path) and \
@@ -657,6 +719,12 @@ class System(Cleaner):
                 return True
         return False
 
+    def whitelisted_tree(self, pathname):
+        """Return boolean whether a directory walk should skip pathname
+
+        This combines the built-in whitelist with the user's whitelist."""
+        return self.whitelisted(pathname) or FileUtilities.whitelisted(pathname)
+
 
 def register_cleaners():
     """Register all known cleaners: system, CleanerML, and Winapp2"""
@@ -25,7 +25,7 @@ Create cleaners from CleanerML (markup language)
 from __future__ import absolute_import, print_function
 
 import bleachbit
-from bleachbit.Action import ActionProvider
+from bleachbit.Action import ActionProvider, regex_registry
 from bleachbit import _
 from bleachbit.General import boolstr_to_bool, getText
 from bleachbit.FileUtilities import expand_glob_join, listdir
@@ -271,6 +271,7 @@ def load_cleaners():
             Cleaner.backends[cleaner.id] = cleaner
         else:
             logger.debug('cleaner is not usable on this OS because it has no actions: %s', pathname)
+    logger.debug('cleaners share %d compiled regular expressions', len(regex_registry))
 
 
 def pot_fragment(msgid, pathname, translators=None):
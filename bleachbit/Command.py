@@ -24,15 +24,19 @@ Command design pattern implementation for cleaning
 
 from __future__ import absolute_import, print_function
 
-from bleachbit import _
-from bleachbit import FileUtilities
+from bleachbit import _, FSE
+from bleachbit import FileUtilities, Scheduler
 
+import array
 import logging
 import os
+import sys
 import types
 
 from sqlite3 import DatabaseError
 
+logger = logging.getLogger(__name__)
+
 if 'nt' == os.name:
     import bleachbit.Windows
 else:
@@ -52,14 +56,44 @@ def whitelist(path):
     return ret
 
 
+def delete_file(path, shred, entry=None):
+    """Delete a path for Delete and DeleteBatch
+
+    Return True if the file is locked, so it was marked for deletion
+    upon system reboot."""
+    try:
+        FileUtilities.delete(path, shred, entry=entry)
+    except WindowsError as e:
+        # WindowsError: [Error 32] The process cannot access the file because it is being
+        # used by another process: u'C:\\Documents and
+        # Settings\\username\\Cookies\\index.dat'
+        if 32 != e.winerror and 5 != e.winerror:
+            raise
+        try:
+            bleachbit.Windows.delete_locked_file(path)
+        except:
+            raise
+        else:
+            if shred:
+                import warnings
+                warnings.warn(
+                    _('At least one file was locked by another process, so its contents could not be overwritten. It will be marked for deletion upon system reboot.'))
+            return True
+    return False
+
+
 class Delete:
 
     """Delete a single file or directory.  Obey the user
     preference regarding shredding."""
 
-    def __init__(self, path):
-        """Create a Delete instance to delete 'path'"""
+    def __init__(self, path, entry=None):
+        """Create a Delete instance to delete 'path'
+
+        The optional entry is a FileUtilities.PathEntry for path,
+        whose cached lstat() saves looking up the file again."""
         self.path = path
+        self.entry = entry
         self.shred = False
 
     def __str__(self):
@@ -71,6 +105,20 @@ class Delete:
         if FileUtilities.whitelisted(self.path):
             yield whitelist(self.path)
             return
+        yield self.delete(really_delete)
+
+    def delete(self, really_delete):
+        """Like execute() without the whitelist check, and return the
+        result
+
+        A file with other hard links gets the key 'links', a list of
+        (PathEntry.hard_link(), size), because its space is freed only
+        with its last link.  A clean lowers the link count as it goes,
+        so there every file gets the key, to match the last link."""
+        entry = self.entry
+        if entry is None:
+            # keep the lstat() for getsize(), hard_link() and delete()
+            entry = FileUtilities.PathEntry(self.path)
         ret = {
             # TRANSLATORS: This is the label in the log indicating will be
             # deleted (for previews) or was actually deleted
@@ -78,29 +126,309 @@ class Delete:
             'n_deleted': 1,
             'n_special': 0,
             'path': self.path,
-            'size': FileUtilities.getsize(self.path)}
-        if really_delete:
-            try:
-                FileUtilities.delete(self.path, self.shred)
-            except WindowsError as e:
-                # WindowsError: [Error 32] The process cannot access the file because it is being
-                # used by another process: u'C:\\Documents and
-                # Settings\\username\\Cookies\\index.dat'
-                if 32 != e.winerror and 5 != e.winerror:
-                    raise
+            'size': FileUtilities.getsize(self.path, entry)}
+        link = entry.hard_link(really_delete)
+        if link is not None:
+            ret['links'] = [(link, ret['size'])]
+        if really_delete and delete_file(self.path, self.shred, entry):
+            # TRANSLATORS: The file will be deleted when the
+            # system reboots
+            ret['label'] = _('Mark for deletion')
+        return ret
+
+
+class DeleteTree:
+
+    """Delete everything under a directory, but not the directory
+
+    This is the fast path for a walk.all delete action when nothing
+    under the directory is whitelisted, so the whitelist is checked
+    once for the tree instead of once per file.  The tree is removed
+    bottom up, and the result is one record for all of it.  Each file
+    is logged only at the debug level.  Until the record, True is
+    yielded every step files, so a large tree does not hold up the
+    user interface."""
+
+    def __init__(self, path):
+        self.path = path
+        # called with (PathEntry, result of Delete.delete()) for each
+        # path, so a preview can keep what it found
+        self.on_delete = None
+
+    def __str__(self):
+        return 'Command to delete everything under %s' % self.path
+
+    def execute(self, really_delete, step=256):
+        """Make changes and return results"""
+        ret = {
+            'label': _('Delete'),
+            'n_deleted': 0,
+            'n_errors': 0,
+            'n_special': 0,
+            'path': self.path,
+            'size': 0}
+        verbose = logger.isEnabledFor(logging.DEBUG)
+        n_entries = 0
+        for (_dirpath, dirs, files) in FileUtilities.walk_entries(self.path):
+            for entry in FileUtilities.inode_order(dirs + files):
+                n_entries += 1
+                if 0 == n_entries % step:
+                    yield True
+                if entry.is_symlink() and FileUtilities.whitelisted(entry.path):
+                    # the link resolves to a whitelisted path
+                    continue
                 try:
-                    bleachbit.Windows.delete_locked_file(self.path)
-                except:
-                    raise
+                    result = Delete(entry.path, entry).delete(really_delete)
+                except OSError as e:
+                    # for example, permission denied
+                    logger.error('%s: %s', str(e).decode(FSE), entry.path)
+                    ret['n_errors'] += 1
+                    continue
+                if verbose:
+                    logger.debug('%s %s', result['label'], entry.path)
+                if self.on_delete is not None:
+                    self.on_delete(entry, result)
+                ret['n_deleted'] += 1
+                ret['size'] += result['size']
+                if 'links' in result:
+                    ret.setdefault('links', []).extend(result['links'])
+        if ret['n_deleted'] or ret['n_errors']:
+            yield ret
+
+
+class BatchResult(object):
+
+    """The result of one file in a DeleteBatch, read like the
+    dictionary that Delete.execute() yields"""
+
+    __slots__ = ('label', 'n_deleted', 'n_special', 'path', 'size')
+
+    def __init__(self, label, n_deleted, path, size):
+        self.label = label
+        self.n_deleted = n_deleted
+        self.n_special = 0
+        self.path = path
+        self.size = size
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class DeleteBatch(object):
+
+    """Delete many files, as a Delete for each would
+
+    The paths, sizes and outcomes are kept in parallel arrays, and
+    run() goes through them in one loop, so a file costs no command,
+    generator or result dictionary of its own.  The Worker reads the
+    outcomes from the arrays, and the labels are looked up once."""
+
+    __slots__ = ('paths', 'entries', 'sizes', 'status', 'errors', 'expected',
+                 'links')
+
+    # status codes
+    PENDING = 0
+    DELETED = 1
+    SKIPPED = 2  # whitelisted
+    MARKED = 3  # marked for deletion upon system reboot
+    FAILED = 4
+    CHANGED = 5  # not the file the preview found
+
+    _labels = None
+
+    def __init__(self):
+        self.paths = []
+        self.entries = []
+        self.sizes = array.array('d')
+        self.status = array.array('b')
+        # index to sys.exc_info() of a failed file
+        self.errors = {}
+        # PathEntry.identity() from a preview, or None
+        self.expected = []
+        # (index, PathEntry.hard_link()) in the order the files were
+        # looked at, which is also the order of their deletes
+        self.links = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __str__(self):
+        return 'Command to delete %d files' % len(self.paths)
+
+    @classmethod
+    def labels(cls):
+        """Return the labels by status code"""
+        if cls._labels is None:
+            cls._labels = {cls.DELETED: _('Delete'),
+                           cls.SKIPPED: _('Skip'),
+                           cls.MARKED: _('Mark for deletion'),
+                           # TRANSLATORS: The file changed since the
+                           # preview, so it was not deleted
+                           cls.CHANGED: _('Changed')}
+        return cls._labels
+
+    def append(self, path, entry=None, expected=None):
+        """Add a file, with its optional FileUtilities.PathEntry
+
+        If expected is the PathEntry.identity() seen by a preview, the
+        file is deleted only if it is still the same."""
+        self.paths.append(path)
+        self.entries.append(entry)
+        self.expected.append(expected)
+        self.sizes.append(0)
+        self.status.append(self.PENDING)
+
+    def run(self, really_delete, step=256):
+        """Make changes and record the outcomes
+
+        Yield True after each step files, so the caller can keep
+        the user interface responsive.  While Scheduler.scheduler is
+        active, the files are deleted by its threads, several devices
+        at once, and the outcomes are still kept by index.  A
+        directory comes after its children, so it waits for the files
+        before it.  Shredding renames files in their directory before
+        it deletes them, so then the files are deleted one by one.
+
+        While FileUtilities.unlinker is active, the files of one
+        directory share a FileUtilities.ParentDir, which is released
+        at the end."""
+        from bleachbit.Options import options
+        unlinker = FileUtilities.unlinker
+        if not really_delete or options.get('shred') or unlinker is None:
+            for ret in self._run(really_delete, step):
+                yield ret
+            return
+        parents = self._parents()
+        try:
+            for ret in self._run(really_delete, step):
+                yield ret
+        finally:
+            for parent in parents:
+                unlinker.release(parent)
+
+    def _run(self, really_delete, step):
+        """Do run()"""
+        from bleachbit.Options import options
+        scheduler = Scheduler.scheduler if really_delete else None
+        if scheduler is not None and len(self.paths) > 1 and \
+                not options.get('shred'):
+            device = self._device()
+            dirname = os.path.dirname
+            start = 0
+            parents = set()
+            for i in xrange(len(self.paths)):
+                if self.paths[i] in parents:
+                    for ret in scheduler.run(xrange(start, i), device,
+                                             lambda j: self._run_one(j, True)):
+                        yield ret
+                    start = i
+                    parents = set()
+                parents.add(dirname(self.paths[i]))
+            for ret in scheduler.run(xrange(start, len(self.paths)), device,
+                                     lambda j: self._run_one(j, True)):
+                yield ret
+            return
+        for i in xrange(len(self.paths)):
+            self._run_one(i, really_delete)
+            if step - 1 == i % step:
+                yield True
+
+    def _run_one(self, i, really_delete):
+        """Make changes for file i and record the outcome"""
+        path = self.paths[i]
+        entry = self.entries[i]
+        if entry is None:
+            # keep the lstat() for getsize() and delete()
+            entry = self.entries[i] = FileUtilities.PathEntry(path)
+        if FileUtilities.whitelisted(path):
+            self.status[i] = self.SKIPPED
+        elif self.expected[i] is not None and not self._same(i):
+            self.status[i] = self.CHANGED
+        else:
+            try:
+                self.sizes[i] = FileUtilities.getsize(path, entry)
+                link = entry.hard_link(really_delete)
+                if link is not None:
+                    # Before the delete, so a link that sees another
+                    # deleted comes after it, even across threads.
+                    self.links.append((i, link))
+                if really_delete and delete_file(path, False, entry):
+                    self.status[i] = self.MARKED
                 else:
-                    if self.shred:
-                        import warnings
-                        warnings.warn(
-                            _('At least one file was locked by another process, so its contents could not be overwritten. It will be marked for deletion upon system reboot.'))
-                    # TRANSLATORS: The file will be deleted when the
-                    # system reboots
-                    ret['label'] = _('Mark for deletion')
-        yield ret
+                    self.status[i] = self.DELETED
+            except Exception:
+                self.status[i] = self.FAILED
+                self.errors[i] = sys.exc_info()
+
+    def _parents(self):
+        """Give every file the FileUtilities.ParentDir of its
+        directory, and return the set of them
+
+        Files from a walk already have one.  For the others, each
+        directory costs one stat()."""
+        parents = set()
+        found = {}
+        dirname = os.path.dirname
+        for i in xrange(len(self.paths)):
+            entry = self.entries[i]
+            if entry is None:
+                entry = self.entries[i] = \
+                    FileUtilities.PathEntry(self.paths[i])
+            if entry.parent is None:
+                parent = dirname(self.paths[i])
+                if parent not in found:
+                    try:
+                        st = os.stat(parent)
+                    except OSError:
+                        found[parent] = None
+                    else:
+                        found[parent] = FileUtilities.ParentDir(
+                            parent, (st.st_dev, st.st_ino))
+                entry.parent = found[parent]
+            if entry.parent is not None:
+                parents.add(entry.parent)
+        return parents
+
+    def _device(self):
+        """Return a function giving the st_dev of file i
+
+        The device of a file is that of its directory, so the files
+        of a directory cost one lstat()."""
+        devices = {}
+        dirname = os.path.dirname
+
+        def device(i):
+            parent = dirname(self.paths[i])
+            if parent not in devices:
+                try:
+                    devices[parent] = os.lstat(parent).st_dev
+                except OSError:
+                    devices[parent] = None
+            return devices[parent]
+        return device
+
+    def _same(self, i):
+        """Return whether file i is the one the preview found"""
+        try:
+            return self.entries[i].identity() == self.expected[i]
+        except OSError:
+            # gone, or no longer accessible
+            return False
+
+    def execute(self, really_delete):
+        """Yield a BatchResult for each file, like Delete.execute()
+
+        The error of a file that failed is raised when it is reached."""
+        for _dummy in self.run(really_delete):
+            pass
+        labels = self.labels()
+        for i in xrange(len(self.paths)):
+            status = self.status[i]
+            if self.FAILED == status:
+                raise self.errors[i][1]
+            yield BatchResult(labels[status],
+                              int(status in (self.DELETED, self.MARKED)),
+                              self.paths[i], int(self.sizes[i]))
 
 
 class Function:
@@ -253,9 +581,9 @@ class Shred(Delete):
 
     """Shred a single file"""
 
-    def __init__(self, path):
+    def __init__(self, path, entry=None):
         """Create an instance to shred 'path'"""
-        Delete.__init__(self, path)
+        Delete.__init__(self, path, entry)
         self.shred = True
 
     def __str__(self):
@@ -275,18 +603,22 @@ class Truncate(Delete):
         if FileUtilities.whitelisted(self.path):
             yield whitelist(self.path)
             return
+        yield self.delete(really_delete)
 
+    def delete(self, really_delete):
+        """Like execute() without the whitelist check, and return the
+        result"""
         ret = {
             # TRANSLATORS: The file will be truncated to 0 bytes in length
             'label': _('Truncate'),
             'n_deleted': 1,
             'n_special': 0,
             'path': self.path,
-            'size': FileUtilities.getsize(self.path)}
+            'size': FileUtilities.getsize(self.path, self.entry)}
         if really_delete:
             f = open(self.path, 'wb')
             f.truncate(0)
-        yield ret
+        return ret
 
 
 class Winreg:
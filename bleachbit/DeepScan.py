@@ -35,6 +35,16 @@ import bleachbit
 
 UTF8 = 'utf-8'
 
+# Linux file systems without user files, skipped by default
+PSEUDO_FSTYPES = ('autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2',
+                  'configfs', 'debugfs', 'devpts', 'efivarfs', 'fusectl',
+                  'hugetlbfs', 'mqueue', 'proc', 'pstore', 'securityfs',
+                  'sysfs', 'tracefs')
+
+# An ordered parallel walk lists this many of the next directories per
+# worker ahead of the one it yields next.
+READ_AHEAD = 4
+
 
 def to_unicode(s):
     """
@@ -70,41 +80,817 @@ def normalized_walk(top, **kwargs):
             yield result
 
 
+def combine_regexes(regexes):
+    """Compile regexes into one alternation with a named group for each
+
+    The group name 'sN' points back to regexes[N].  Return None if the
+    regexes cannot be safely combined, for example because they use
+    numbered back references or global flags that would leak into the
+    other alternatives."""
+    for regex in regexes:
+        if re.search(r'\\[1-9]|\(\?[iLmsux]+\)', regex):
+            return None
+    pattern = '|'.join(['(?P<s%d>%s)' % (i, regex)
+                        for (i, regex) in enumerate(regexes)])
+    try:
+        return re.compile(pattern)
+    except (re.error, AssertionError, OverflowError):
+        # Python 2 supports at most 100 groups
+        return None
+
+
+def _required_literals(items, ignorecase):
+    """Return the literal tails of a parsed pattern
+
+    Return a list of (text, exact, ignorecase) where a matching string
+    must end with text (or equal it, if exact), or None if there is no
+    such literal."""
+    import sre_constants
+    if 1 == len(items) and sre_constants.BRANCH == items[0][0]:
+        ret = []
+        for branch in items[0][1][1]:
+            tails = _required_literals(list(branch), ignorecase)
+            if tails is None:
+                return None
+            ret += tails
+        return ret
+    if not items or items[-1] not in ((sre_constants.AT, sre_constants.AT_END),
+                                      (sre_constants.AT, sre_constants.AT_END_STRING)):
+        return None
+    chars = []
+    pos = len(items) - 2
+    while pos >= 0:
+        (op, av) = items[pos]
+        if sre_constants.LITERAL == op and av < 128:
+            chars.append(chr(av))
+        elif sre_constants.IN == op and 2 == len(av) and \
+                all([sre_constants.LITERAL == op2 and av2 < 128 for (op2, av2) in av]) and \
+                chr(av[0][1]).lower() == chr(av[1][1]).lower():
+            # a class such as [Bb]
+            chars.append(chr(av[0][1]).lower())
+            ignorecase = True
+        else:
+            break
+        pos -= 1
+    if not chars:
+        return None
+    text = ''.join(reversed(chars))
+    exact = 0 == pos and (sre_constants.AT, sre_constants.AT_BEGINNING) == items[0]
+    if ignorecase:
+        text = text.lower()
+    return [(text, exact, ignorecase)]
+
+
+def compile_prefilter(regexes, flags=0):
+    """Return a quick test for names that may match any of the regexes
+
+    Most CleanerML patterns end with a literal, such as ^Thumbs\.db$
+    or \.[Bb][Aa][Kk]$, so a set lookup or str.endswith() rejects
+    most names before any regex runs.  The test may accept names that
+    do not match, but never rejects one that does.  Return None if a
+    regex has no literal ending, so every name must be tried."""
+    import sre_constants
+    import sre_parse
+    if flags & (re.MULTILINE | re.LOCALE | re.UNICODE):
+        return None
+    exact = set()
+    exact_lower = set()
+    suffixes = []
+    suffixes_lower = []
+    for regex in regexes:
+        try:
+            parsed = sre_parse.parse(regex, flags)
+        except (re.error, sre_constants.error, AssertionError, OverflowError):
+            return None
+        if parsed.pattern.flags & (re.MULTILINE | re.LOCALE | re.UNICODE):
+            return None
+        ignorecase = bool(parsed.pattern.flags & re.IGNORECASE)
+        tails = _required_literals(list(parsed), ignorecase)
+        if tails is None:
+            return None
+        for (text, is_exact, is_ignorecase) in tails:
+            if is_exact:
+                (exact_lower if is_ignorecase else exact).add(text)
+            else:
+                (suffixes_lower if is_ignorecase else suffixes).append(text)
+    suffixes = tuple(suffixes)
+    suffixes_lower = tuple(suffixes_lower)
+    any_lower = bool(exact_lower or suffixes_lower)
+
+    def prefilter(name):
+        if name.endswith('\n'):
+            # $ also matches before a final newline
+            name = name[:-1]
+        if name in exact or name.endswith(suffixes):
+            return True
+        if any_lower:
+            name = name.lower()
+            return name in exact_lower or name.endswith(suffixes_lower)
+        return False
+    return prefilter
+
+
+def compile_searches(regexes):
+    """Compile a list of regexes into a function
+
+    The function takes a filename and returns a regex that matches it,
+    or None."""
+    match = _compile_searches(regexes)
+    prefilter = compile_prefilter(regexes)
+    if prefilter is None:
+        return match
+
+    def prefiltered_match(filename):
+        if not prefilter(filename):
+            return None
+        return match(filename)
+    return prefiltered_match
+
+
+def _compile_searches(regexes):
+    """Like compile_searches() without the prefilter"""
+    combined = combine_regexes(regexes)
+    if combined is not None:
+        def match(filename):
+            ret = combined.search(filename)
+            if ret is None:
+                return None
+            return regexes[int(ret.lastgroup[1:])]
+    else:
+        compiled = [(regex, re.compile(regex)) for regex in regexes]
+
+        def match(filename):
+            for (regex, r) in compiled:
+                if r.search(filename):
+                    return regex
+            return None
+    return match
+
+
+def dir_key(dirpath, st):
+    """Return a key identifying the directory
+
+    The key is (st_dev, st_ino) when the platform provides inode
+    numbers, so a directory reached by two names has one key."""
+    if st.st_ino:
+        return (st.st_dev, st.st_ino)
+    # Python 2 on Windows gives zero for st_ino.
+    return os.path.normcase(os.path.normpath(dirpath))
+
+
+def mount_fstypes(mountinfo='/proc/self/mountinfo'):
+    """Return a dictionary mapping st_dev to the file system type
+
+    The information comes from the Linux mountinfo file.  On other
+    systems, return an empty dictionary."""
+    ret = {}
+    try:
+        with open(mountinfo) as f:
+            for line in f:
+                # mount ID, parent ID, major:minor, root, mount point,
+                # options, optional fields, separator, type, source, ...
+                fields = line.split()
+                try:
+                    (major, minor) = fields[2].split(':')
+                    fstype = fields[fields.index('-', 6) + 1]
+                except (IndexError, ValueError):
+                    continue
+                ret[os.makedev(int(major), int(minor))] = fstype
+    except (IOError, OSError):
+        pass
+    return ret
+
+
+class PrunePolicy:
+
+    """Subtrees a deep scan search does not descend into
+
+    one_file_system stays on the device of the root.  fstypes is a
+    collection of file system types such as 'proc' to skip.  dirnames
+    is a regular expression for the names of directories to skip."""
+
+    def __init__(self, one_file_system=False, fstypes=(), dirnames=None):
+        self.one_file_system = one_file_system
+        self.fstypes = frozenset(fstypes)
+        self.dirnames = dirnames
+        self.dirnames_c = re.compile(dirnames) if dirnames else None
+
+    def __eq__(self, other):
+        return isinstance(other, PrunePolicy) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return 'PrunePolicy(%r, %r, %r)' % self.key()
+
+    def key(self):
+        """Return a tuple describing the policy"""
+        return (self.one_file_system, tuple(sorted(self.fstypes)), self.dirnames)
+
+    def reason(self, dirpath, st, root_dev, fstypes):
+        """Return why to skip the directory, or None to descend
+
+        root_dev is the device of the search root, and fstypes is
+        the result of mount_fstypes()."""
+        if self.dirnames_c and self.dirnames_c.search(os.path.basename(dirpath)):
+            return 'directory name'
+        if self.one_file_system and st.st_dev != root_dev:
+            return 'another file system'
+        if self.fstypes and fstypes.get(st.st_dev) in self.fstypes:
+            return 'file system type %s' % fstypes[st.st_dev]
+        return None
+
+
+def normalized_listdir(dirpath):
+    """List a directory the way normalized_walk() does
+
+    Return (dirnames, filenames) where dirnames are the subdirectories
+    to descend into (symbolic links are not followed) and filenames are
+    the names that are not directories.  Raise OSError if the directory
+    cannot be listed."""
+    from bleachbit import ChangeJournal
+    journal = ChangeJournal.journal
+    if journal is not None:
+        listing = journal.get(dirpath, 'deepscan')
+        if listing is not None:
+            return listing
+        token = journal.watch(dirpath)
+    from bleachbit.FileUtilities import list_entries
+    dirnames = []
+    filenames = []
+    for entry in list_entries(dirpath):
+        name = os.path.basename(entry.path)
+        if entry.is_dir():
+            if not entry.is_symlink():
+                dirnames.append(name)
+        else:
+            filenames.append(name)
+    if 'Darwin' == platform.system():
+        filenames = [unicodedata.normalize('NFC', to_unicode(fn)).encode(UTF8)
+                     for fn in filenames]
+    if journal is not None:
+        journal.put(dirpath, 'deepscan', (dirnames, filenames), token)
+    return (dirnames, filenames)
+
+
+class DeepScanIndex:
+
+    """On-disk cache of the directories seen by deep scans
+
+    For each directory the index keeps its mtime, the subdirectories
+    and the filenames that matched.  A directory whose mtime has not
+    changed is served from the index instead of being listed again.
+    Adding, removing or renaming an entry changes the mtime of its
+    directory, so this is safe for matching by filename.
+
+    The index holds at most max_entries directories.  When it grows
+    past that, the directories not used for the most runs are evicted,
+    and they are listed again when next needed."""
+
+    version = 1
+
+    def __init__(self, pathname=None, max_entries=200000):
+        if pathname is None:
+            pathname = os.path.join(bleachbit.options_dir, 'deepscan.index')
+        self.pathname = pathname
+        self.max_entries = max_entries
+        self.run = 0
+        self.tables = None
+
+    def load(self):
+        """Read the index from disk"""
+        import marshal
+        self.tables = {}
+        if not os.path.exists(self.pathname):
+            return
+        try:
+            with open(self.pathname, 'rb') as f:
+                data = marshal.load(f)
+            if data['version'] == self.version:
+                self.run = data['run']
+                self.tables = data['tables']
+        except Exception:
+            # The index is only a cache, so start over.
+            logging.getLogger(__name__).debug('ignoring deep scan index %s', self.pathname,
+                                              exc_info=True)
+            self.tables = {}
+
+    def save(self):
+        """Evict cold directories and write the index to disk"""
+        import marshal
+        if self.tables is None:
+            return
+        self.evict()
+        data = {'version': self.version, 'run': self.run, 'tables': self.tables}
+        dirname = os.path.dirname(self.pathname)
+        try:
+            if not os.path.exists(dirname):
+                from bleachbit.General import makedirs
+                makedirs(dirname)
+            tmp_pathname = self.pathname + '.tmp'
+            with open(tmp_pathname, 'wb') as f:
+                marshal.dump(data, f)
+            if 'nt' == os.name and os.path.exists(self.pathname):
+                os.remove(self.pathname)
+            os.rename(tmp_pathname, self.pathname)
+        except (IOError, OSError):
+            logging.getLogger(__name__).warning('cannot write deep scan index %s',
+                                                self.pathname, exc_info=True)
+
+    def evict(self):
+        """Drop the least recently used directories beyond max_entries"""
+        count = sum([len(table) for table in self.tables.values()])
+        if count <= self.max_entries:
+            return
+        ages = []
+        for (signature, table) in self.tables.items():
+            for (dirpath, record) in table.items():
+                ages.append((record[1], signature, dirpath))
+        ages.sort()
+        for (_run, signature, dirpath) in ages[0:count - self.max_entries]:
+            del self.tables[signature][dirpath]
+        for signature in [k for (k, v) in self.tables.items() if not v]:
+            del self.tables[signature]
+
+    def start(self):
+        """Begin a scan"""
+        if self.tables is None:
+            self.load()
+        self.run += 1
+
+    def table(self, signature):
+        """Return the directories recorded for one walk"""
+        return self.tables.setdefault(signature, {})
+
+
+class ListingPool:
+
+    """Threads that list directories from a shared queue
+
+    Any idle thread takes the next directory, so a slow directory
+    does not hold up the others.  Results are returned in the order
+    they finish."""
+
+    def __init__(self, workers, visit):
+        import Queue
+        import threading
+        self.Empty = Queue.Empty
+        self.jobs = Queue.Queue()
+        self.done = Queue.Queue()
+        self.visit = visit
+        self.threads = [threading.Thread(target=self._run) for _i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        """Thread body"""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                self.done.put((job, self.visit(job), None))
+            except Exception as e:
+                self.done.put((job, None, e))
+
+    def submit(self, job):
+        """Queue a directory to list"""
+        self.jobs.put(job)
+
+    def get(self, timeout):
+        """Return (job, listing) for a finished directory
+
+        Return None if nothing finished within timeout seconds.  An
+        exception raised while listing is raised here."""
+        try:
+            (job, listing, error) = self.done.get(True, timeout)
+        except self.Empty:
+            return None
+        if error is not None:
+            raise error
+        return (job, listing)
+
+    def close(self):
+        """Stop the threads and drop the directories not yet started"""
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except self.Empty:
+            pass
+        for _thread in self.threads:
+            self.jobs.put(None)
+
+
 class DeepScan:
 
     """Advanced directory tree scan"""
 
-    def __init__(self):
+    def __init__(self, index=None, workers=1, ordered=True):
         self.roots = []
         self.searches = {}
+        # searches allowed to use the index, by directory
+        self.cached = {}
+        # prune policies, by directory
+        self.policies = {}
+        self.index = index
+        # threads listing directories, and whether to keep their order
+        self.workers = workers
+        self.ordered = ordered
 
-    def add_search(self, dirname, regex):
-        """Starting in dirname, look for files matching regex"""
+    def add_search(self, dirname, regex, cache=False, policy=None):
+        """Starting in dirname, look for files matching regex
+
+        If cache is True, the search may be served from the index.
+        policy is an optional PrunePolicy."""
         if dirname not in self.searches:
             self.searches[dirname] = [regex]
-        else:
+        elif regex not in self.searches[dirname]:
             self.searches[dirname].append(regex)
+        if cache:
+            self.cached.setdefault(dirname, set()).add(regex)
+        policies = self.policies.setdefault(dirname, [])
+        if policy not in policies:
+            policies.append(policy)
+
+    def plan(self, fstypes=None):
+        """Fold the searches into as few walks as possible
+
+        Roots that resolve to the same directory are merged, and a root
+        inside another root is walked as part of the outer root with
+        the combined searches for its subtree.  A root is not folded
+        into an outer root whose policies would prune a directory on
+        the way to it, because then the walk would not reach it.
+        fstypes is the result of mount_fstypes(), read here if a
+        policy needs it.
+
+        Return a list of (top, regexes, nested, cache, policies, others)
+        where nested maps the dir_key() of each nested root to the
+        regexes for its subtree, cache is whether every search in the
+        walk allows the index, policies is a list of (root_dev, policy)
+        for the searches in the walk, where policy may be None, and
+        others is the set of dir_key() of the roots inside top that
+        have a walk of their own."""
+        logger = logging.getLogger(__name__)
+        # Group by real path, preferring a name that is not a link.
+        roots = {}
+        uncached = set()
+        policies = {}
+        for dirname in sorted(self.searches.keys()):
+            real = os.path.realpath(dirname)
+            name = os.path.normpath(dirname)
+            if real not in roots:
+                roots[real] = (name, [])
+            elif name == real:
+                roots[real] = (name, roots[real][1])
+            for regex in self.searches[dirname]:
+                if regex not in roots[real][1]:
+                    roots[real][1].append(regex)
+                if regex not in self.cached.get(dirname, ()):
+                    uncached.add(real)
+            for policy in self.policies.get(dirname, [None]):
+                if policy not in policies.setdefault(real, []):
+                    policies[real].append(policy)
+
+        def ancestors(real):
+            """Return the roots containing real, outermost first"""
+            return sorted([other for other in roots
+                           if other == real or
+                           real.startswith(os.path.join(other, ''))], key=len)
+
+        if fstypes is None and \
+                any([policy and policy.fstypes for values in policies.values()
+                     for policy in values]):
+            fstypes = mount_fstypes()
+
+        def reaches(outer, real):
+            """Return whether the policies of outer prune no directory
+            from outer down to real"""
+            if None in policies[outer]:
+                return True
+            try:
+                root_dev = os.stat(outer).st_dev
+            except OSError:
+                return False
+            dirpath = outer
+            for name in real[len(outer):].split(os.sep):
+                if not name:
+                    continue
+                dirpath = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(dirpath)
+                except OSError:
+                    return False
+                if all([policy.reason(dirpath, st, root_dev, fstypes)
+                        for policy in policies[outer]]):
+                    return False
+            return True
+
+        # root to the root whose walk it is part of
+        walks = {}
+        for real in sorted(roots.keys(), key=len):
+            walks[real] = real
+            for outer in ancestors(real)[:-1]:
+                if reaches(outer, real):
+                    walks[real] = walks[outer]
+                    break
+
+        ret = []
+        for real in sorted(roots.keys()):
+            if walks[real] != real:
+                # walked as part of walks[real]
+                continue
+            (top, regexes) = roots[real]
+            nested = {}
+            others = set()
+            cache = real not in uncached
+            walk_policies = []
+            for other in roots:
+                if other == real or not other.startswith(os.path.join(real, '')):
+                    continue
+                if walks[other] != real:
+                    try:
+                        others.add(dir_key(roots[other][0], os.stat(other)))
+                    except OSError:
+                        pass
+                    continue
+                subtree_regexes = []
+                for ancestor in ancestors(other):
+                    if walks[ancestor] != real:
+                        continue
+                    for regex in roots[ancestor][1]:
+                        if regex not in subtree_regexes:
+                            subtree_regexes.append(regex)
+                try:
+                    nested[dir_key(roots[other][0], os.stat(other))] = subtree_regexes
+                except OSError:
+                    continue
+                cache = cache and other not in uncached
+                walk_policies += self._root_policies(other, policies[other])
+                logger.debug('deep scan root %s is folded into %s', roots[other][0], top)
+            walk_policies += self._root_policies(real, policies[real])
+            ret.append((top, regexes, nested, cache, walk_policies, others))
+        return ret
+
+    @staticmethod
+    def _root_policies(real, policies):
+        """Return (root_dev, policy) for the policies of one root"""
+        try:
+            root_dev = os.stat(real).st_dev
+        except OSError:
+            return []
+        return [(root_dev, policy) for policy in policies]
 
     def scan(self):
         """Perform requested searches and yield each match"""
-        logging.getLogger(__name__).debug('DeepScan.scan: searches=%s', str(self.searches))
+        for ret in self.scan_matches():
+            if True == ret:
+                yield True
+            else:
+                yield ret[0]
+
+    def scan_matches(self):
+        """Perform requested searches
+
+        Yield a tuple (path, regex) for each match, where regex is a
+        search that matched it, and occasionally True to allow the GUI
+        to process its idle loop.  Each filename is matched once even
+        when several searches apply to it, and each directory is
+        visited once even when several roots or links lead to it."""
+        logger = logging.getLogger(__name__)
+        logger.debug('DeepScan.scan: searches=%s', str(self.searches))
         import time
         yield_time = time.time()
 
-        for (top, regexes) in self.searches.items():
-            for (dirpath, dirnames, filenames) in normalized_walk(top):
-                for regex in regexes:
-                    # fixme, don't match filename twice
-                    r = re.compile(regex)
-                    for filename in filenames:
-                        if r.search(filename):
-                            full_path = os.path.join(dirpath, filename)
-                            if isinstance(full_path, str):
-                                # Convert path to Unicode.
-                                full_path = full_path.decode(bleachbit.FSE)
-                            yield full_path
+        fstypes = None
+        if any([policy and policy.fstypes for policies in self.policies.values()
+                for policy in policies]):
+            fstypes = mount_fstypes()
+        plan = self.plan(fstypes)
+        if any([walk[3] for walk in plan]):
+            if self.index is None:
+                self.index = DeepScanIndex()
+            self.index.start()
+
+        visited = set()
+        for (top, regexes, nested, cache, policies, others) in plan:
+            if cache:
+                import hashlib
+                signature = hashlib.md5(repr(
+                    (top, regexes, sorted(nested.items())))).hexdigest()
+                table = self.index.table(signature)
+            else:
+                table = None
+            # Compile once per subtree, not once per directory.
+            match = compile_searches(regexes)
+            nested = dict([(key, compile_searches(subtree_regexes))
+                           for (key, subtree_regexes) in nested.items()])
+            if os.name == 'nt':
+                # NTFS stores files as Unicode, and this makes listing
+                # return Unicode.
+                top = unicode(top)
+            else:
+                # On Linux the file system encoding may be UTF-8, but deal with
+                # bytestrings to avoid potential UnicodeDecodeError in
+                # posixpath.join()
+                top = str(top)
+            prune = self._pruner(policies, set(nested.keys()), fstypes, others)
+            for ret in self._walk(top, match, nested, table, visited, prune):
+                if True == ret:
+                    yield True
+                    yield_time = time.time()
+                    continue
+                (dirpath, dir_match, filenames) = ret
+                for filename in filenames:
+                    regex = dir_match(filename)
+                    if regex is None:
+                        continue
+                    full_path = os.path.join(dirpath, filename)
+                    if isinstance(full_path, str):
+                        # Convert path to Unicode.
+                        full_path = full_path.decode(bleachbit.FSE)
+                    yield (full_path, regex)
 
                 if time.time() - yield_time > 0.25:
                     # allow GTK+ to process the idle loop
                     yield True
                     yield_time = time.time()
+
+        if self.index is not None and self.index.tables is not None:
+            self.index.save()
+
+    @staticmethod
+    def _pruner(policies, roots, fstypes, others=()):
+        """Return a function telling whether to skip a directory
+
+        A directory is skipped only when every search in the walk has
+        a policy that skips it, or when it is in others, the roots
+        with a walk of their own.  Roots are never skipped."""
+        use_policies = policies and \
+            None not in [policy for (_dev, policy) in policies]
+        if not use_policies and not others:
+            return None
+
+        def prune(dirpath, st, key, top=False):
+            if top or key in roots:
+                return False
+            if key in others:
+                logging.getLogger(__name__).debug(
+                    'deep scan leaves %s to its own walk', dirpath)
+                return True
+            if not use_policies:
+                return False
+            reasons = []
+            for (root_dev, policy) in policies:
+                reason = policy.reason(dirpath, st, root_dev, fstypes)
+                if reason is None:
+                    return False
+                reasons.append(reason)
+            logging.getLogger(__name__).debug(
+                'deep scan pruned %s (%s)', dirpath, reasons[0])
+            return True
+        return prune
+
+    def _walk(self, top, match, nested, table, visited, prune=None):
+        """Walk one tree depth first
+
+        Yield (dirpath, dir_match, filenames) for each directory not
+        visited before, and True while waiting on the listing threads.
+        With several workers, directories are listed in parallel.  The
+        order is the same as with one worker when ordered is set, and
+        otherwise directories come in the order their listings finish.
+        An ordered walk lists ahead only the next few directories per
+        worker in that order, so the listings waiting for their turn
+        grow with the depth of the tree, not with its width."""
+        if self.workers < 2:
+            pending = [(top, match)]
+            while pending:
+                job = pending.pop()
+                listing = self._visit(job, nested, table, visited, prune, top)
+                children = self._accept(job[0], listing, visited)
+                if children is None:
+                    continue
+                pending.extend(reversed(children))
+                yield (job[0], listing[1], listing[3])
+            return
+
+        pool = ListingPool(self.workers,
+                           lambda job: self._visit(job, nested, table, visited, prune, top))
+        try:
+            if self.ordered:
+                # Keep the serial order and let the threads list the
+                # next limit directories in it.  Each level of the
+                # tree then has at most limit of them outstanding.
+                limit = READ_AHEAD * self.workers
+                listings = {}
+                # paths submitted and not yet yielded
+                submitted = set()
+                pending = [(top, match)]
+                while pending:
+                    job = pending.pop()
+                    if job[0] not in submitted:
+                        submitted.add(job[0])
+                        pool.submit(job)
+                    while job[0] not in listings:
+                        ret = pool.get(0.25)
+                        if ret is None:
+                            yield True
+                            continue
+                        listings[ret[0][0]] = ret[1]
+                    submitted.discard(job[0])
+                    listing = listings.pop(job[0])
+                    children = self._accept(job[0], listing, visited)
+                    if children is not None:
+                        pending.extend(reversed(children))
+                    # the next directories in the serial order
+                    for ahead in pending[-limit:]:
+                        if ahead[0] not in submitted:
+                            submitted.add(ahead[0])
+                            pool.submit(ahead)
+                    if children is not None:
+                        yield (job[0], listing[1], listing[3])
+            else:
+                pool.submit((top, match))
+                outstanding = 1
+                while outstanding:
+                    ret = pool.get(0.25)
+                    if ret is None:
+                        yield True
+                        continue
+                    outstanding -= 1
+                    (job, listing) = ret
+                    children = self._accept(job[0], listing, visited)
+                    if children is None:
+                        continue
+                    for child in children:
+                        pool.submit(child)
+                    outstanding += len(children)
+                    yield (job[0], listing[1], listing[3])
+        finally:
+            pool.close()
+
+    def _visit(self, job, nested, table, visited, prune=None, top=None):
+        """List one directory
+
+        Return (key, dir_match, dirnames, filenames), or None if the
+        directory cannot be read or is pruned.  This runs on the
+        listing threads."""
+        (dirpath, dir_match) = job
+        try:
+            st = os.stat(dirpath)
+        except OSError:
+            return None
+        key = dir_key(dirpath, st)
+        if prune and prune(dirpath, st, key, dirpath == top):
+            return None
+        dir_match = nested.get(key, dir_match)
+        if key in visited:
+            # _accept() skips it, so do not list it
+            return (key, dir_match, [], [])
+        try:
+            (dirnames, filenames) = self._listdir(dirpath, st, dir_match, table)
+        except OSError:
+            # like os.walk(), ignore errors such as permission denied
+            return (key, dir_match, [], [])
+        return (key, dir_match, dirnames, filenames)
+
+    def _accept(self, dirpath, listing, visited):
+        """Mark a listed directory as visited
+
+        Return the jobs for its subdirectories, or None if the
+        directory is to be skipped."""
+        if listing is None:
+            return None
+        (key, dir_match, dirnames, _filenames) = listing
+        if key in visited:
+            logging.getLogger(__name__).debug('deep scan already visited %s', dirpath)
+            return None
+        visited.add(key)
+        return [(os.path.join(dirpath, dirname), dir_match) for dirname in dirnames]
+
+    def _listdir(self, dirpath, st, dir_match, table):
+        """Return (dirnames, filenames) for one directory
+
+        If table is given, serve the directory from the index when its
+        mtime is unchanged.  Then filenames holds only the names that
+        matched before."""
+        if table is not None:
+            record = table.get(dirpath)
+            if record is not None and record[0] == st.st_mtime:
+                record[1] = self.index.run
+                return (record[2], record[3])
+        (dirnames, filenames) = normalized_listdir(dirpath)
+        if table is not None:
+            import time
+            # Skip a directory changed just now because another change
+            # within the timestamp resolution would go unnoticed.
+            if time.time() - st.st_mtime > 2:
+                matches = [fn for fn in filenames if dir_match(fn) is not None]
+                table[dirpath] = [st.st_mtime, self.index.run, dirnames, matches]
+            else:
+                table.pop(dirpath, None)
+        return (dirnames, filenames)
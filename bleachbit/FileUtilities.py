@@ -25,7 +25,7 @@ File-related utilities
 from __future__ import absolute_import, print_function
 
 import bleachbit
-from bleachbit import expanduser
+from bleachbit import ChangeJournal, expanduser
 
 import atexit
 import codecs
@@ -41,6 +41,7 @@ import string
 import sys
 import subprocess
 import tempfile
+import threading
 import time
 
 logger = logging.getLogger(__name__)
@@ -53,11 +54,16 @@ if 'posix' == os.name:
     from bleachbit.General import WindowsError
     pywinerror = WindowsError
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # fall back to os.listdir() and os.lstat()
+        scandir = None
 
 
-def open_files_linux():
-    return glob.iglob("/proc/*/fd/*")
-
 
 def open_files_lsof(run_lsof=None):
     if run_lsof is None:
@@ -68,31 +74,26 @@ def open_files_lsof(run_lsof=None):
             yield f[1:]  # Drop lsof's "n"
 
 
-def open_files():
-    if sys.platform.startswith('linux'):
-        files = open_files_linux()
-    elif 'darwin' == sys.platform or sys.platform.startswith('freebsd'):
-        files = open_files_lsof()
-    else:
-        raise RuntimeError('unsupported platform for open_files()')
-    for filename in files:
-        try:
-            target = os.path.realpath(filename)
-        except TypeError:
-            # happens, for example, when link points to
-            # '/etc/password\x00 (deleted)'
-            continue
-        else:
-            yield target
+class OpenFiles:
 
+    """Cached way to determine whether a file is open by active process
 
-class OpenFiles:
+    Open files are kept as a set of (st_dev, st_ino), so a lookup does
+    not depend on how the path is spelled.  The paths are kept in
+    files for display.  On Linux the set is built per process.  A
+    descriptor number is soon reused for another file, so each scan
+    still calls stat() on every descriptor, but readlink() only on the
+    descriptors that are new or now point to another file.
 
-    """Cached way to determine whether a file is open by active process"""
+    The cache is not refreshed by time: the Worker calls refresh()
+    between phases of its run."""
 
     def __init__(self):
         self.last_scan_time = None
-        self.files = []
+        self.files = set()
+        self.inodes = set()
+        # process ID to {descriptor: ((st_dev, st_ino), path or None)}
+        self.pids = {}
 
     def file_qualifies(self, filename):
         """Return boolean whether filename qualifies to enter cache (check \
@@ -100,19 +101,172 @@ class OpenFiles:
         return not filename.startswith("/dev") and \
             not filename.startswith("/proc")
 
+    def _read(self, link, known):
+        """Return ((st_dev, st_ino), path or None) for the file behind
+        link (an open descriptor or a path), or None if it is gone
+
+        known is the result for the same link in the last scan, or
+        None."""
+        try:
+            st = os.stat(link)
+        except OSError:
+            # 13 = permission denied, or the descriptor was closed
+            return None
+        inode = (st.st_dev, st.st_ino)
+        if known is not None and known[0] == inode:
+            return known
+        if link.startswith('/proc/'):
+            try:
+                target = os.readlink(link)
+            except OSError:
+                return None
+        else:
+            target = link
+        return (inode, target if self.file_qualifies(target) else None)
+
     def scan(self):
         """Update cache"""
         self.last_scan_time = time.time()
-        self.files = []
-        for filename in open_files():
-            if self.file_qualifies(filename):
-                self.files.append(filename)
+        pids = {}
+        if sys.platform.startswith('linux'):
+            for pid in os.listdir('/proc'):
+                if not pid.isdigit():
+                    continue
+                fd_dir = os.path.join('/proc', pid, 'fd')
+                try:
+                    fds = os.listdir(fd_dir)
+                except OSError:
+                    continue
+                # Processes that exited are dropped with the old dict.
+                known = self.pids.get(int(pid), {})
+                files = pids[int(pid)] = {}
+                for fd in fds:
+                    found = self._read(os.path.join(fd_dir, fd), known.get(fd))
+                    if found is not None:
+                        files[fd] = found
+        elif 'darwin' == sys.platform or sys.platform.startswith('freebsd'):
+            files = pids[None] = {}
+            for filename in open_files_lsof():
+                try:
+                    filename = os.path.realpath(filename)
+                except TypeError:
+                    # happens, for example, when link points to
+                    # '/etc/password\x00 (deleted)'
+                    continue
+                found = self._read(filename, None)
+                if found is not None:
+                    files[filename] = found
+        else:
+            raise RuntimeError('unsupported platform for OpenFiles')
+        self.pids = pids
+        self.files = set()
+        self.inodes = set()
+        for files in pids.itervalues():
+            for (inode, target) in files.itervalues():
+                if target is not None:
+                    self.files.add(target)
+                    self.inodes.add(inode)
+
+    def refresh(self):
+        """Forget the open files, so the next query scans again"""
+        self.last_scan_time = None
 
     def is_open(self, filename):
         """Return boolean whether filename is open by running process"""
-        if self.last_scan_time is None or (time.time() - self.last_scan_time) > 10:
+        if self.last_scan_time is None:
             self.scan()
-        return os.path.realpath(filename) in self.files
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        return (st.st_dev, st.st_ino) in self.inodes
+
+
+class PathEntry(object):
+
+    """A path found by a directory walk
+
+    The file type and the lstat() result are looked up at most once and
+    then cached, so the filters, the size and the delete can share them.
+    When scandir is available, the type usually comes for free from the
+    directory listing.  While unlinker is active, the entries of a
+    walk get the ParentDir of their directory, for deleting them."""
+
+    __slots__ = ('path', '_entry', '_lstat', 'parent')
+
+    def __init__(self, path, entry=None, lstat=None, parent=None):
+        self.path = path
+        self._entry = entry  # optional DirEntry from scandir
+        self._lstat = lstat
+        self.parent = parent  # optional ParentDir
+
+    def __repr__(self):
+        return 'PathEntry(%r)' % self.path
+
+    def lstat(self):
+        """Return the cached result of os.lstat()"""
+        if self._lstat is None:
+            if self._entry is None:
+                self._lstat = os.lstat(self.path)
+            else:
+                self._lstat = self._entry.stat(follow_symlinks=False)
+        return self._lstat
+
+    def identity(self):
+        """Return (st_dev, st_ino, st_mtime) to tell whether the file
+        was replaced or changed
+
+        Deleting the children of a directory changes its modification
+        time, so for a directory it is None."""
+        st = self.lstat()
+        if stat.S_ISDIR(st.st_mode):
+            return (st.st_dev, st.st_ino, None)
+        return (st.st_dev, st.st_ino, st.st_mtime)
+
+    def hard_link(self, single=False):
+        """Return (st_dev, st_ino, st_nlink) if this is a file with
+        more than one hard link (or with single, any file), or else None"""
+        try:
+            st = self.lstat()
+        except OSError:
+            return None
+        if (single or st.st_nlink > 1) and not stat.S_ISDIR(st.st_mode):
+            return (st.st_dev, st.st_ino, st.st_nlink)
+        return None
+
+    def is_symlink(self):
+        """Return boolean whether the path is a symbolic link"""
+        if self._entry is not None and self._lstat is None:
+            return self._entry.is_symlink()
+        try:
+            return stat.S_ISLNK(self.lstat().st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self):
+        """Return boolean whether the path is a directory, like os.path.isdir()"""
+        return self._is_type(stat.S_ISDIR, os.path.isdir)
+
+    def is_file(self):
+        """Return boolean whether the path is a regular file, like os.path.isfile()"""
+        return self._is_type(stat.S_ISREG, os.path.isfile)
+
+    def _is_type(self, s_is, os_path_is):
+        if self._entry is not None and self._lstat is None:
+            try:
+                if stat.S_ISDIR == s_is:
+                    return self._entry.is_dir()
+                return self._entry.is_file()
+            except OSError:
+                return False
+        try:
+            mode = self.lstat().st_mode
+        except OSError:
+            return False
+        if stat.S_ISLNK(mode):
+            # follow the link
+            return os_path_is(self.path)
+        return s_is(mode)
 
 
 def __random_string(length):
@@ -158,19 +312,29 @@ def bytes_to_human(bytes_i):
     return 'A lot.'
 
 
-def children_in_directory(top, list_directories=False):
-    """Iterate files and, optionally, subdirectories in directory"""
+def children_in_directory(top, list_directories=False, prune=None):
+    """Iterate files and, optionally, subdirectories in directory
+
+    If prune is given, it is called with the path of each subdirectory,
+    and a subdirectory for which it returns True is neither listed nor
+    descended into."""
+    for entry in children_entries(top, list_directories, prune):
+        yield entry.path
+
+
+def children_entries(top, list_directories=False, prune=None):
+    """Like children_in_directory() but yield PathEntry instances"""
     if type(top) is tuple:
         for top_ in top:
-            for pathname in children_in_directory(top_, list_directories):
-                yield pathname
+            for entry in children_entries(top_, list_directories, prune):
+                yield entry
         return
-    for (dirpath, dirnames, filenames) in os.walk(top, topdown=False):
+    for (dirpath, dirs, files) in walk_entries(top, prune):
         if list_directories:
-            for dirname in dirnames:
-                yield os.path.join(dirpath, dirname)
-        for filename in filenames:
-            yield os.path.join(dirpath, filename)
+            for entry in dirs:
+                yield entry
+        for entry in files:
+            yield entry
 
 
 def clean_ini(path, section, parameter):
@@ -238,32 +402,215 @@ def clean_json(path, target):
         json.dump(js, open(path, 'w'))
 
 
-def delete(path, shred=False, ignore_missing=False, allow_shred=True):
+class ParentDir(object):
+
+    """A directory whose children are deleted through UnlinkAt
+
+    The files listed from one directory share one ParentDir, with the
+    device and inode the listing found.  The directory is opened when
+    the first of them is deleted, and the descriptor is checked once
+    with fstat(), so a directory renamed or replaced since the listing,
+    for example by a symbolic link, is not used.  The descriptor stays
+    open until UnlinkAt.release()."""
+
+    __slots__ = ('path', 'identity', 'fd', 'lock')
+
+    def __init__(self, path, identity):
+        self.path = path
+        self.identity = identity  # (st_dev, st_ino)
+        self.fd = None  # None until opened, -1 if it cannot be used
+        # held while the descriptor is in use, so it is not closed
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ParentDir(%r)' % self.path
+
+
+class UnlinkAt:
+
+    """Remove files relative to an open parent directory
+
+    os.remove() and os.rmdir() make the kernel resolve every component
+    of the path again.  Here the caller holds a ParentDir for the
+    directory it listed, and unlinkat() gets only the name, so the
+    files in one directory share one lookup.  At most max_open
+    directories stay open: beyond that, the one opened first is
+    closed and opened again if it is used again.  A directory that
+    cannot be opened, for lack of read permission, or that is no
+    longer the one listed, falls back to os.remove() and os.rmdir(),
+    and so does a path without a ParentDir.
+
+    Python 2 has no dir_fd arguments, so unlinkat() is called through
+    ctypes, which limits this to Linux."""
+
+    AT_REMOVEDIR = 0x200  # from <fcntl.h> on Linux
+
+    def __init__(self, libc=None, max_open=64):
+        import collections
+        import ctypes
+        import ctypes.util
+        if libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+        self.unlinkat = libc.unlinkat  # AttributeError if missing
+        self.get_errno = ctypes.get_errno
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        # the open ParentDir, the first opened first
+        self.open_dirs = collections.OrderedDict()
+
+    def _dir_fd(self, parent):
+        """Return the descriptor of parent, or None if it cannot be
+        used (parent.lock must be held)"""
+        if parent.fd is None:
+            parent.fd = -1
+            try:
+                fd = os.open(parent.path, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError:
+                return None
+            st = os.fstat(fd)
+            if (st.st_dev, st.st_ino) != parent.identity:
+                os.close(fd)
+                return None
+            parent.fd = fd
+            with self.lock:
+                self.open_dirs[parent] = None
+                excess = [other for other in self.open_dirs.keys()
+                          if other is not parent]
+                excess = excess[:len(self.open_dirs) - self.max_open]
+            for other in excess:
+                # one in use by another thread stays open for now
+                if other.lock.acquire(False):
+                    try:
+                        self._close(other)
+                    finally:
+                        other.lock.release()
+        if parent.fd < 0:
+            return None
+        return parent.fd
+
+    def _close(self, parent):
+        """Close the descriptor of parent (parent.lock must be held)"""
+        with self.lock:
+            self.open_dirs.pop(parent, None)
+        if parent.fd is not None and parent.fd >= 0:
+            os.close(parent.fd)
+        parent.fd = None
+
+    def _unlink(self, path, parent, flags, fallback):
+        if parent is None:
+            fallback(path)
+            return
+        basename = os.path.basename(path)
+        name = basename.encode(bleachbit.FSE) \
+            if isinstance(basename, unicode) else basename
+        with parent.lock:
+            dir_fd = self._dir_fd(parent)
+            if dir_fd is None:
+                fallback(path)
+            elif 0 != self.unlinkat(dir_fd, name, flags):
+                e = self.get_errno()
+                raise OSError(e, os.strerror(e), path)
+
+    def remove(self, path, parent=None):
+        """Remove a file in the ParentDir parent, like os.remove()"""
+        self._unlink(path, parent, 0, os.remove)
+
+    def rmdir(self, path, parent=None):
+        """Remove an empty directory in the ParentDir parent, like
+        os.rmdir()"""
+        self._unlink(path, parent, self.AT_REMOVEDIR, os.rmdir)
+
+    def release(self, parent):
+        """Close the descriptor of parent until it is used again"""
+        with parent.lock:
+            self._close(parent)
+
+    def close(self):
+        """Close all the directories"""
+        with self.lock:
+            parents = list(self.open_dirs.keys())
+        for parent in parents:
+            self.release(parent)
+
+
+unlinker = None
+
+
+def start_unlinker():
+    """Delete relative to open directories until stop_unlinker()
+
+    Return the active UnlinkAt, or None if the platform lacks it."""
+    global unlinker
+    if unlinker is None and sys.platform.startswith('linux'):
+        try:
+            unlinker = UnlinkAt()
+        except (AttributeError, OSError):
+            logger.debug('cannot use unlinkat()', exc_info=True)
+    return unlinker
+
+
+def stop_unlinker():
+    """Close the directories kept open for deleting"""
+    global unlinker
+    if unlinker is not None:
+        unlinker.close()
+        unlinker = None
+
+
+def delete(path, shred=False, ignore_missing=False, allow_shred=True, entry=None):
     """Delete path that is either file, directory, link or FIFO.
 
        If shred is enabled as a function parameter or the BleachBit global
        parameter, the path will be shredded unless allow_shred = False.
+
+       If entry is a PathEntry for path, its cached lstat() is used.
     """
     from bleachbit.Options import options
+    remove = os.remove
+    rmdir = os.rmdir
+    parent = None if entry is None else entry.parent
+    if unlinker is not None and parent is not None and \
+            not (allow_shred and (shred or options.get('shred'))):
+        # Shredding renames the path first, so it deletes by path.
+        def remove(path):
+            unlinker.remove(path, parent)
+
+        def rmdir(path):
+            unlinker.rmdir(path, parent)
     is_special = False
     path = extended_path(path)
-    if not os.path.lexists(path):
-        if ignore_missing:
-            return
-        raise OSError(2, 'No such file or directory', path)
     if 'posix' == os.name:
+        # One lstat() gives both existence and the file type.
         # With certain (relatively rare) files on Windows os.lstat()
         # may return Access Denied
-        mode = os.lstat(path)[stat.ST_MODE]
+        try:
+            if entry is None:
+                mode = os.lstat(path).st_mode
+            else:
+                mode = entry.lstat().st_mode
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR) and ignore_missing:
+                return
+            raise
         is_special = stat.S_ISFIFO(mode) or stat.S_ISLNK(mode)
+        is_dir = stat.S_ISDIR(mode)
+        is_file = stat.S_ISREG(mode)
+    else:
+        if not os.path.lexists(path):
+            if ignore_missing:
+                return
+            raise OSError(2, 'No such file or directory', path)
+        is_dir = os.path.isdir(path)
+        is_file = not is_dir and os.path.isfile(path)
     if is_special:
-        os.remove(path)
-    elif os.path.isdir(path):
+        remove(path)
+    elif is_dir:
         delpath = path
         if allow_shred and (shred or options.get('shred')):
             delpath = wipe_name(path)
         try:
-            os.rmdir(delpath)
+            rmdir(delpath)
         except OSError as e:
             # [Errno 39] Directory not empty
             # https://bugs.launchpad.net/bleachbit/+bug/1012930
@@ -280,7 +627,7 @@ def delete(path, shred=False, ignore_missing=False, allow_shred=True):
                 logger.info("directory is not empty: %s", path)
             else:
                 raise
-    elif os.path.isfile(path):
+    elif is_file:
         # wipe contents
         if allow_shred and (shred or options.get('shred')):
             try:
@@ -296,10 +643,10 @@ def delete(path, shred=False, ignore_missing=False, allow_shred=True):
                 # permission denied (13) happens shredding MSIE 8 on Windows 7
                 logger.debug("IOError #%s shredding '%s'", e.errno, path, exc_info=True)
             # wipe name
-            os.remove(wipe_name(path))
+            remove(wipe_name(path))
         else:
             # unlink
-            os.remove(path)
+            remove(path)
     else:
         logger.info("special file type cannot be deleted: %s", path)
 
@@ -362,12 +709,110 @@ def execute_sqlite3(path, cmds):
 def expand_glob_join(pathname1, pathname2):
     """Join pathname1 and pathname1, expand pathname, glob, and return as list"""
     ret = []
-    pathname3 = expanduser(bleachbit.expandvars(os.path.join(pathname1, pathname2)))
-    for pathname4 in glob.iglob(pathname3):
+    pathname3 = expand_path(os.path.join(pathname1, pathname2))
+    for pathname4 in iglob(pathname3):
         ret.append(pathname4)
     return ret
 
 
+def expand_path(path):
+    """Return expanduser(expandvars(path)), memoized during a run"""
+    if glob_cache is None:
+        return expanduser(bleachbit.expandvars(path))
+    return glob_cache.expand(path)
+
+
+class GlobCache:
+
+    """Results of glob and path expansion for one Worker run
+
+    Glob results are keyed by pattern.  Deleting a path drops the
+    results of the patterns it could change: those whose fixed
+    directory (the part before the first wildcard) contains the path,
+    and those at or below the path."""
+
+    def __init__(self):
+        self.globs = {}
+        self.expanded = {}
+        # fixed directory to the patterns with wildcards below it
+        self.by_prefix = {}
+        # directory to the patterns whose fixed part is at or below it
+        self.under = {}
+
+    @staticmethod
+    def _key(path):
+        """Normalize a path for lookups"""
+        path = os.path.normpath(path)
+        if isinstance(path, str):
+            path = path.decode(bleachbit.FSE, 'replace')
+        return path
+
+    def expand(self, path):
+        """Memoized expanduser(expandvars(path))"""
+        if path not in self.expanded:
+            self.expanded[path] = expanduser(bleachbit.expandvars(path))
+        return self.expanded[path]
+
+    def glob(self, pathname):
+        """Memoized glob.glob(pathname)"""
+        if pathname in self.globs:
+            return self.globs[pathname]
+        ret = list(glob.iglob(pathname))
+        self.globs[pathname] = ret
+        parts = self._key(pathname).split(os.sep)
+        fixed = []
+        for part in parts:
+            if glob.has_magic(part):
+                break
+            fixed.append(part)
+        prefix = os.sep.join(fixed) or os.sep
+        if len(fixed) < len(parts):
+            self.by_prefix.setdefault(prefix, set()).add(pathname)
+        while True:
+            self.under.setdefault(prefix, set()).add(pathname)
+            parent = os.path.dirname(prefix)
+            if parent == prefix:
+                break
+            prefix = parent
+        return ret
+
+    def deleted(self, path):
+        """Forget the results a deletion of path could change"""
+        path = self._key(path)
+        drop = set(self.under.pop(path, ()))
+        parent = path
+        while True:
+            (parent, child) = (os.path.dirname(parent), parent)
+            if parent == child:
+                break
+            drop.update(self.by_prefix.get(parent, ()))
+        for pathname in drop:
+            self.globs.pop(pathname, None)
+
+
+# the cache for the current run, or None
+glob_cache = None
+
+
+def start_glob_cache():
+    """Memoize glob and path expansion until stop_glob_cache()"""
+    global glob_cache
+    glob_cache = GlobCache()
+
+
+def stop_glob_cache():
+    """Stop memoizing glob and path expansion"""
+    global glob_cache
+    glob_cache = None
+
+
+def iglob(pathname):
+    """Like glob.iglob(), but memoized during a run"""
+    if glob_cache is None:
+        return glob.iglob(pathname)
+    return iter(glob_cache.glob(pathname))
+
+
 def expandvars(path):
     return bleachbit.expandvars(path)
 
@@ -410,12 +855,17 @@ def free_space(pathname):
     return mystat.f_bfree * mystat.f_bsize
 
 
-def getsize(path):
+def getsize(path, entry=None):
     """Return the actual file size considering spare files
-       and symlinks"""
+       and symlinks
+
+    If entry is a PathEntry for path, its cached lstat() is used."""
     if 'posix' == os.name:
         try:
-            __stat = os.lstat(path)
+            if entry is None:
+                __stat = os.lstat(path)
+            else:
+                __stat = entry.lstat()
         except OSError as e:
             # OSError: [Errno 13] Permission denied
             # can happen when a regular user is trying to find the size of /var/log/hp/tmp
@@ -440,6 +890,80 @@ def getsize(path):
     return os.path.getsize(path)
 
 
+stat_pool = None
+
+
+def start_stat_pool(workers):
+    """Keep threads for prefetch_lstat() until stop_stat_pool()
+
+    Return the pool, or None with fewer than two workers or off
+    POSIX."""
+    global stat_pool
+    if stat_pool is None and workers > 1 and 'posix' == os.name:
+        from multiprocessing.pool import ThreadPool
+        stat_pool = ThreadPool(workers)
+    return stat_pool
+
+
+def stop_stat_pool():
+    """Stop the threads of prefetch_lstat()"""
+    global stat_pool
+    if stat_pool is not None:
+        stat_pool.terminate()
+        stat_pool = None
+
+
+def prefetch_lstat(commands, pool, batch_size=256):
+    """Yield commands after looking up their files in parallel
+
+    Commands with an entry attribute (such as Command.Delete) get a
+    PathEntry whose lstat() is filled by pool, a
+    multiprocessing.pool.ThreadPool such as stat_pool, a batch at a
+    time, so getsize() does not wait on each file in turn.  So do the
+    entries of a Command.DeleteBatch.  This helps on network file
+    systems, where each lstat() is a round trip.  The commands are
+    yielded in their original order.  If pool is None, nothing is
+    looked up."""
+    if pool is None:
+        for cmd in commands:
+            yield cmd
+        return
+
+    def lstat(entry):
+        try:
+            entry.lstat()
+        except OSError:
+            # getsize() looks again and handles the error
+            pass
+
+    def prefetch(batch):
+        entries = []
+        for cmd in batch:
+            if hasattr(cmd, 'entries'):
+                for (i, entry) in enumerate(cmd.entries):
+                    if entry is None:
+                        entry = cmd.entries[i] = PathEntry(cmd.paths[i])
+                    entries.append(entry)
+                continue
+            if not hasattr(cmd, 'entry') or not cmd.path:
+                continue
+            if cmd.entry is None:
+                cmd.entry = PathEntry(cmd.path)
+            entries.append(cmd.entry)
+        pool.map(lstat, entries)
+        return batch
+
+    batch = []
+    for cmd in commands:
+        batch.append(cmd)
+        if len(batch) >= batch_size:
+            for ready in prefetch(batch):
+                yield ready
+            batch = []
+    for ready in prefetch(batch):
+        yield ready
+
+
 def getsizedir(path):
     """Return the size of the contents of a directory"""
     total_bytes = 0
@@ -513,6 +1037,30 @@ def human_to_bytes(human, hformat='si'):
     return int(float(amount) * base**exponent)
 
 
+def list_entries(dirname, parent=None):
+    """Return a list of PathEntry for the children of dirname
+
+    The entries get the optional ParentDir parent.  Raise OSError if
+    the directory cannot be listed."""
+    journal = ChangeJournal.journal
+    if journal is not None:
+        names = journal.get(dirname, 'names')
+        if names is not None:
+            return [PathEntry(os.path.join(dirname, name), parent=parent)
+                    for name in names]
+        token = journal.watch(dirname)
+    if scandir is None:
+        entries = [PathEntry(os.path.join(dirname, name), parent=parent)
+                   for name in os.listdir(dirname)]
+    else:
+        entries = [PathEntry(direntry.path, direntry, parent=parent)
+                   for direntry in scandir(dirname)]
+    if journal is not None:
+        journal.put(dirname, 'names',
+                    [os.path.basename(entry.path) for entry in entries], token)
+    return entries
+
+
 def listdir(directory):
     """Return full path of files in directory.
 
@@ -591,42 +1139,206 @@ def uris_to_paths(file_uris):
     return file_paths
 
 
+def walk_entries(top, prune=None):
+    """Walk the directory tree like os.walk(top, topdown=False)
+
+    Yield (dirpath, dirs, files) where dirs and files are lists of
+    PathEntry.  Each subdirectory is passed to prune before it is
+    descended into, and those for which prune returns True are dropped,
+    so whitelisted trees are never enumerated.  Children are yielded
+    before their parents, and symbolic links are not followed.
+
+    While unlinker is active, the entries of each directory share a
+    ParentDir, which is released once they are yielded."""
+    identity = None
+    if unlinker is not None:
+        try:
+            st = os.stat(top)
+        except OSError:
+            pass
+        else:
+            identity = (st.st_dev, st.st_ino)
+    return _walk_entries(top, prune, identity)
+
+
+def _walk_entries(top, prune, identity):
+    """Do walk_entries() for top, of device and inode identity or None"""
+    parent = None if identity is None else ParentDir(top, identity)
+    try:
+        entries = list_entries(top, parent)
+    except OSError:
+        # like os.walk(), ignore errors such as permission denied
+        return
+    dirs = []
+    files = []
+    for entry in entries:
+        if entry.is_dir():
+            dirs.append(entry)
+        else:
+            files.append(entry)
+    if prune is not None:
+        dirs = [entry for entry in dirs if not prune(entry.path)]
+    for entry in dirs:
+        if not entry.is_symlink():
+            child = None
+            if parent is not None:
+                try:
+                    st = entry.lstat()
+                except OSError:
+                    pass
+                else:
+                    child = (st.st_dev, st.st_ino)
+            for result in _walk_entries(entry.path, prune, child):
+                yield result
+    yield (top, dirs, files)
+    if parent is not None and unlinker is not None:
+        unlinker.release(parent)
+
+
+# While a Worker run deletes, the entries of each directory are
+# deleted in inode order, this many at a time (0 for listing order).
+inode_order_buffer = 0
+
+
+def set_inode_order(buffer_size):
+    """Make inode_order() sort up to buffer_size entries at a time,
+    or keep the listing order if buffer_size is 0"""
+    global inode_order_buffer
+    inode_order_buffer = buffer_size
+
+
+def _inode(entry):
+    """Return the inode number of a PathEntry, or 0 if unknown"""
+    try:
+        return entry.lstat().st_ino
+    except OSError:
+        return 0
+
+
+def inode_order(entries, buffer_size=None):
+    """Yield PathEntry objects in inode order within each directory
+
+    On file systems such as ext4 and XFS, deleting in the order of the
+    directory listing touches the inode table and the journal at
+    random, while inode order touches them in sequence.  Entries that
+    come one after another from the same directory are sorted by
+    st_ino, up to buffer_size at a time, so the memory is bounded and
+    a directory is still yielded after everything in it.  The lstat()
+    of each entry is cached for the delete.
+
+    buffer_size defaults to the one from set_inode_order(), and with 0
+    the entries are yielded as they come."""
+    if buffer_size is None:
+        buffer_size = inode_order_buffer
+    if not buffer_size:
+        for entry in entries:
+            yield entry
+        return
+    dirname = os.path.dirname
+    buf = []
+    parent = None
+    for entry in entries:
+        entry_parent = dirname(entry.path)
+        if buf and (entry_parent != parent or len(buf) >= buffer_size):
+            buf.sort(key=_inode)
+            for sorted_entry in buf:
+                yield sorted_entry
+            buf = []
+        parent = entry_parent
+        buf.append(entry)
+    buf.sort(key=_inode)
+    for sorted_entry in buf:
+        yield sorted_entry
+
+
+class WhitelistIndex:
+
+    """Compiled form of the whitelist
+
+    Files and folders are kept in hashed sets, so a lookup costs
+    roughly the depth of the path instead of the size of the whitelist.
+    On Windows the paths are case folded once when the index is built."""
+
+    def __init__(self, whitelist, case_sensitive=True):
+        self.case_sensitive = case_sensitive
+        self.files = set()
+        self.folders = set()
+        # folders such as C:\ which match everything below
+        self.drives = set()
+        for (p_type, p_path) in whitelist:
+            if not case_sensitive:
+                p_path = p_path.lower()
+            if 'file' == p_type:
+                self.files.add(p_path)
+            elif 'folder' == p_type:
+                self.folders.add(p_path)
+                if not case_sensitive and 3 == len(p_path):
+                    self.drives.add(p_path)
+
+    def __len__(self):
+        return len(self.files) + len(self.folders)
+
+    def match(self, path):
+        """Return boolean whether path is whitelisted"""
+        if not self.case_sensitive:
+            path = path.lower()
+        if path in self.files or path in self.folders:
+            return True
+        if self.drives and path[0:3] in self.drives:
+            return True
+        if not self.folders:
+            return False
+        # Check each ancestor, which is the same as testing whether
+        # the path starts with a whitelisted folder plus a separator.
+        pos = path.find(os.sep)
+        while -1 != pos:
+            if path[0:pos] in self.folders:
+                return True
+            pos = path.find(os.sep, pos + 1)
+        return False
+
+    def overlaps(self, path):
+        """Return boolean whether path or anything under it is whitelisted"""
+        if self.match(path):
+            return True
+        if not self.case_sensitive:
+            path = path.lower()
+        prefix = os.path.join(path, '')
+        for p_path in self.files | self.folders:
+            if p_path.startswith(prefix):
+                return True
+        return False
+
+
+def get_whitelist_index():
+    """Return the compiled whitelist
+
+    The index is built once and cached until the whitelist changes."""
+    from bleachbit.Options import options
+    if options.whitelist_index is None:
+        options.whitelist_index = WhitelistIndex(options.get_whitelist_paths(),
+                                                 case_sensitive='nt' != os.name)
+    return options.whitelist_index
+
+
 def whitelisted_posix(path, check_realpath=True):
     """Check whether this POSIX path is whitelisted"""
-    from bleachbit.Options import options
+    index = get_whitelist_index()
+    if not index:
+        return False
     if check_realpath and os.path.islink(path):
         # also check the link name
-        if whitelisted_posix(path, False):
+        if index.match(path):
             return True
         # resolve symlink
         path = os.path.realpath(path)
-    for pathname in options.get_whitelist_paths():
-        if pathname[0] == 'file' and path == pathname[1]:
-            return True
-        if pathname[0] == 'folder':
-            if path == pathname[1]:
-                return True
-            if path.startswith(pathname[1] + os.sep):
-                return True
-    return False
+    return index.match(path)
 
 
 def whitelisted_windows(path):
     """Check whether this Windows path is whitelisted"""
-    from bleachbit.Options import options
-    for pathname in options.get_whitelist_paths():
-        # Windows is case insensitive
-        if pathname[0] == 'file' and path.lower() == pathname[1].lower():
-            return True
-        if pathname[0] == 'folder':
-            if path.lower() == pathname[1].lower():
-                return True
-            if path.lower().startswith(pathname[1].lower() + os.sep):
-                return True
-            # Simple drive letter like C:\ matches everything below
-            if len(pathname[1]) == 3 and path.lower().startswith(pathname[1].lower()):
-                return True
-    return False
+    # Windows is case insensitive, so the index is case folded.
+    return get_whitelist_index().match(path)
 
 if 'nt' == os.name:
     whitelisted = whitelisted_windows
@@ -726,16 +1438,19 @@ def wipe_name(pathname1):
     # finally, rename to a short name
     i = 0
     while True:
+        pathname3 = os.path.join(head, __random_string(i + 1))
         try:
-            pathname3 = os.path.join(head, __random_string(i + 1))
-            os.rename(pathname2, pathname3)
-            break
-        except:
-            i += 1
-            if i > 100:
-                logger.info('exhausted short rename: %s', pathname2)
-                pathname3 = pathname2
+            # os.rename() would replace another file
+            if not os.path.lexists(pathname3):
+                os.rename(pathname2, pathname3)
                 break
+        except:
+            pass
+        i += 1
+        if i > 100:
+            logger.info('exhausted short rename: %s', pathname2)
+            pathname3 = pathname2
+            break
     return pathname3
 
 
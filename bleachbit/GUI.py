@@ -377,7 +377,13 @@ class GUI:
             self.set_sensitive(False)
             self.textbuffer.set_text("")
             self.progressbar.show()
-            self.worker = Worker.Worker(self, really_delete, operations)
+            plan = None
+            if really_delete and self.preview_plan is not None and \
+                    self.preview_plan.matches(operations):
+                # clean what the preview found without searching again
+                plan = self.preview_plan
+            self.preview_plan = None
+            self.worker = Worker.Worker(self, really_delete, operations, plan)
         except Exception:
             logger.exception('Error in Worker()')
         else:
@@ -392,6 +398,8 @@ class GUI:
         self.progressbar.set_text(_("Done."))
         self.textview.scroll_mark_onscreen(self.textbuffer.get_insert())
         self.set_sensitive(True)
+        if not really_delete:
+            self.preview_plan = worker.preview_plan
 
         # Close the program after cleaning is completed.
         # if the option is selected under preference.
@@ -917,6 +925,8 @@ class GUI:
             from bleachbit import RecognizeCleanerML
             RecognizeCleanerML.RecognizeCleanerML()
             register_cleaners()
+        # what the last preview found (see Worker.PreviewPlan)
+        self.preview_plan = None
         self.create_window()
         gobject.threads_init()
 
@@ -197,6 +197,20 @@ class PreferencesDialog:
             'toggled', self.__toggle_callback, 'delete_confirmation')
         vbox.pack_start(cb_popup, False)
 
+        cb_reuse = gtk.CheckButton(_("Clean what the preview found"))
+        cb_reuse.set_active(options.get('reuse_preview'))
+        cb_reuse.connect('toggled', self.__toggle_callback, 'reuse_preview')
+        cb_reuse.set_tooltip_text(
+            _("Files that changed after the preview are not deleted"))
+        vbox.pack_start(cb_reuse, False)
+
+        cb_journal = gtk.CheckButton(_("Remember folder listings until they change"))
+        cb_journal.set_active(options.get('change_journal'))
+        cb_journal.connect('toggled', self.__toggle_callback, 'change_journal')
+        cb_journal.set_tooltip_text(
+            _("Previews repeated in a short time list fewer folders"))
+        vbox.pack_start(cb_journal, False)
+
         
         cb_units_iec = gtk.CheckButton(
             _("Use IEC sizes (1 KiB = 1024 bytes) instead of SI (1 kB = 1000 bytes)"))
@@ -40,7 +40,8 @@ if 'nt' == os.name:
 
 
 boolean_keys = ['auto_hide', 'auto_start', 'check_beta',
-                'check_online_updates', 'first_start', 'shred', 'exit_done', 'delete_confirmation', 'units_iec']
+                'check_online_updates', 'first_start', 'shred', 'exit_done', 'delete_confirmation', 'units_iec',
+                'deepscan_ordered', 'change_journal', 'reuse_preview']
 if 'nt' == os.name:
     boolean_keys.append('update_winapp2')
 
@@ -62,6 +63,8 @@ class Options:
     // 초기화 함수
     def __init__(self):
         self.purged = False
+        # compiled by FileUtilities.get_whitelist_index()
+        self.whitelist_index = None
         self.config = bleachbit.RawConfigParser()
         self.config.optionxform = str  # make keys case sensitive for hashpath purging
         self.config._boolean_states['t'] = True
@@ -199,6 +202,7 @@ class Options:
 
     // Disk에 저장된 옵션 복원 함수    
     def restore(self):
+        self.whitelist_index = None
         try:
             self.config.read(bleachbit.options_file)
         except:
@@ -224,6 +228,13 @@ class Options:
         self.__set_default("exit_done", False)
         self.__set_default("delete_confirmation", True)
         self.__set_default("units_iec", False)
+        self.__set_default("deepscan_workers", 1)
+        self.__set_default("deepscan_ordered", True)
+        self.__set_default("change_journal", False)
+        self.__set_default("preview_workers", 1)
+        self.__set_default("reuse_preview", False)
+        self.__set_default("delete_order", "name")
+        self.__set_default("jobs", 1)
 
         if 'nt' == os.name:
             self.__set_default("update_winapp2", False)
@@ -270,6 +281,7 @@ class Options:
    // whitelist 저장 함수
     def set_whitelist_paths(self, values):
         section = "whitelist/paths"
+        self.whitelist_index = None
         if self.config.has_section(section):
             self.config.remove_section(section)
         self.config.add_section(section)
@@ -0,0 +1,219 @@
+# vim: ts=4:sw=4:expandtab
+# -*- coding: UTF-8 -*-
+
+# BleachBit
+# Copyright (C) 2008-2018 Andrew Ziem
+# https://www.bleachbit.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Delete files on several devices at once
+"""
+
+from __future__ import absolute_import, print_function
+
+from bleachbit import DeepScan
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# file system types whose latency hides behind concurrent requests
+NETWORK_FSTYPES = ('9p', 'afs', 'ceph', 'cifs', 'fuse.glusterfs',
+                   'fuse.sshfs', 'glusterfs', 'lustre', 'ncpfs', 'nfs',
+                   'nfs4', 'smb3', 'smbfs')
+
+# the most files deleted at once on a device of each class
+CONCURRENCY = {'network': 8, 'ssd': 4, 'unknown': 2, 'rotational': 1}
+
+# the active scheduler, or None
+scheduler = None
+
+
+def _rotational(st_dev, sysfs='/sys/dev/block'):
+    """Return whether a block device is rotational, or None if unknown
+
+    A partition has no queue of its own, so the queue of the disk
+    that holds it is read."""
+    devdir = os.path.join(sysfs, '%d:%d' % (os.major(st_dev), os.minor(st_dev)))
+    for queue in (os.path.join(devdir, 'queue', 'rotational'),
+                  os.path.join(devdir, '..', 'queue', 'rotational')):
+        try:
+            with open(queue) as f:
+                return '1' == f.read().strip()
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def device_class(st_dev, fstypes, sysfs='/sys/dev/block'):
+    """Return 'network', 'ssd', 'rotational' or 'unknown' for a device
+
+    fstypes is the result of DeepScan.mount_fstypes()."""
+    if fstypes.get(st_dev) in NETWORK_FSTYPES:
+        return 'network'
+    rotational = _rotational(st_dev, sysfs)
+    if rotational is None:
+        return 'unknown'
+    return 'rotational' if rotational else 'ssd'
+
+
+class DeviceScheduler:
+
+    """Run a function over items with threads for each device
+
+    The items are grouped by device, and each device gets at most the
+    concurrency of its class, so a disk is not made to seek between
+    many files while an SSD or a network mount serves several at
+    once.  All devices share a pool of jobs threads, which lives until
+    close().  The function must record its own results, so the caller
+    can read them in the original order."""
+
+    def __init__(self, jobs, fstypes=None, sysfs='/sys/dev/block'):
+        self.jobs = jobs
+        self.fstypes = DeepScan.mount_fstypes() if fstypes is None else fstypes
+        self.sysfs = sysfs
+        # st_dev to its limit
+        self.limits = {}
+        self.cond = threading.Condition()
+        self.threads = []
+        self.closed = False
+        # for the current run(): st_dev to [pending items, number
+        # running], the devices in order, the function, and the
+        # number of items not yet done
+        self.queues = {}
+        self.order = []
+        self.func = None
+        self.left = 0
+
+    def limit(self, st_dev):
+        """Return the most items to run at once on a device"""
+        if st_dev not in self.limits:
+            if st_dev is None:
+                d_class = 'unknown'
+            else:
+                d_class = device_class(st_dev, self.fstypes, self.sysfs)
+            self.limits[st_dev] = min(self.jobs, CONCURRENCY[d_class])
+            logger.debug('device %s is %s', st_dev, d_class)
+        return self.limits[st_dev]
+
+    def _take(self):
+        """Return (st_dev, item) that may run now, or None (the lock
+        must be held)"""
+        for st_dev in self.order:
+            queue = self.queues[st_dev]
+            if queue[0] and queue[1] < self.limits[st_dev]:
+                queue[1] += 1
+                return (st_dev, queue[0].pop())
+        return None
+
+    def _work(self):
+        """Run items until close()"""
+        while True:
+            with self.cond:
+                task = None
+                while not self.closed:
+                    task = self._take()
+                    if task is not None:
+                        break
+                    self.cond.wait()
+                if task is None:
+                    return
+                func = self.func
+            try:
+                func(task[1])
+            except Exception:
+                logger.exception('error in %s', func)
+            with self.cond:
+                self.queues[task[0]][1] -= 1
+                self.left -= 1
+                self.cond.notify_all()
+
+    def run(self, items, device, func, interval=0.25):
+        """Call func(item) for each item, with device(item) giving its
+        st_dev or None
+
+        Yield True at least every interval seconds until all are done,
+        so the caller can keep the user interface responsive.  Closing
+        the generator stops after the items that already started."""
+        queues = {}
+        order = []
+        for item in items:
+            st_dev = device(item)
+            if st_dev not in queues:
+                queues[st_dev] = [[], 0]
+                order.append(st_dev)
+                self.limit(st_dev)
+            queues[st_dev][0].append(item)
+        for st_dev in order:
+            queues[st_dev][0].reverse()  # pop() from the end
+        with self.cond:
+            self.queues = queues
+            self.order = order
+            self.func = func
+            self.left = sum([len(queue[0]) for queue in queues.values()])
+            while len(self.threads) < min(self.jobs, self.left):
+                thread = threading.Thread(target=self._work, name='DeviceScheduler')
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.cond.notify_all()
+        try:
+            while True:
+                with self.cond:
+                    if self.left:
+                        self.cond.wait(interval)
+                    if not self.left:
+                        break
+                yield True
+        finally:
+            with self.cond:
+                # drop what did not start, and wait for the rest
+                for queue in self.queues.values():
+                    self.left -= len(queue[0])
+                    del queue[0][:]
+                while self.left:
+                    self.cond.wait()
+
+    def close(self):
+        """Stop the threads"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+def start_scheduler(jobs):
+    """Delete batches of files with jobs threads until stop_scheduler()
+
+    Return the active DeviceScheduler, or None for one job or on
+    platforms without device numbers."""
+    global scheduler
+    if scheduler is None and jobs > 1 and 'posix' == os.name:
+        scheduler = DeviceScheduler(jobs)
+    return scheduler
+
+
+def stop_scheduler():
+    """Delete one file at a time again"""
+    global scheduler
+    if scheduler is not None:
+        scheduler.close()
+        scheduler = None
@@ -464,44 +464,56 @@ def is_broken_xdg_desktop(pathname):
 
 
 def is_running_darwin(exename, run_ps=None):
+    return exename in running_exenames_darwin(run_ps)
+
+
+def running_exenames_darwin(run_ps=None):
+    """Return the set of names of running executables using ps"""
     if run_ps is None:
         def run_ps():
             return subprocess.check_output(["ps", "aux", "-c"])
     try:
-        processess = (re.split(r"\s+", p, 10)[10] for p in run_ps().split("\n") if p != "")
-        next(processess)  # drop the header
-        return exename in processess
+        processess = [re.split(r"\s+", p, 10)[10] for p in run_ps().split("\n") if p != ""]
     except IndexError:
         raise RuntimeError("Unexpected output from ps")
+    # drop the header
+    return set(processess[1:])
 
 
 def is_running_linux(exename):
     """Check whether exename is running"""
+    return exename in running_exenames_linux()
+
+
+def running_exenames_linux():
+    """Return the set of basenames of running executables"""
+    names = set()
     for filename in glob.iglob("/proc/*/exe"):
         try:
-            target = os.path.realpath(filename)
-        except TypeError:
-            # happens, for example, when link points to
-            # '/etc/password\x00 (deleted)'
-            continue
+            # The kernel gives the resolved path.
+            target = os.readlink(filename)
         except OSError:
             # 13 = permission denied
             continue
-        if exename == os.path.basename(target):
-            return True
-    return False
+        names.add(os.path.basename(target))
+    return names
 
 
 def is_running(exename):
     """Check whether exename is running"""
+    return exename in running_exenames()
+
+
+def running_exenames():
+    """Return the set of names of running executables"""
     if sys.platform.startswith('linux'):
-        return is_running_linux(exename)
+        return running_exenames_linux()
     elif ('darwin' == sys.platform or
           sys.platform.startswith('openbsd') or
           sys.platform.startswith('freebsd')):
-        return is_running_darwin(exename)
+        return running_exenames_darwin()
     else:
-        raise RuntimeError('unsupported platform for physical_free()')
+        raise RuntimeError('unsupported platform for running_exenames()')
 
 
 def rotated_logs():
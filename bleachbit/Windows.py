@@ -465,18 +465,29 @@ def get_windows_version():
 
 def is_process_running(name):
     """Return boolean whether process (like firefox.exe) is running"""
+    return name.lower() in running_process_names()
 
+
+def running_process_names():
+    """Return the set of lowercase names of running processes"""
     if parse_windows_build() >= 6:
-        return is_process_running_psutil(name)
+        return running_process_names_psutil()
     else:
         # psutil does not support XP, so fall back
         # https://github.com/giampaolo/psutil/issues/348
-        return is_process_running_win32(name)
+        return running_process_names_win32()
 
 
 def is_process_running_win32(name):
     """Return boolean whether process (like firefox.exe) is running
 
+    Does not work on 64-bit Windows"""
+    return name.lower() in running_process_names_win32()
+
+
+def running_process_names_win32():
+    """Return the set of lowercase names of running processes
+
     Does not work on 64-bit Windows
 
     Originally by Eric Koome
@@ -484,6 +495,7 @@ def is_process_running_win32(name):
     http://code.activestate.com/recipes/305279/
     """
 
+    names = set()
     hModule = c_ulong()
     count = c_ulong()
     modname = c_buffer(30)
@@ -513,29 +525,33 @@ def is_process_running_win32(name):
             if len(clean_modname) > 0 and '?' != clean_modname:
                 # Filter out non-ASCII characters which we don't need
                 # and which may cause display warnings
-                clean_modname2 = re.sub(
-                    r'[^a-z.]', '_', clean_modname.lower())
-                if clean_modname2 == name.lower():
-                    return True
+                names.add(re.sub(r'[^a-z.]', '_', clean_modname.lower()))
 
-    return False
+    return names
 
 
 def is_process_running_psutil(name):
     """Return boolean whether process (like firefox.exe) is running
 
+    Works on Windows Vista or later, but on Windows XP gives an ImportError
+    """
+    return name.lower() in running_process_names_psutil()
+
+
+def running_process_names_psutil():
+    """Return the set of lowercase names of running processes
+
     Works on Windows Vista or later, but on Windows XP gives an ImportError
     """
 
     import psutil
-    name = name.lower()
+    names = set()
     for proc in psutil.process_iter():
         try:
-            if proc.name().lower() == name:
-                return True
+            names.add(proc.name().lower())
         except psutil.NoSuchProcess:
             pass
-    return False
+    return names
 
 
 def move_to_recycle_bin(path):
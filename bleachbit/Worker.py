@@ -24,22 +24,260 @@ Perform the preview or delete operations
 
 from __future__ import absolute_import, print_function
 
-from bleachbit import DeepScan, FileUtilities
+from bleachbit import Action, ChangeJournal, Cleaner, Command, DeepScan, FileUtilities, \
+    Scheduler
 from bleachbit.Cleaner import backends
 from bleachbit import _, ungettext, expanduser, FSE
 
 import logging
+import marshal
 import math
+import struct
 import sys
 
 logger = logging.getLogger(__name__)
 
+# the most files in one Command.DeleteBatch
+BATCH_SIZE = 1024
+
+# the most files of a directory sorted at once for the delete_order
+# option 'inode'
+INODE_ORDER_BUFFER = 8192
+
+# commands that Worker.execute_file() runs without a generator
+FILE_COMMANDS = (Command.Delete, Command.Shred, Command.Truncate)
+
+# how many of FILE_COMMANDS run between looks at the clock, when they
+# do not overwrite or truncate files
+TIME_CHECK_INTERVAL = 64
+
+# the start of a file written by PlanWriter
+PLAN_MAGIC = 'BleachBit plan 1\n'
+
+
+class PreviewPlan:
+
+    """What a preview found, so a clean can skip searching again
+
+    The commands are kept by operation and option, in the order they
+    ran.  A file to delete is kept in a Command.DeleteBatch as its path
+    and the PathEntry.identity() the preview saw, so the clean deletes
+    it only if it is still the same file.  So is each path a
+    Command.DeleteTree found.  Other commands are kept as they are and
+    run again."""
+
+    def __init__(self, operations):
+        self.operations = self._normalize(operations)
+        # operation.option to a list of commands
+        self.commands = {}
+
+    @staticmethod
+    def _normalize(operations):
+        return dict((key, sorted(value)) for (key, value) in operations.items())
+
+    def matches(self, operations):
+        """Return whether the plan is for these operations"""
+        return self.operations == self._normalize(operations)
+
+    def add_command(self, operation_option, cmd):
+        """Keep a command to run again"""
+        self.commands.setdefault(operation_option, []).append(cmd)
+
+    def add_file(self, operation_option, path, expected=None, size=None):
+        """Keep a file to delete if its identity is still expected"""
+        commands = self.commands.setdefault(operation_option, [])
+        if not commands or not isinstance(commands[-1], Command.DeleteBatch) or \
+                len(commands[-1]) >= BATCH_SIZE:
+            commands.append(Command.DeleteBatch())
+        commands[-1].append(path, None, expected)
+
+    def get_commands(self, operation_option):
+        """Return the commands for operation.option"""
+        return self.commands.get(operation_option, [])
+
+
+class LinkCounter:
+
+    """Count the space of files with hard links once
+
+    The space of a file is freed only when its last link is deleted,
+    so a file with other links counts nothing until the run has seen
+    as many of its links as it had.  Only files with more than one
+    link are kept, by (st_dev, st_ino).  Because the link count comes
+    from the lstat() before each delete, and a clean lowers it as it
+    goes, the first count seen is kept, and the last link is seen with
+    a count of one."""
+
+    def __init__(self):
+        # (st_dev, st_ino) to [links not yet seen, size]
+        self.pending = {}
+        self.n_links = 0  # files seen with more than one link
+
+    def add(self, link, size):
+        """Return the space freed when the link is deleted
+
+        link is a PathEntry.hard_link()."""
+        key = link[0:2]
+        if 1 == link[2]:
+            # the last link of a file whose other links a clean deleted
+            if self.pending.pop(key, None) is not None:
+                self.n_links += 1
+            return size
+        self.n_links += 1
+        (remaining, size) = self.pending.pop(key, (link[2], size))
+        remaining -= 1
+        if remaining > 0:
+            self.pending[key] = (remaining, size)
+            return 0
+        return size
+
+    def pending_bytes(self):
+        """Return the space kept by links that were not deleted"""
+        return sum(size for (_remaining, size) in self.pending.itervalues())
+
+
+class PlanWriter:
+
+    """Write what a preview found to a plan file for a later clean
+
+    The file is a stream of marshal records, so neither writing nor
+    reading it keeps the whole plan in memory:
+
+        PLAN_MAGIC
+        {'operations': operations}
+        for each operation.option, a section of records ending in None:
+            [(path, size, st_dev, st_ino, st_mtime), ...]
+        {operation.option: [(offset, rerun), ...]}
+        offset of the index (8 bytes, little endian)
+
+    A file to delete, also one found by a Command.DeleteTree, is kept
+    with the identity the preview saw, as in PreviewPlan, and a file
+    without one is left out.  Other commands cannot be written, so
+    their operation.option is marked to rerun, and a clean searches it
+    again instead of reading its files."""
+
+    def __init__(self, pathname, operations):
+        self.operations = PreviewPlan._normalize(operations)
+        self.f = open(pathname, 'wb')
+        self.f.write(PLAN_MAGIC)
+        marshal.dump({'operations': self.operations}, self.f)
+        # operation.option to a list of [offset, rerun]
+        self.index = {}
+        self.section = None
+        self.files = []
+
+    def matches(self, operations):
+        """Return whether the plan is for these operations"""
+        return self.operations == PreviewPlan._normalize(operations)
+
+    def _flush(self):
+        """Write the files waiting for a record"""
+        if self.files:
+            marshal.dump(self.files, self.f)
+            self.files = []
+
+    def _start(self, operation_option):
+        """Write records in the section of operation.option"""
+        if operation_option == self.section:
+            return
+        self._end()
+        self.section = operation_option
+        self.index.setdefault(operation_option, []).append(
+            [self.f.tell(), False])
+
+    def _end(self):
+        """End the current section"""
+        if self.section is not None:
+            self._flush()
+            marshal.dump(None, self.f)
+            self.section = None
+
+    def add_command(self, operation_option, cmd):
+        """Keep a command to run again
+
+        The deep scan is not an option a clean can search again, so
+        its section is never marked."""
+        self._start(operation_option)
+        if 'deepscan' != operation_option:
+            self.index[operation_option][-1][1] = True
+
+    def add_file(self, operation_option, path, expected=None, size=None):
+        """Keep a file to delete if its identity is still expected"""
+        self._start(operation_option)
+        if expected is None:
+            # whitelisted, or the preview could not look at it
+            return
+        self.files.append((path, size or 0) + tuple(expected))
+        if len(self.files) >= BATCH_SIZE:
+            self._flush()
+
+    def close(self):
+        """Write the index and close the file"""
+        self._end()
+        offset = self.f.tell()
+        marshal.dump(dict((key, [tuple(section) for section in sections])
+                          for (key, sections) in self.index.items()), self.f)
+        self.f.write(struct.pack('<Q', offset))
+        self.f.close()
+
+
+class PlanReader:
+
+    """Read a plan file written by PlanWriter
+
+    Only the header and the index are read when the file is opened.
+    The files of an operation.option are read a batch at a time while
+    the clean runs."""
+
+    def __init__(self, pathname):
+        self.f = open(pathname, 'rb')
+        if PLAN_MAGIC != self.f.read(len(PLAN_MAGIC)):
+            self.f.close()
+            raise ValueError('not a cleaning plan: %s' % pathname)
+        self.operations = marshal.load(self.f)['operations']
+        self.f.seek(-8, 2)
+        (offset, ) = struct.unpack('<Q', self.f.read(8))
+        self.f.seek(offset)
+        self.index = marshal.load(self.f)
+
+    def matches(self, operations):
+        """Return whether the plan is for these operations"""
+        return self.operations == PreviewPlan._normalize(operations)
+
+    def get_commands(self, operation_option):
+        """Yield the commands for operation.option"""
+        sections = self.index.get(operation_option, ())
+        if any(rerun for (_offset, rerun) in sections):
+            (operation, option_id) = operation_option.split('.', 1)
+            for cmd in backends[operation].get_commands(option_id):
+                yield cmd
+            return
+        for (offset, _rerun) in sections:
+            self.f.seek(offset)
+            while True:
+                record = marshal.load(self.f)
+                if record is None:
+                    break
+                # Other records may be read before the caller asks for
+                # the next command.
+                offset = self.f.tell()
+                batch = Command.DeleteBatch()
+                for (path, _size, st_dev, st_ino, st_mtime) in record:
+                    batch.append(path, None, (st_dev, st_ino, st_mtime))
+                yield batch
+                self.f.seek(offset)
+
+    def close(self):
+        """Close the file"""
+        self.f.close()
+
 
 class Worker:
 
     """Perform the preview or delete operations"""
 
-    def __init__(self, ui, really_delete, operations):
+    def __init__(self, ui, really_delete, operations, plan=None,
+                 preview_plan=None):
         """Create a Worker
 
         ui: an instance with methods
@@ -48,9 +286,16 @@ class Worker:
             update_total_size()
             update_item_size()
             worker_done()
+            and optionally the attribute quiet, to show only the totals
+            instead of a line for each file
         really_delete: (boolean) preview or make real changes?
         operations: dictionary where operation-id is the key and
             operation-id are values
+        plan: a PreviewPlan or PlanReader from a preview of the same
+            operations, to clean what it found instead of searching again
+        preview_plan: where a preview keeps what it finds, such as
+            a PlanWriter (by default a PreviewPlan if the option
+            reuse_preview is set)
         """
         self.ui = ui
         self.really_delete = really_delete
@@ -62,6 +307,18 @@ class Worker:
         self.total_errors = 0
         self.total_special = 0  # special operations
         self.yield_time = None
+        self.quiet = getattr(ui, 'quiet', False)
+        from bleachbit.Options import options
+        self.stat_workers = int(options.get('preview_workers'))
+        self.plan = plan if really_delete else None
+        self.total_changed = 0  # files changed since the preview
+        # hard links, so total_bytes counts their space once
+        self.links = LinkCounter()
+        # what this preview finds, for a later clean
+        self.preview_plan = None if really_delete else preview_plan
+        if self.preview_plan is None and not really_delete and \
+                options.get('reuse_preview'):
+            self.preview_plan = PreviewPlan(operations)
         if 0 == len(self.operations):
             raise RuntimeError("No work to do")
 
@@ -76,9 +333,119 @@ class Worker:
         logger.error(err, exc_info=True)
         self.total_errors += 1
 
+    def print_command_error(self, e, cmd, operation_option, exc_info=True):
+        """Display the exception e raised by a command"""
+        # 2 = does not exist
+        # 13 = permission denied
+        from errno import ENOENT, EACCES
+        if isinstance(e, OSError) and e.errno in (ENOENT, EACCES):
+            # For access denied, do not show traceback
+            exc_message = str(e).decode(FSE)
+            logger.error('%s: %s', exc_message, cmd)
+        else:
+            # For other errors, show the traceback.
+            msg = _('Error: {operation_option}: {command}')
+            data = {'command': cmd, 'operation_option': operation_option}
+            logger.error(msg.format(**data), exc_info=exc_info)
+        self.total_errors += 1
+
+    def execute_batch(self, batch, operation_option):
+        """Execute or preview a Command.DeleteBatch
+
+        Like execute() for each file, but the outcomes are read from
+        the arrays of the batch, and the log gets one update."""
+        for ret in batch.run(self.really_delete):
+            yield ret
+        labels = batch.labels()
+        glob_cache = FileUtilities.glob_cache if self.really_delete else None
+        # The link counts are only consistent in the order the files
+        # were looked at, which threads may have changed.
+        freed_by_link = {}
+        for (i, link) in batch.links:
+            if batch.status[i] in (Command.DeleteBatch.DELETED,
+                                   Command.DeleteBatch.MARKED):
+                freed_by_link[i] = self.links.add(link, int(batch.sizes[i]))
+        lines = []
+        for i in xrange(len(batch)):
+            status = batch.status[i]
+            path = batch.paths[i]
+            if self.preview_plan is not None:
+                expected = None
+                if Command.DeleteBatch.DELETED == status:
+                    try:
+                        expected = batch.entries[i].identity()
+                    except OSError:
+                        pass
+                self.preview_plan.add_file(operation_option, path, expected,
+                                           int(batch.sizes[i]))
+            if Command.DeleteBatch.FAILED == status:
+                exc_info = batch.errors[i]
+                self.print_command_error(exc_info[1], 'Command to delete %s' % path,
+                                         operation_option, exc_info)
+                continue
+            size = int(batch.sizes[i])
+            if Command.DeleteBatch.CHANGED == status:
+                self.total_changed += 1
+            elif Command.DeleteBatch.SKIPPED != status:
+                freed = freed_by_link.get(i, size)
+                self.size += freed
+                self.total_bytes += freed
+                self.total_deleted += 1
+                if glob_cache is not None:
+                    glob_cache.deleted(path)
+            if not self.quiet:
+                lines.append(u"%s %s %s\n" % (labels[status],
+                                              FileUtilities.bytes_to_human(size),
+                                              path.decode('utf8', 'replace')))
+        if lines:
+            self.ui.append_text(u''.join(lines))
+
+    def record(self, cmd, operation_option, ret):
+        """Keep a command for a clean that reuses this preview"""
+        if cmd.__class__ is Command.Delete and not cmd.shred and \
+                ret is not None and ret['n_deleted']:
+            entry = cmd.entry or FileUtilities.PathEntry(cmd.path)
+            try:
+                expected = entry.identity()
+            except OSError:
+                pass
+            else:
+                self.preview_plan.add_file(operation_option, cmd.path, expected,
+                                           ret['size'])
+                return
+        if 'deepscan' == operation_option:
+            # A file the deep scan whitelisted or could not look at is
+            # left out, as add_file() leaves out one without identity.
+            return
+        self.preview_plan.add_command(operation_option, cmd)
+
+    def record_entry(self, operation_option, entry, size):
+        """Keep a path found by a Command.DeleteTree for a clean that
+        reuses this preview
+
+        The clean then deletes only what the preview found, and does
+        not walk the tree again."""
+        try:
+            expected = entry.identity()
+        except OSError:
+            return
+        self.preview_plan.add_file(operation_option, entry.path, expected, size)
+
+    def execute_any(self, cmd, operation_option):
+        """Execute or preview a command or a Command.DeleteBatch"""
+        if isinstance(cmd, Command.DeleteBatch):
+            return self.execute_batch(cmd, operation_option)
+        return self.execute(cmd, operation_option)
+
     def execute(self, cmd, operation_option):
         """Execute or preview the command"""
         ret = None
+        # a Command.DeleteTree keeps its paths as it goes
+        by_entry = self.preview_plan is not None and \
+            isinstance(cmd, Command.DeleteTree)
+        if by_entry:
+            cmd.on_delete = lambda entry, result: \
+                self.record_entry(operation_option, entry, result['size'])
         try:
             for ret in cmd.execute(self.really_delete):
                 if True == ret or isinstance(ret, tuple):
@@ -89,41 +456,70 @@ class Worker:
         except SystemExit:
             pass
         except Exception as e:
-            # 2 = does not exist
-            # 13 = permission denied
-            from errno import ENOENT, EACCES
-            if isinstance(e, OSError) and e.errno in (ENOENT, EACCES):
-                # For access denied, do not show traceback
-                exc_message = str(e).decode(FSE)
-                logger.error('%s: %s', exc_message, cmd)
-            else:
-                # For other errors, show the traceback.
-                msg = _('Error: {operation_option}: {command}')
-                data = {'command': cmd, 'operation_option': operation_option}
-                logger.error(msg.format(**data), exc_info=True)
-            self.total_errors += 1
+            if self.preview_plan is not None:
+                self.record(cmd, operation_option, None)
+            self.print_command_error(e, cmd, operation_option)
         else:
+            if True == ret:
+                # Command.DeleteTree yields True while it works, and no
+                # record when it found nothing.
+                ret = None
+            if self.preview_plan is not None and not by_entry:
+                self.record(cmd, operation_option, ret)
             if ret is None:
                 return
-            if isinstance(ret['size'], (int, long)):
-                size = FileUtilities.bytes_to_human(ret['size'])
-                self.size += ret['size']
-                self.total_bytes += ret['size']
-            else:
-                size = "?B"
+            line = self.report(ret)
+            if line is not None:
+                self.ui.append_text(line)
 
-            if ret['path']:
-                path = ret['path']
+    def execute_file(self, cmd, operation_option):
+        """Execute or preview one of FILE_COMMANDS
+
+        Like execute(), but without a generator, and return the line
+        for the log, or None."""
+        try:
+            if FileUtilities.whitelisted(cmd.path):
+                ret = Command.whitelist(cmd.path)
             else:
-                path = ''
-            path = path.decode('utf8', 'replace')  # for invalid encoding
-            line = u"%s %s %s\n" % (ret['label'], size, path)
-            self.total_deleted += ret['n_deleted']
-            self.total_special += ret['n_special']
-            if ret['label']:
-                # the label may be a hidden operation
-                # (e.g., win.shell.change.notify)
-                self.ui.append_text(line)
+                ret = cmd.delete(self.really_delete)
+        except SystemExit:
+            return None
+        except Exception as e:
+            if self.preview_plan is not None:
+                self.record(cmd, operation_option, None)
+            self.print_command_error(e, cmd, operation_option)
+            return None
+        if self.preview_plan is not None:
+            self.record(cmd, operation_option, ret)
+        return self.report(ret)
+
+    def report(self, ret):
+        """Count the result of a command, and return the line for the
+        log, or None"""
+        size = ret['size']
+        if isinstance(size, (int, long)):
+            freed = size
+            for (link, link_size) in ret.get('links', ()):
+                freed -= link_size - self.links.add(link, link_size)
+            self.size += freed
+            self.total_bytes += freed
+        path = ret['path']
+        if path and self.really_delete and FileUtilities.glob_cache is not None:
+            FileUtilities.glob_cache.deleted(path)
+        self.total_deleted += ret['n_deleted']
+        # a Command.DeleteTree counts the files it could not delete
+        self.total_errors += ret.get('n_errors', 0)
+        self.total_special += ret['n_special']
+        if self.quiet or not ret['label']:
+            # the label may be a hidden operation
+            # (e.g., win.shell.change.notify)
+            return None
+        if isinstance(size, (int, long)):
+            size = FileUtilities.bytes_to_human(size)
+        else:
+            size = "?B"
+        path = (path or '').decode('utf8', 'replace')  # for invalid encoding
+        return u"%s %s %s\n" % (ret['label'], size, path)
 
     def clean_operation(self, operation):
         """Perform a single cleaning operation"""
@@ -135,6 +531,10 @@ class Worker:
         if not operation_options:
             raise StopIteration
 
+        # Each operation is a phase, so look at the open files again
+        # when one is next needed.
+        FileUtilities.openfiles.refresh()
+
         if self.really_delete and backends[operation].is_running():
             # TRANSLATORS: %s expands to a name such as 'Firefox' or 'System'.
             err = _("%s cannot be cleaned because it is currently running.  Close it, and try again.") \
@@ -144,29 +544,69 @@ class Worker:
             return
         import time
         self.yield_time = time.time()
+        from bleachbit.Options import options
+        shred = options.get('shred')
 
         total_size = 0
         for option_id in operation_options:
             self.size = 0
             assert(isinstance(option_id, (str, unicode)))
             # normal scan
-            for cmd in backends[operation].get_commands(option_id):
-                for ret in self.execute(cmd, '%s.%s' % (operation, option_id)):
-                    if True == ret:
-                        # Return control to PyGTK idle loop to keep
-                        # it responding allow the user to abort
-                        self.yield_time = time.time()
-                        yield True
+            if self.plan is not None:
+                # clean what the preview found
+                commands = self.plan.get_commands('%s.%s' % (operation, option_id))
+            else:
+                commands = backends[operation].get_commands(option_id)
+            if FileUtilities.stat_pool is not None:
+                # a preview mostly waits on lstat(), so look up
+                # a batch of files at once
+                commands = FileUtilities.prefetch_lstat(
+                    commands, FileUtilities.stat_pool)
+            operation_option = '%s.%s' % (operation, option_id)
+            # the log lines of FILE_COMMANDS, shown together
+            lines = []
+            n_files = 0
+            for cmd in commands:
+                # the commands are old-style classes, so not type(cmd)
+                if cmd.__class__ in FILE_COMMANDS:
+                    line = self.execute_file(cmd, operation_option)
+                    if line is not None:
+                        lines.append(line)
+                    n_files += 1
+                    # Overwriting or truncating a large file can take
+                    # long, so then look at the clock after each one.
+                    costly = self.really_delete and \
+                        (shred or cmd.__class__ is not Command.Delete or cmd.shred)
+                    if n_files % TIME_CHECK_INTERVAL and not costly:
+                        continue
+                else:
+                    if lines:
+                        self.ui.append_text(u''.join(lines))
+                        lines = []
+                    for ret in self.execute_any(cmd, operation_option):
+                        if True == ret:
+                            # Return control to PyGTK idle loop to keep
+                            # it responding allow the user to abort
+                            self.yield_time = time.time()
+                            yield True
                 if time.time() - self.yield_time > 0.25:
+                    if lines:
+                        self.ui.append_text(u''.join(lines))
+                        lines = []
                     if self.really_delete:
                         self.ui.update_total_size(self.total_bytes)
                     yield True
                     self.yield_time = time.time()
+            if lines:
+                self.ui.append_text(u''.join(lines))
 
             self.ui.update_item_size(operation, option_id, self.size)
             total_size += self.size
 
             # deep scan
+            if self.plan is not None:
+                # the plan has the results
+                continue
             for ds in backends[operation].get_deep_scan(option_id):
                 if '' == ds['path']:
                     ds['path'] = expanduser('~')
@@ -222,49 +662,88 @@ class Worker:
         2. Deep scan
         3. Memory
         4. Free disk space"""
-        self.deepscans = {}
-        # prioritize
-        self.delayed_ops = []
-        for operation in self.operations:
-            delayables = ['free_disk_space', 'memory']
-            for delayable in delayables:
-                if operation not in ('system', '_gui'):
-                    continue
-                if delayable in self.operations[operation]:
-                    i = self.operations[operation].index(delayable)
-                    del self.operations[operation][i]
-                    priority = 99
-                    if 'free_disk_space' == delayable:
-                        priority = 100
-                    new_op = (priority, {operation: [delayable]})
-                    self.delayed_ops.append(new_op)
-
-        # standard operations
-        import warnings
-        with warnings.catch_warnings(record=True) as ws:
-            # This warning system allows general warnings. Duplicate will
-            # be removed, and the warnings will show near the end of
-            # the log.
-
-            warnings.simplefilter('once')
-            for dummy in self.run_operations(self.operations):
-                # yield to GTK+ idle loop
-                yield True
-            for w in ws:
-                logger.warning(w.message)
-
-        # run deep scan
-        if self.deepscans:
-            for dummy in self.run_deep_scan():
-                yield dummy
-
-        # delayed operations
-        for op in sorted(self.delayed_ops):
-            operation = op[1].keys()[0]
-            for option_id in op[1].values()[0]:
-                for ret in self.run_delayed_op(operation, option_id):
+        from bleachbit.Options import options
+        if options.get('change_journal'):
+            # keep directory listings for the next run
+            ChangeJournal.enable()
+        else:
+            ChangeJournal.disable()
+        # Many actions glob the same directories, so list them once
+        # per run.
+        FileUtilities.start_glob_cache()
+        # Deletes come in batches, not one command per file.
+        Action.set_batch_size(BATCH_SIZE)
+        if self.really_delete:
+            # The files of a directory are deleted through one open
+            # descriptor for it.
+            FileUtilities.start_unlinker()
+            if 'inode' == options.get('delete_order'):
+                FileUtilities.set_inode_order(INODE_ORDER_BUFFER)
+            # Batches on separate devices can be deleted at once.
+            Scheduler.start_scheduler(int(options.get('jobs')))
+        else:
+            # One pool of threads looks up files for every option.
+            FileUtilities.start_stat_pool(self.stat_workers)
+        try:
+            # Look at the processes again for this run.
+            Cleaner.processes.expire()
+            self.deepscans = {}
+            # prioritize
+            self.delayed_ops = []
+            for operation in self.operations:
+                delayables = ['free_disk_space', 'memory']
+                for delayable in delayables:
+                    if operation not in ('system', '_gui'):
+                        continue
+                    if delayable in self.operations[operation]:
+                        i = self.operations[operation].index(delayable)
+                        del self.operations[operation][i]
+                        priority = 99
+                        if 'free_disk_space' == delayable:
+                            priority = 100
+                        new_op = (priority, {operation: [delayable]})
+                        self.delayed_ops.append(new_op)
+
+            # standard operations
+            import warnings
+            with warnings.catch_warnings(record=True) as ws:
+                # This warning system allows general warnings. Duplicate will
+                # be removed, and the warnings will show near the end of
+                # the log.
+
+                warnings.simplefilter('once')
+                for dummy in self.run_operations(self.operations):
                     # yield to GTK+ idle loop
                     yield True
+                for w in ws:
+                    logger.warning(w.message)
+
+            # run deep scan
+            if self.plan is not None:
+                for cmd in self.plan.get_commands('deepscan'):
+                    for dummy in self.execute_any(cmd, 'deepscan'):
+                        yield True
+            elif self.deepscans:
+                for dummy in self.run_deep_scan():
+                    yield dummy
+
+            # delayed operations
+            for op in sorted(self.delayed_ops):
+                operation = op[1].keys()[0]
+                for option_id in op[1].values()[0]:
+                    for ret in self.run_delayed_op(operation, option_id):
+                        # yield to GTK+ idle loop
+                        yield True
+        finally:
+            # The caller may close this generator early, so the
+            # run-wide state is always reset.
+            ChangeJournal.save()
+            FileUtilities.stop_glob_cache()
+            FileUtilities.stop_unlinker()
+            FileUtilities.set_inode_order(0)
+            Scheduler.stop_scheduler()
+            FileUtilities.stop_stat_pool()
+            Action.set_batch_size(None)
 
         # print final stats
         bytes_delete = FileUtilities.bytes_to_human(self.total_bytes)
@@ -287,9 +766,26 @@ class Worker:
             # would be deleted (in other words, simply a preview).
             line = _("Files to be deleted: %d") % self.total_deleted
         self.ui.append_text("\n%s" % line)
+        if self.links.n_links > 0:
+            # TRANSLATORS: The disk space of a file with several hard
+            # links is counted once
+            line = _("Files with hard links: %d") % self.links.n_links
+            self.ui.append_text("\n%s" % line)
+            pending = self.links.pending_bytes()
+            if pending > 0:
+                # TRANSLATORS: Hard links outside the cleaning keep
+                # this much disk space in use
+                line = _("Disk space kept by other hard links: %s") % \
+                    FileUtilities.bytes_to_human(pending)
+                self.ui.append_text("\n%s" % line)
         if self.total_special > 0:
             line = _("Special operations: %d") % self.total_special
             self.ui.append_text("\n%s" % line)
+        if self.total_changed > 0:
+            # TRANSLATORS: These files were not deleted because they
+            # changed after the preview
+            line = _("Files changed since the preview: %d") % self.total_changed
+            self.ui.append_text("\n%s" % line)
         if self.total_errors > 0:
             line = _("Errors: %d") % self.total_errors
             self.ui.append_text("\n%s" % line, 'error')
@@ -308,21 +804,26 @@ class Worker:
         # or all the system executables.
         self.ui.update_progress_bar(_("Please wait.  Running deep scan."))
         yield True  # allow GTK to update the screen
-        ds = DeepScan.DeepScan()
+        from bleachbit.Options import options
+        ds = DeepScan.DeepScan(workers=int(options.get('deepscan_workers')),
+                               ordered=options.get('deepscan_ordered'))
         for (path, dsdict) in self.deepscans.items():
             logger.debug('deepscan path=%s, dict=%s' % (path, dsdict))
             for dsdict2 in dsdict:
-                ds.add_search(path, dsdict2['regex'])
+                policy = DeepScan.PrunePolicy(dsdict2['onefilesystem'],
+                                              dsdict2['skipfstypes'],
+                                              dsdict2['skipdirs'])
+                ds.add_search(path, dsdict2['regex'], dsdict2['cache'], policy)
 
         for path in ds.scan():
             if True == path:
                 yield True
                 continue
             # fixme: support non-delete commands
-            from bleachbit import Command
-            cmd = Command.Delete(path)
-            for ret in self.execute(cmd, 'deepscan'):
-                yield True
+            line = self.execute_file(Command.Delete(path), 'deepscan')
+            if line is not None:
+                self.ui.append_text(line)
+            yield True
 
     def run_operations(self, my_operations):
         """Run a set of operations (general, memory, free disk space)"""
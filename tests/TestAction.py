@@ -27,8 +27,10 @@ from __future__ import absolute_import, print_function
 
 from bleachbit.Action import *
 from bleachbit import FSE, expanduser, expandvars
+from bleachbit.Options import options
 from tests import common
 
+import glob
 import shutil
 import sys
 import tempfile
@@ -249,7 +251,7 @@ class ActionTestCase(common.BleachbitTestCase):
         _iglob = glob.iglob
         glob.iglob = lambda x: ['/tmp/foo1', '/tmp/foo2', '/tmp/bar1']
         _getsize = FileUtilities.getsize
-        FileUtilities.getsize = lambda x: 1
+        FileUtilities.getsize = lambda x, entry=None: 1
 
         # should match three files using no regexes
         action_str = u'<action command="delete" search="glob" path="/tmp/foo*" />'
@@ -306,7 +308,7 @@ class ActionTestCase(common.BleachbitTestCase):
         _iglob = glob.iglob
         glob.iglob = lambda x: ['/tmp/foo1', '/tmp/foo2', '/tmp/bar1']
         _getsize = FileUtilities.getsize
-        FileUtilities.getsize = lambda x: 1
+        FileUtilities.getsize = lambda x, entry=None: 1
 
         # should match three files using no regexes
         action_str = u'<action command="delete" search="glob" path="/tmp/foo*" />'
@@ -329,6 +331,23 @@ class ActionTestCase(common.BleachbitTestCase):
         glob.iglob = _iglob
         FileUtilities.getsize = _getsize
 
+    def test_regex_registry(self):
+        """Unit test for RegexRegistry"""
+        registry = RegexRegistry()
+        compiled = registry.compile('^foo$')
+        self.assertTrue(compiled.search('foo'))
+        self.assertIs(registry.compile('^foo$'), compiled)
+        self.assertIsNot(registry.compile('^foo$', re.IGNORECASE), compiled)
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry.dump(), [('^foo$', 0, 2), ('^foo$', re.IGNORECASE, 1)])
+
+        # actions with the same pattern share the compiled form
+        action_str = u'<action command="delete" search="glob" path="/tmp/foo*" regex="^bleachbit-registry$"/>'
+        for _i in range(2):
+            Delete(parseString(action_str).childNodes[0])
+        self.assertEqual([uses for (pattern, _flags, uses) in regex_registry.dump()
+                          if pattern == '^bleachbit-registry$'], [2])
+
     def test_type(self):
         """Unit test for type attribute"""
         dirname = self.mkdtemp(prefix='bleachbit-action-type')
@@ -380,6 +399,113 @@ class ActionTestCase(common.BleachbitTestCase):
 
         os.rmdir(dirname)
 
+    def test_TraversalPlan(self):
+        """Unit test for TraversalPlan"""
+        top = self.mkdtemp(prefix='bleachbit-action-plan')
+        subdir = os.path.join(top, 'sub')
+        os.mkdir(subdir)
+        f_log = self.write_file(os.path.join(top, 'a.log'))
+        f_txt = self.write_file(os.path.join(top, 'a.txt'))
+        f_sub_log = self.write_file(os.path.join(subdir, 'b.log'))
+        f_sub_tmp = self.write_file(os.path.join(subdir, 'b.tmp'))
+        other = self.mkdtemp(prefix='bleachbit-action-plan-other')
+        f_other = self.write_file(os.path.join(other, 'c.log'))
+
+        action_strs = (
+            u'<action command="delete" search="walk.files" path="%s" regex="\\.log$"/>' % top,
+            u'<action command="delete" search="walk.all" path="%s" regex="\\.(log|tmp)$"/>' % subdir,
+            u'<action command="delete" search="walk.files" path="%s"/>' % other,
+            u'<action command="truncate" search="file" path="%s"/>' % f_txt,
+            u'<action command="delete" search="file" path="%s"/>' % os.path.join(top, 'missing'))
+        providers = []
+        for action_str in action_strs:
+            action_node = parseString(action_str).childNodes[0]
+            for actionplugin in ActionProvider.plugins:
+                if actionplugin.action_key == action_node.getAttribute('command'):
+                    providers.append(actionplugin(action_node))
+
+        plan = TraversalPlan(providers)
+        self.assertEqual([step[0] for step in plan.steps], ['walk', 'walk', 'action', 'action'])
+        self.assertEqual(plan.steps[0][1], top)
+        self.assertEqual([root for (root, _provider) in plan.steps[0][2]], [top, subdir])
+        self.assertIn('walk %s' % top, plan.dump())
+
+        # each directory is listed once
+        listed = []
+        _list_entries = FileUtilities.list_entries
+
+        def list_entries(dirname, parent=None):
+            listed.append(dirname)
+            return _list_entries(dirname, parent)
+        FileUtilities.list_entries = list_entries
+        try:
+            cmds = list(plan_commands(providers))
+        finally:
+            FileUtilities.list_entries = _list_entries
+        self.assertEqual(sorted(listed), sorted([top, subdir, other]))
+
+        # each file is claimed once, by the first action that accepts it
+        paths = [cmd.path for cmd in cmds]
+        self.assertEqual(sorted(paths), sorted([f_log, f_sub_log, f_sub_tmp, f_other, f_txt]))
+        self.assertIsInstance(cmds[-1], Command.Truncate)
+
+        # in batches, which do not span steps
+        batches = list(plan.get_commands(batch_size=1))
+        self.assertEqual([len(batch) for batch in batches[:4]], [1, 1, 1, 1])
+        self.assertEqual(len(batches), 5)
+        batches = list(plan.get_commands(batch_size=10))
+        self.assertEqual([len(batch) for batch in batches[:2]], [3, 1])
+        self.assertIsInstance(batches[0], Command.DeleteBatch)
+        self.assertEqual(sorted(batches[0].paths + batches[1].paths),
+                         sorted([f_log, f_sub_log, f_sub_tmp, f_other]))
+        self.assertIsInstance(batches[2], Command.Truncate)
+
+        import shutil
+        shutil.rmtree(top)
+        shutil.rmtree(other)
+
+    def test_TraversalPlan_tree(self):
+        """Unit test for TraversalPlan with a whole tree to delete"""
+        top = self.mkdtemp(prefix='bleachbit-action-tree')
+        subdir = os.path.join(top, 'sub')
+        os.mkdir(subdir)
+        self.write_file(os.path.join(top, 'a.log'))
+        self.write_file(os.path.join(subdir, 'b.tmp'))
+        action_strs = (
+            u'<action command="delete" search="walk.files" path="%s" regex="\\.log$"/>' % top,
+            u'<action command="delete" search="walk.all" path="%s"/>' % top)
+        providers = []
+        for action_str in action_strs:
+            action_node = parseString(action_str).childNodes[0]
+            providers.append(Delete(action_node))
+
+        old_whitelist = options.get_whitelist_paths()
+        try:
+            # something whitelisted under the top needs the walk
+            options.set_whitelist_paths([('file', os.path.join(subdir, 'b.tmp'))])
+            plan = TraversalPlan(providers)
+            self.assertEqual([step[0] for step in plan.steps], ['walk'])
+            self.assertEqual(len(list(plan.get_commands())), 3)
+
+            options.set_whitelist_paths([])
+            plan = TraversalPlan(providers)
+            self.assertEqual([step[0] for step in plan.steps], ['tree'])
+            self.assertIn('tree %s' % top, plan.dump())
+            cmds = list(plan.get_commands())
+        finally:
+            options.set_whitelist_paths(old_whitelist)
+        self.assertEqual(len(cmds), 1)
+        self.assertIsInstance(cmds[0], Command.DeleteTree)
+        ret = cmds[0].execute(True).next()
+        self.assertEqual(ret['n_deleted'], 3)
+        self.assertEqual(os.listdir(top), [])
+
+        # a filtered walk.all walks as before
+        action_node = parseString(action_strs[0].replace('walk.files', 'walk.all')).childNodes[0]
+        plan = TraversalPlan([Delete(action_node)])
+        self.assertEqual([step[0] for step in plan.steps], ['walk'])
+        os.rmdir(top)
+
     def test_walk_files(self):
         """Unit test for walk.files"""
         paths = {'posix': '/var', 'nt': '$WINDIR\\system32'}
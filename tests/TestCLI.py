@@ -128,7 +128,7 @@ class CLITestCase(common.BleachbitTestCase):
         save_delete = FileUtilities.delete
         deleted_paths = []
 
-        def dummy_delete(path, shred=False):
+        def dummy_delete(path, shred=False, entry=None):
             self.assertExists(path)
             deleted_paths.append(os.path.normcase(path))
         FileUtilities.delete = dummy_delete
@@ -0,0 +1,140 @@
+# vim: ts=4:sw=4:expandtab
+# -*- coding: UTF-8 -*-
+
+# BleachBit
+# Copyright (C) 2008-2018 Andrew Ziem
+# https://www.bleachbit.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Test case for module ChangeJournal
+"""
+
+from __future__ import absolute_import, print_function
+
+from tests import common
+from bleachbit import ChangeJournal
+from bleachbit.FileUtilities import children_in_directory, list_entries
+
+import errno
+import os
+import unittest
+
+
+@unittest.skipUnless(os.path.exists('/proc/sys/fs/inotify'), 'skipping without inotify')
+class ChangeJournalTestCase(common.BleachbitTestCase):
+
+    """Test case for module ChangeJournal"""
+
+    def setUp(self):
+        self.journal = ChangeJournal.enable()
+        self.assertIsNotNone(self.journal)
+
+    def tearDown(self):
+        ChangeJournal.disable()
+        self.assertIsNone(ChangeJournal.journal)
+
+    def test_listing(self):
+        """Listings are kept until the directory changes"""
+        top = self.mkdtemp(prefix='bleachbit-test-journal')
+        subdir = os.path.join(top, 'sub')
+        os.mkdir(subdir)
+        f_a = self.write_file(os.path.join(subdir, 'a'))
+
+        self.assertEqual(list(children_in_directory(top)), [f_a])
+        self.assertEqual(self.journal.get(subdir, 'names'), ['a'])
+
+        # A new file drops the listing of its directory only.
+        f_b = self.write_file(os.path.join(subdir, 'b'))
+        self.assertIsNone(self.journal.get(subdir, 'names'))
+        self.assertEqual(self.journal.get(top, 'names'), ['sub'])
+        self.assertEqual(sorted(children_in_directory(top)), [f_a, f_b])
+
+        # So does a deletion.
+        os.remove(f_a)
+        self.assertEqual(list(children_in_directory(top)), [f_b])
+
+        # A moved directory is forgotten with its subdirectories.
+        os.rename(top, top + '.moved')
+        self.assertIsNone(self.journal.get(top, 'names'))
+        self.assertIsNone(self.journal.get(subdir, 'names'))
+        os.mkdir(top)
+        os.mkdir(subdir)
+        self.assertEqual(list(children_in_directory(top)), [])
+
+        import shutil
+        shutil.rmtree(top)
+        shutil.rmtree(top + '.moved')
+
+    def test_watch_limit(self):
+        """Directories that cannot be watched are listed every time"""
+        top = self.mkdtemp(prefix='bleachbit-test-journal')
+        f_a = self.write_file(os.path.join(top, 'a'))
+
+        def add_watch(pathname, mask):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        self.journal.inotify.add_watch = add_watch
+        self.assertEqual([entry.path for entry in list_entries(top)], [f_a])
+        self.assertIsNone(self.journal.get(top, 'names'))
+        self.assertTrue(self.journal.watch_limit)
+
+        import shutil
+        shutil.rmtree(top)
+
+    def test_overflow(self):
+        """An event queue overflow drops every listing"""
+        top = self.mkdtemp(prefix='bleachbit-test-journal')
+        list_entries(top)
+        self.assertEqual(self.journal.get(top, 'names'), [])
+
+        read_events = self.journal.inotify.read_events
+        self.journal.inotify.read_events = lambda: [(-1, ChangeJournal.IN_Q_OVERFLOW, '')]
+        self.assertIsNone(self.journal.get(top, 'names'))
+        self.journal.inotify.read_events = read_events
+
+        import shutil
+        shutil.rmtree(top)
+
+    def test_save(self):
+        """Listings are used by a later run until the directory changes"""
+        top = self.mkdtemp(prefix='bleachbit-test-journal')
+        self.write_file(os.path.join(top, 'a'))
+        recent = self.mkdtemp(prefix='bleachbit-test-journal')
+        # An old modification time cannot stay the same after a change.
+        import time
+        past = time.time() - 10
+        os.utime(top, (past, past))
+        pathname = os.path.join(self.tempdir, 'listings.index')
+        self.journal.pathname = pathname
+        list_entries(top)
+        list_entries(recent)
+        self.journal.save()
+
+        later = ChangeJournal.ChangeJournal(pathname=pathname)
+        later.load()
+        self.assertEqual(later.saved.keys(), [top])
+        self.assertEqual(later.get(top, 'names'), ['a'])
+        self.assertEqual(later.get(top, 'deepscan'), None)
+        # After a change since the save, the directory is listed again.
+        later.load()
+        self.write_file(os.path.join(top, 'b'))
+        self.assertIsNone(later.get(top, 'names'))
+        self.assertEqual(later.saved, {})
+        later.close()
+
+        import shutil
+        shutil.rmtree(top)
+        shutil.rmtree(recent)
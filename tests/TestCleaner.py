@@ -27,6 +27,7 @@ Test case for module Cleaner
 from __future__ import absolute_import, print_function
 
 from bleachbit.Action import ActionProvider
+from bleachbit.Command import DeleteTree
 from bleachbit.Cleaner import *
 
 from tests import common
@@ -89,10 +90,14 @@ class CleanerTestCase(common.BleachbitTestCase):
             count = 0
             for cmd in cleaner.get_commands('option1'):
                 for result in cmd.execute(False):
-                    self.assertEqual(result['n_deleted'], 1)
                     pathname = result['path']
                     self.assertLExists(pathname, "Does not exist: '%s'" % pathname)
                     count += 1
+                    if isinstance(cmd, DeleteTree):
+                        # one result for the files under the directory
+                        self.assertGreater(result['n_deleted'], 0)
+                        continue
+                    self.assertEqual(result['n_deleted'], 1)
                     common.validate_result(self, result)
             self.assertGreater(count, 0, "No files found for %s" % action_str)
         # should yield nothing
@@ -176,10 +181,12 @@ class CleanerTestCase(common.BleachbitTestCase):
         _iglob = glob.iglob
         _lexists = os.path.lexists
         _oswalk = os.walk
+        _walk_entries = FileUtilities.walk_entries
         glob.iglob = lambda path: []
         os.path.exists = lambda path: False
         os.path.lexists = lambda path: False
         os.walk = lambda top, topdown = False: []
+        FileUtilities.walk_entries = lambda top, prune = None: []
         for key in sorted(backends):
             for (option_id, __name) in backends[key].get_options():
                 for cmd in backends[key].get_commands(option_id):
@@ -194,6 +201,38 @@ class CleanerTestCase(common.BleachbitTestCase):
         os.path.exists = _exists
         os.path.lexists = _lexists
         os.walk = _oswalk
+        FileUtilities.walk_entries = _walk_entries
+
+    def test_ProcessSnapshot(self):
+        """Unit test for class ProcessSnapshot"""
+        snapshot = ProcessSnapshot(ttl=60)
+        exe = os.path.basename(os.path.realpath(sys.executable))
+        self.assertTrue(snapshot.is_exe_running(exe))
+        self.assertFalse(snapshot.is_exe_running('does-not-exist'))
+
+        # the list is kept until it expires
+        names = snapshot.get_exenames()
+        self.assertIs(snapshot.get_exenames(), names)
+        snapshot.expire()
+        self.assertIsNot(snapshot.get_exenames(), names)
+
+        # so are the running-detection globs
+        lock = self.write_file('bleachbit-test-lock')
+        pattern = os.path.join(self.tempdir, 'bleachbit-test-l*')
+        self.assertEqual(snapshot.pathname_exists(pattern), lock)
+        os.remove(lock)
+        self.assertEqual(snapshot.pathname_exists(pattern), lock)
+        snapshot.expire()
+        self.assertIsNone(snapshot.pathname_exists(pattern))
+
+        # a cleaner uses the shared snapshot
+        cleaner = Cleaner()
+        cleaner.add_running('exe', exe)
+        self.assertTrue(cleaner.is_running())
+        cleaner = Cleaner()
+        cleaner.add_running('pathname', pattern)
+        processes.expire()
+        self.assertFalse(cleaner.is_running())
 
     def test_register_cleaners(self):
         """Unit test for register_cleaners"""
@@ -49,6 +49,78 @@ class CommandTestCase(common.BleachbitTestCase):
         self.assertEqual(ret['path'], path)
         self.assertNotExists(path)
 
+    def test_DeleteTree(self):
+        """Unit test for DeleteTree"""
+        top = self.mkdtemp(prefix='bleachbit-test-deletetree')
+        os.makedirs(os.path.join(top, 'a', 'b'))
+        for name in ('1', os.path.join('a', '2'), os.path.join('a', 'b', '3')):
+            self.write_file(os.path.join(top, name), b'foo')
+        cmd = DeleteTree(top)
+        self.assertIn(top, str(cmd))
+
+        # preview: one record for the five paths
+        rets = list(cmd.execute(really_delete=False))
+        self.assertEqual(len(rets), 1)
+        self.assertEqual(rets[0]['path'], top)
+        self.assertEqual(rets[0]['n_deleted'], 5)
+        self.assertEqual(rets[0]['n_errors'], 0)
+        self.assertGreater(rets[0]['size'], 0)
+        self.assertExists(os.path.join(top, 'a', 'b', '3'))
+
+        # delete the contents but not the directory, and yield while
+        # deleting
+        rets = list(cmd.execute(really_delete=True, step=2))
+        self.assertEqual(rets[:2], [True, True])
+        self.assertEqual(len(rets), 3)
+        self.assertEqual(rets[2]['n_deleted'], 5)
+        self.assertExists(top)
+        self.assertEqual(os.listdir(top), [])
+
+        # nothing left to report
+        self.assertEqual(list(cmd.execute(really_delete=True)), [])
+        os.rmdir(top)
+
+    def test_DeleteBatch(self):
+        """Unit test for DeleteBatch"""
+        from bleachbit.Options import options
+        paths = [self.write_file('test_DeleteBatch%d' % i, b'foo') for i in range(3)]
+        missing = os.path.join(self.tempdir, 'missing')
+        batch = DeleteBatch()
+        for path in paths:
+            batch.append(path)
+        batch.append(missing)
+        self.assertEqual(len(batch), 4)
+        self.assertIn('4 files', str(batch))
+
+        old_whitelist = options.get_whitelist_paths()
+        options.set_whitelist_paths([('file', paths[2])])
+        try:
+            # preview
+            self.assertEqual(list(batch.run(False, step=2)), [True, True])
+            self.assertEqual(list(batch.status),
+                             [DeleteBatch.DELETED, DeleteBatch.DELETED,
+                              DeleteBatch.SKIPPED, DeleteBatch.FAILED])
+            self.assertGreater(batch.sizes[0], 0)
+            self.assertIsInstance(batch.errors[3][1], OSError)
+            for path in paths:
+                self.assertExists(path)
+
+            # the results read like those of Delete
+            results = batch.execute(True)
+            for path in paths:
+                ret = results.next()
+                self.assertEqual(ret['path'], path)
+                self.assertEqual(ret.path, path)
+            self.assertEqual(ret['label'], DeleteBatch.labels()[DeleteBatch.SKIPPED])
+            self.assertEqual(ret['n_deleted'], 0)
+            self.assertRaises(OSError, results.next)
+        finally:
+            options.set_whitelist_paths(old_whitelist)
+        self.assertNotExists(paths[0])
+        self.assertNotExists(paths[1])
+        self.assertExists(paths[2])
+        self.assertFalse(hasattr(ret, '__dict__'))
+
     def test_Function(self):
         """Unit test for Function"""
         path = self.write_file('test_Function', b'foo')
@@ -26,10 +26,11 @@ Test case for module DeepScan
 from __future__ import absolute_import, print_function
 
 from tests import common
-from bleachbit.DeepScan import DeepScan, normalized_walk
+from bleachbit.DeepScan import DeepScan, ListingPool, combine_regexes, compile_prefilter, normalized_walk
 from bleachbit import expanduser
 
 import os
+import time
 
 
 class DeepScanTestCase(common.BleachbitTestCase):
@@ -91,6 +92,304 @@ class DeepScanTestCase(common.BleachbitTestCase):
                 continue
             self.assertLExists(ret)
 
+    def test_combine_regexes(self):
+        """Unit test for combine_regexes()"""
+        regexes = ['\.[Bb][Aa][Kk]$', '[a-zA-Z]{1,4}~$', '^Thumbs\.db$']
+        combined = combine_regexes(regexes)
+        for (filename, expected) in (('foo.bak', 0), ('foo~', 1), ('Thumbs.db', 2)):
+            match = combined.search(filename)
+            self.assertEqual(match.lastgroup, 's%d' % expected)
+        self.assertIsNone(combined.search('foo.txt'))
+        # groups inside a regex do not confuse the attribution
+        combined = combine_regexes(['^x', '(a)(b)$'])
+        self.assertEqual(combined.search('ab').lastgroup, 's1')
+        # these cannot be combined
+        self.assertIsNone(combine_regexes(['(a)\\1']))
+        self.assertIsNone(combine_regexes(['(?i)foo', 'bar']))
+        self.assertIsNone(combine_regexes(['a%d' % i for i in range(200)]))
+
+    def test_compile_prefilter(self):
+        """Unit test for compile_prefilter()"""
+        import re
+        names = ['Thumbs.db', 'thumbs.db', 'Thumbs.db\n', 'xThumbs.db', 'a.bak', 'a.BaK',
+                 'a.bak.txt', 'foo~', '~', '1~', '~wrl0001.tmp', 'ppt1234.tmp', '.DS_Store',
+                 'Makefile', u'caf\xe9.bak', 'caf\xc3\xa9~', '']
+        tests = (
+            # regexes, flags, whether there is a prefilter
+            (['^Thumbs\.db$'], 0, True),
+            (['^Thumbs\.db$'], re.IGNORECASE, True),
+            (['\.[Bb][Aa][Kk]$', '[a-zA-Z]{1,4}~$'], 0, True),
+            (['^~wr[a-z][0-9]{4}\.tmp$', '^ppt[0-9]{4}\.tmp$'], 0, True),
+            (['^(Thumbs\.db|\.DS_Store)$'], 0, False),
+            (['^Thumbs\.db$|\.bak\Z'], 0, True),
+            (['(?i)\.bak$'], 0, True),
+            (['\.bak$', 'Make'], 0, False),
+            (['^\.DS_Store$'], re.MULTILINE, False),
+            (['[a-z]$'], 0, False))
+        for (regexes, flags, has_prefilter) in tests:
+            prefilter = compile_prefilter(regexes, flags)
+            self.assertEqual(prefilter is not None, has_prefilter, regexes)
+            if prefilter is None:
+                continue
+            for name in names:
+                matches = any([re.search(regex, name, flags) for regex in regexes])
+                if matches:
+                    self.assertTrue(prefilter(name), (regexes, name))
+        prefilter = compile_prefilter(['\.[Bb][Aa][Kk]$', '^Thumbs\.db$'])
+        self.assertEqual([name for name in names if prefilter(name)],
+                         ['Thumbs.db', 'Thumbs.db\n', 'a.bak', 'a.BaK', u'caf\xe9.bak'])
+
+    def test_scan_matches(self):
+        """Each file is yielded once and attributed to its search"""
+        subdir = self.mkdtemp(prefix='bleachbit-test-scan-matches')
+        f_bak = self.write_file(os.path.join(subdir, 'foo.bak'))
+        f_both = self.write_file(os.path.join(subdir, 'foo.bak~'))
+        f_keep = self.write_file(os.path.join(subdir, 'foo.txt'))
+        for regexes in (['\.bak$', '~$', '\.bak'], ['(?i)\.BAK$', '~$', '\.bak']):
+            ds = DeepScan()
+            for regex in regexes:
+                ds.add_search(subdir, regex)
+            # duplicate searches are ignored
+            ds.add_search(subdir, regexes[0])
+            self.assertEqual(len(ds.searches[subdir]), 3)
+            matches = dict([ret for ret in ds.scan_matches() if ret != True])
+            self.assertEqual(sorted(matches.keys()), [f_bak, f_both])
+            self.assertNotIn(f_keep, matches)
+            self.assertEqual(matches[f_bak], regexes[0])
+            # either search that matched may be reported
+            self.assertIn(matches[f_both], regexes[1:])
+        import shutil
+        shutil.rmtree(subdir)
+
+    def test_nested_roots(self):
+        """Nested and duplicate roots are walked once"""
+        top = self.mkdtemp(prefix='bleachbit-test-nested')
+        subdir = os.path.join(top, 'sub')
+        os.mkdir(subdir)
+        f_top_bak = self.write_file(os.path.join(top, 'a.bak'))
+        f_top_tmp = self.write_file(os.path.join(top, 'a.tmp'))
+        f_sub_bak = self.write_file(os.path.join(subdir, 'b.bak'))
+        f_sub_tmp = self.write_file(os.path.join(subdir, 'b.tmp'))
+
+        ds = DeepScan()
+        ds.add_search(top, '\.bak$')
+        ds.add_search(top + os.sep, '\.bak$')
+        # the .tmp search applies only under subdir
+        ds.add_search(subdir, '\.tmp$')
+        if 'posix' == os.name:
+            # a link to the top is the same root
+            link = os.path.join(self.tempdir, 'bleachbit-test-nested-link')
+            os.symlink(top, link)
+            ds.add_search(link, '\.bak$')
+            # a link back up the tree does not cause a cycle
+            os.symlink(top, os.path.join(subdir, 'loop'))
+        plan = ds.plan()
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(os.path.realpath(plan[0][0]), os.path.realpath(top))
+        self.assertEqual(plan[0][1], ['\.bak$'])
+        self.assertEqual(list(plan[0][2].values()), [['\.bak$', '\.tmp$']])
+        self.assertFalse(plan[0][3])
+
+        matches = [ret[0] for ret in ds.scan_matches() if ret != True]
+        self.assertEqual(sorted(matches), sorted([f_top_bak, f_sub_bak, f_sub_tmp]))
+        self.assertNotIn(f_top_tmp, matches)
+
+        import shutil
+        if 'posix' == os.name:
+            os.unlink(link)
+        shutil.rmtree(top)
+
+    def test_workers(self):
+        """Parallel scans find the same files"""
+        top = self.mkdtemp(prefix='bleachbit-test-workers')
+        expected = []
+        for i in range(5):
+            subdir = os.path.join(top, 'd%d' % i)
+            os.mkdir(subdir)
+            for j in range(3):
+                os.mkdir(os.path.join(subdir, 's%d' % j))
+                expected.append(self.write_file(os.path.join(subdir, 's%d' % j, 'x.bak')))
+                self.write_file(os.path.join(subdir, 's%d' % j, 'x.txt'))
+        # a wide directory
+        for i in range(40):
+            os.mkdir(os.path.join(top, 'w%d' % i))
+
+        def scan(workers, ordered):
+            ds = DeepScan(workers=workers, ordered=ordered)
+            ds.add_search(top, '\.bak$')
+            return [ret for ret in ds.scan() if ret != True]
+
+        serial = scan(1, True)
+        self.assertEqual(sorted(serial), sorted(expected))
+        # the ordered parallel scan keeps the serial order, and reads
+        # ahead by a bounded number of directories
+        import bleachbit.DeepScan
+        outstanding = [0, 0]
+
+        class CountingPool(ListingPool):
+
+            def submit(self, job):
+                outstanding[0] += 1
+                outstanding[1] = max(outstanding)
+                ListingPool.submit(self, job)
+
+            def get(self, timeout):
+                ret = ListingPool.get(self, timeout)
+                if ret is not None:
+                    outstanding[0] -= 1
+                return ret
+        bleachbit.DeepScan.ListingPool = CountingPool
+        try:
+            self.assertEqual(scan(2, True), serial)
+        finally:
+            bleachbit.DeepScan.ListingPool = ListingPool
+        # at most the limit for each of the three levels, not the
+        # whole wide directory
+        self.assertLessEqual(outstanding[1], 3 * 2 * bleachbit.DeepScan.READ_AHEAD)
+        self.assertEqual(scan(4, True), serial)
+        self.assertEqual(sorted(scan(4, False)), sorted(expected))
+
+        # Stopping early stops the threads.
+        ds = DeepScan(workers=4)
+        ds.add_search(top, '\.bak$')
+        for ret in ds.scan():
+            if ret != True:
+                break
+
+        import shutil
+        shutil.rmtree(top)
+
+    def test_prune(self):
+        """Pruning policies skip subtrees"""
+        from bleachbit.DeepScan import PrunePolicy, mount_fstypes
+        top = self.mkdtemp(prefix='bleachbit-test-prune')
+        f_keep = self.write_file(os.path.join(top, 'a.bak'))
+        os.mkdir(os.path.join(top, '.git'))
+        f_git = self.write_file(os.path.join(top, '.git', 'b.bak'))
+
+        def scan(*policies):
+            ds = DeepScan()
+            for policy in policies:
+                ds.add_search(top, '\.bak$', policy=policy)
+            return sorted([ret for ret in ds.scan() if ret != True])
+
+        skip_git = PrunePolicy(dirnames='^\.git$')
+        self.assertEqual(scan(skip_git), [f_keep])
+        # the root itself is never pruned
+        self.assertEqual(scan(PrunePolicy(dirnames='^bleachbit-test-prune')),
+                         [f_git, f_keep])
+        # every search must agree to prune
+        self.assertEqual(scan(skip_git, None), [f_git, f_keep])
+        self.assertEqual(scan(skip_git, PrunePolicy(dirnames='^\.(git|svn)$')), [f_keep])
+
+        # a root under a pruned directory is still searched, on its own
+        sub = os.path.join(top, '.git', 'sub')
+        os.mkdir(sub)
+        self.write_file(os.path.join(sub, 'c.bak'))
+        f_sub_tmp = self.write_file(os.path.join(sub, 'c.tmp'))
+        os.mkdir(os.path.join(top, 'other'))
+        for (other, expected) in ((False, [f_keep, f_sub_tmp]),
+                                  (True, [f_git, f_keep, f_sub_tmp])):
+            ds = DeepScan()
+            ds.add_search(top, '\.bak$', policy=skip_git)
+            ds.add_search(sub, '\.tmp$')
+            if other:
+                # A root without a policy joins the outer walk, which
+                # then enters .git, but still leaves sub to its own walk.
+                ds.add_search(os.path.join(top, 'other'), '\.bak$')
+            self.assertEqual(len(ds.plan()), 2)
+            self.assertEqual(sorted([ret for ret in ds.scan() if ret != True]),
+                             sorted(expected))
+
+        # file system type and device
+        mountinfo = self.write_file('mountinfo',
+                                    '22 1 0:20 / /proc rw,nosuid shared:12 - proc proc rw\n'
+                                    '23 1 8:1 / / rw master:1 - ext4 /dev/sda1 rw\n')
+        fstypes = mount_fstypes(mountinfo)
+        self.assertEqual(fstypes[os.makedev(0, 20)], 'proc')
+        self.assertEqual(fstypes[os.makedev(8, 1)], 'ext4')
+        self.assertEqual(mount_fstypes(os.path.join(top, 'missing')), {})
+
+        class MockStat:
+            st_dev = os.makedev(0, 20)
+        policy = PrunePolicy(fstypes=['proc'])
+        self.assertEqual(policy.reason('/proc', MockStat, MockStat.st_dev, fstypes),
+                         'file system type proc')
+        self.assertEqual(PrunePolicy().reason('/proc', MockStat, 1, fstypes), None)
+        self.assertEqual(PrunePolicy(True).reason('/proc', MockStat, 1, fstypes),
+                         'another file system')
+        self.assertEqual(PrunePolicy(True).reason('/proc', MockStat, MockStat.st_dev, fstypes),
+                         None)
+
+        import shutil
+        shutil.rmtree(top)
+
+    def test_index(self):
+        """Unchanged directories are served from the index"""
+        from bleachbit.DeepScan import DeepScanIndex
+        top = self.mkdtemp(prefix='bleachbit-test-index')
+        subdir = os.path.join(top, 'sub')
+        os.mkdir(subdir)
+        f_top = self.write_file(os.path.join(top, 'a.bak'))
+        f_sub = self.write_file(os.path.join(subdir, 'b.bak'))
+        self.write_file(os.path.join(subdir, 'b.txt'))
+        # the index skips directories changed in the last two seconds
+        old = time.time() - 60
+        for dirname in (top, subdir):
+            os.utime(dirname, (old, old))
+        index_path = os.path.join(self.tempdir, 'deepscan.index')
+
+        def scan(cache=True, max_entries=100):
+            index = DeepScanIndex(index_path, max_entries)
+            ds = DeepScan(index)
+            ds.add_search(top, '\.bak$', cache)
+            return (sorted([ret for ret in ds.scan() if ret != True]), index)
+
+        (matches, index) = scan()
+        self.assertEqual(matches, [f_top, f_sub])
+        self.assertExists(index_path)
+        self.assertEqual(index.run, 1)
+
+        # The second scan must not list the directories again.
+        import bleachbit.DeepScan
+        real_listdir = bleachbit.DeepScan.normalized_listdir
+        listed = []
+
+        def mock_listdir(dirpath):
+            listed.append(dirpath)
+            return real_listdir(dirpath)
+        bleachbit.DeepScan.normalized_listdir = mock_listdir
+        try:
+            (matches, index) = scan()
+            self.assertEqual(matches, [f_top, f_sub])
+            self.assertEqual(listed, [])
+            self.assertEqual(index.run, 2)
+
+            # A changed directory is listed again.
+            f_sub2 = self.write_file(os.path.join(subdir, 'c.bak'))
+            os.utime(subdir, (old + 1, old + 1))
+            (matches, index) = scan()
+            self.assertEqual(matches, [f_top, f_sub, f_sub2])
+            self.assertEqual(listed, [subdir])
+
+            # Without cache="true" the index is not used.
+            del listed[:]
+            (matches, index) = scan(False)
+            self.assertEqual(matches, [f_top, f_sub, f_sub2])
+            self.assertEqual(sorted(listed), sorted([top, subdir]))
+        finally:
+            bleachbit.DeepScan.normalized_listdir = real_listdir
+
+        # The index is capped.
+        (matches, index) = scan(max_entries=1)
+        self.assertEqual(matches, [f_top, f_sub, f_sub2])
+        index = DeepScanIndex(index_path)
+        index.load()
+        self.assertEqual(sum([len(t) for t in index.tables.values()]), 1)
+
+        import shutil
+        shutil.rmtree(top)
+
     def test_delete(self):
         """Delete files in a test environment"""
 
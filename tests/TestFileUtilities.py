@@ -31,6 +31,7 @@ from bleachbit.Options import options
 from bleachbit import expanduser, expandvars, logger
 
 import json
+import logging
 import sys
 import unittest
 
@@ -107,6 +108,37 @@ def test_json_helper(self, execute):
     self.assertNotExists(filename)
 
 
+def benchmark_delete_order(n_files=100000):
+    """Measure how fast deleting a directory is in name and inode order"""
+    import shutil
+    import tempfile
+    import time
+    from bleachbit.Command import DeleteTree
+    print('benchmark of deleting %d files' % n_files)
+    # do not log each file, and delete without shredding
+    logging.getLogger('bleachbit.Command').setLevel(logging.INFO)
+    options.set('shred', False, commit=False)
+    rates = {}
+    for (order, buffer_size) in (('name', 0), ('inode', 8192)):
+        dirname = tempfile.mkdtemp(prefix='bleachbit-delete-order-bench')
+        for x in range(0, n_files):
+            common.touch_file(os.path.join(dirname, str(x)))
+        # ext4 and XFS list large directories in the order of
+        # a hash of the names, not of the inodes
+        os.system('sync')
+        set_inode_order(buffer_size)
+        start = time.time()
+        for _dummy in DeleteTree(dirname).execute(True):
+            pass
+        elapsed_seconds = time.time() - start
+        set_inode_order(0)
+        rates[order] = n_files / elapsed_seconds
+        print('order %s: elapsed: %.2f seconds, %.2f files/second' %
+              (order, elapsed_seconds, rates[order]))
+        shutil.rmtree(dirname)
+    return rates
+
+
 class FileUtilitiesTestCase(common.BleachbitTestCase):
     """Test case for module FileUtilities"""
 
@@ -200,6 +232,31 @@ class FileUtilitiesTestCase(common.BleachbitTestCase):
             raise AssertionError('Found a file that shouldn\'t have been found: ' + filename)
         os.rmdir(subdirname)
 
+        # test pruning: a pruned subdirectory is neither listed nor walked
+        keepdir = os.path.join(dirname, 'keep')
+        deldir = os.path.join(dirname, 'del')
+        keepfile = os.path.join(keepdir, 'sub', 'file')
+        delfile = os.path.join(deldir, 'sub', 'file')
+        common.touch_file(keepfile)
+        common.touch_file(delfile)
+        pruned = []
+
+        def prune(path):
+            pruned.append(path)
+            return path == keepdir
+        children = list(children_in_directory(dirname, True, prune))
+        self.assertEqual(children, [os.path.join(deldir, 'sub', 'file'),
+                                    os.path.join(deldir, 'sub'), deldir])
+        self.assertNotIn(os.path.join(keepdir, 'sub'), pruned)
+        # a trailing separator does not change the order
+        children = list(children_in_directory(dirname + os.sep, True, prune))
+        self.assertEqual([os.path.normpath(p) for p in children],
+                         [os.path.join(deldir, 'sub', 'file'),
+                          os.path.join(deldir, 'sub'), deldir])
+        import shutil
+        shutil.rmtree(keepdir)
+        shutil.rmtree(deldir)
+
         os.rmdir(dirname)
 
     def test_clean_ini(self):
@@ -231,6 +288,122 @@ class FileUtilitiesTestCase(common.BleachbitTestCase):
         # exercise ignore_missing
         delete('does-not-exist', ignore_missing=True)
         self.assertRaises(OSError, delete, 'does-not-exist')
+        if start_unlinker():
+            print("testing delete() with unlinkat()")
+            try:
+                self.delete_helper(shred=False)
+                delete('does-not-exist', ignore_missing=True)
+                self.assertRaises(OSError, delete, 'does-not-exist')
+            finally:
+                stop_unlinker()
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'skipping on non-Linux platform')
+    def test_UnlinkAt(self):
+        """Unit test for class UnlinkAt"""
+        import errno
+
+        def parent_dir(dirname):
+            st = os.stat(dirname)
+            return ParentDir(dirname, (st.st_dev, st.st_ino))
+
+        unlinker = UnlinkAt(max_open=2)
+        top = self.mkdtemp(prefix='bleachbit-test-unlinkat')
+        dirs = [os.path.join(top, str(i)) for i in range(3)]
+        parents = []
+        for dirname in dirs:
+            os.mkdir(dirname)
+            parents.append(parent_dir(dirname))
+            for name in ('a', u'\u2014b'):
+                unlinker.remove(self.write_file(os.path.join(dirname, name)),
+                                parents[-1])
+            self.assertEqual(os.listdir(dirname), [])
+        # only the most recently opened directories stay open
+        self.assertEqual(list(unlinker.open_dirs.keys()), parents[1:])
+        self.assertIsNone(parents[0].fd)
+
+        # an open directory is used even after it was moved, so the
+        # path is not looked up again
+        moved = os.path.join(top, 'moved')
+        os.rename(dirs[2], moved)
+        os.mkdir(dirs[2])
+        self.write_file(os.path.join(moved, 'c'))
+        unlinker.remove(self.write_file(os.path.join(dirs[2], 'c')), parents[2])
+        self.assertEqual(os.listdir(moved), [])
+        self.assertEqual(os.listdir(dirs[2]), ['c'])
+
+        # a directory replaced before it was opened is not used
+        unlinker.release(parents[2])
+        unlinker.remove(os.path.join(dirs[2], 'c'), parents[2])
+        self.assertEqual(os.listdir(dirs[2]), [])
+        self.assertEqual(parents[2].fd, -1)
+        unlinker.rmdir(moved, parent_dir(top))
+
+        # the same errors as os.remove() and os.rmdir()
+        missing = os.path.join(dirs[0], 'missing')
+        with self.assertRaises(OSError) as cm:
+            unlinker.remove(missing, parents[0])
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+        self.assertEqual(cm.exception.filename, missing)
+        with self.assertRaises(OSError) as cm:
+            unlinker.remove(os.path.join(missing, 'child'),
+                            ParentDir(missing, (0, 0)))
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+        with self.assertRaises(OSError) as cm:
+            unlinker.rmdir(top, parent_dir(os.path.dirname(top)))
+        self.assertEqual(cm.exception.errno, errno.ENOTEMPTY)
+
+        # a directory without read permission still works, and so
+        # does a path without a directory
+        f_d = self.write_file(os.path.join(dirs[0], 'd'))
+        f_e = self.write_file(os.path.join(dirs[0], 'e'))
+        os.chmod(dirs[0], 0o333)
+        try:
+            unlinker.remove(f_d, parent_dir(dirs[0]))
+        finally:
+            os.chmod(dirs[0], 0o755)
+        unlinker.remove(f_e)
+        self.assertNotExists(f_d)
+        self.assertNotExists(f_e)
+
+        parent = parent_dir(top)
+        for dirname in dirs:
+            unlinker.rmdir(dirname, parent)
+        unlinker.rmdir(top)
+        self.assertNotExists(top)
+        unlinker.close()
+        self.assertEqual(list(unlinker.open_dirs.keys()), [])
+        self.assertIsNone(parent.fd)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'skipping on non-Linux platform')
+    def test_walk_entries_unlinker(self):
+        """Unit test for walk_entries() with unlinker active"""
+        import bleachbit.FileUtilities as FileUtilities
+        top = self.mkdtemp(prefix='bleachbit-test-walk')
+        os.mkdir(os.path.join(top, 'a'))
+        self.write_file(os.path.join(top, 'a', 'b'))
+        self.write_file(os.path.join(top, 'c'))
+        if not start_unlinker():
+            self.skipTest('no unlinkat()')
+        shred = options.get('shred')
+        options.set('shred', False, commit=False)
+        try:
+            for (dirpath, dirs, files) in walk_entries(top):
+                st = os.stat(dirpath)
+                for entry in dirs + files:
+                    self.assertEqual(entry.parent.path, dirpath)
+                    self.assertEqual(entry.parent.identity,
+                                     (st.st_dev, st.st_ino))
+                    delete(entry.path, entry=entry)
+                # the directory was opened, and is closed once the
+                # walk moves on
+                self.assertGreaterEqual(entry.parent.fd, 0)
+            self.assertIsNone(entry.parent.fd)
+            self.assertEqual(FileUtilities.unlinker.open_dirs.keys(), [])
+        finally:
+            options.set('shred', shred, commit=False)
+            stop_unlinker()
+        self.assertEqual(os.listdir(top), [])
+        os.rmdir(top)
 
     def delete_helper(self, shred):
         """Called by test_delete() with shred = False and = True"""
@@ -436,6 +609,53 @@ class FileUtilitiesTestCase(common.BleachbitTestCase):
         if 'nt' == os.name:
             expand_glob_join('c:\windows', '*.exe')
 
+    def test_GlobCache(self):
+        """Unit test for GlobCache and iglob()"""
+        top = self.mkdtemp(prefix='bleachbit-test-glob')
+        os.mkdir(os.path.join(top, 'a'))
+        f_1 = self.write_file(os.path.join(top, 'a', '1.log'))
+        other = self.mkdtemp(prefix='bleachbit-test-glob-other')
+        import bleachbit.FileUtilities
+        pattern = os.path.join(top, '*', '*.log')
+        other_pattern = os.path.join(other, '*')
+
+        start_glob_cache()
+        try:
+            self.assertEqual(list(iglob(pattern)), [f_1])
+            self.assertEqual(list(iglob(other_pattern)), [])
+            # served from the cache
+            f_2 = self.write_file(os.path.join(top, 'a', '2.log'))
+            self.assertEqual(list(iglob(pattern)), [f_1])
+            self.assertEqual(expand_path('~'), expanduser('~'))
+
+            # A deletion under the fixed directory drops the result.
+            bleachbit.FileUtilities.glob_cache.deleted(f_1)
+            os.remove(f_1)
+            self.assertEqual(list(iglob(pattern)), [f_2])
+            self.assertIn(other_pattern, bleachbit.FileUtilities.glob_cache.globs)
+            # so does deleting a parent of the fixed directory
+            bleachbit.FileUtilities.glob_cache.deleted(os.path.dirname(top))
+            self.assertNotIn(pattern, bleachbit.FileUtilities.glob_cache.globs)
+            self.assertNotIn(other_pattern, bleachbit.FileUtilities.glob_cache.globs)
+        finally:
+            stop_glob_cache()
+        self.assertIsNone(bleachbit.FileUtilities.glob_cache)
+
+        # a pattern without wildcards changes only when its path does
+        start_glob_cache()
+        try:
+            self.assertEqual(list(iglob(top)), [top])
+            bleachbit.FileUtilities.glob_cache.deleted(f_2)
+            self.assertIn(top, bleachbit.FileUtilities.glob_cache.globs)
+            bleachbit.FileUtilities.glob_cache.deleted(top)
+            self.assertNotIn(top, bleachbit.FileUtilities.glob_cache.globs)
+        finally:
+            stop_glob_cache()
+
+        import shutil
+        shutil.rmtree(top)
+        shutil.rmtree(other)
+
     def test_expandvars(self):
         """Unit test for expandvars()."""
         expanded = expandvars('$HOME')
@@ -567,6 +787,71 @@ class FileUtilitiesTestCase(common.BleachbitTestCase):
             path = 'c:\\windows\\system32'
         self.assertGreater(getsizedir(path), 0)
 
+    @unittest.skipUnless('posix' == os.name, 'skipping on non-POSIX platform')
+    def test_prefetch_lstat(self):
+        """Unit test for prefetch_lstat()"""
+        from bleachbit.Command import Delete, Function
+        dirname = self.mkdtemp(prefix='bleachbit-test-prefetch')
+        commands = []
+        for i in range(10):
+            commands.append(Delete(self.write_file(os.path.join(dirname, str(i)), 'x')))
+        commands.append(Delete(os.path.join(dirname, 'missing')))
+        commands.append(Function(None, lambda: 0, 'function'))
+        for workers in (1, 3):
+            for cmd in commands[:11]:
+                cmd.entry = None
+            pool = start_stat_pool(workers)
+            try:
+                ret = list(prefetch_lstat(iter(commands), pool, batch_size=4))
+            finally:
+                stop_stat_pool()
+            self.assertEqual(ret, commands)
+            if 1 == workers:
+                self.assertIsNone(pool)
+                self.assertTrue(all(cmd.entry is None for cmd in commands[:11]))
+                continue
+            for cmd in commands[:10]:
+                self.assertEqual(cmd.entry.lstat(), os.lstat(cmd.path))
+                self.assertEqual(getsize(cmd.path, cmd.entry), getsize(cmd.path))
+            # the missing file is looked up again by getsize()
+            self.assertRaises(OSError, commands[10].entry.lstat)
+        import shutil
+        shutil.rmtree(dirname)
+
+    def test_inode_order(self):
+        """Unit test for inode_order()"""
+        import collections
+        fake_stat = collections.namedtuple('fake_stat', 'st_ino')
+
+        def entries(spec):
+            return [PathEntry(path, lstat=fake_stat(ino)) for (path, ino) in spec]
+
+        def paths(ret):
+            return [entry.path for entry in ret]
+        spec = [('/a/x', 9), ('/a/y', 3), ('/a/z', 5), ('/b/x', 2), ('/b/y', 1), ('/a', 4)]
+        # listing order
+        self.assertEqual(paths(inode_order(entries(spec), 0)),
+                         [path for (path, _ino) in spec])
+        # sorted within each directory, but not across directories
+        self.assertEqual(paths(inode_order(entries(spec), 100)),
+                         ['/a/y', '/a/z', '/a/x', '/b/y', '/b/x', '/a'])
+        # a bounded buffer
+        self.assertEqual(paths(inode_order(entries(spec), 2)),
+                         ['/a/y', '/a/x', '/a/z', '/b/y', '/b/x', '/a'])
+        # an entry that cannot be looked up comes first
+        present = PathEntry(self.write_file('bleachbit-test-inode-order'))
+        missing = PathEntry(os.path.join(self.tempdir, 'missing'))
+        ret = list(inode_order([present, missing], 10))
+        self.assertEqual(ret[0], missing)
+        # the default comes from set_inode_order()
+        self.assertEqual(paths(inode_order(entries(spec))),
+                         [path for (path, _ino) in spec])
+        set_inode_order(100)
+        try:
+            self.assertEqual(paths(inode_order(entries(spec)))[0], '/a/y')
+        finally:
+            set_inode_order(0)
+
     def test_globex(self):
         """Unit test for method globex()"""
         for path in globex('/bin/*', '/ls$'):
@@ -710,6 +995,83 @@ class FileUtilitiesTestCase(common.BleachbitTestCase):
         self.assertEqual(
             set(old_whitelist), set(options.get_whitelist_paths()))
 
+    def test_PathEntry(self):
+        """Unit test for class PathEntry"""
+        dirname = self.mkdtemp(prefix='bleachbit-test-pathentry')
+        filename = self.write_file(os.path.join(dirname, 'file'), 'abc')
+        subdir = os.path.join(dirname, 'sub')
+        os.mkdir(subdir)
+
+        entries = dict((entry.path, entry) for entry in children_entries(dirname, True))
+        self.assertEqual(set(entries.keys()), set([filename, subdir]))
+        self.assertTrue(entries[filename].is_file())
+        self.assertFalse(entries[filename].is_dir())
+        self.assertTrue(entries[subdir].is_dir())
+        self.assertFalse(entries[subdir].is_file())
+        self.assertFalse(entries[filename].is_symlink())
+        self.assertEqual(getsize(filename, entries[filename]), getsize(filename))
+
+        # the lstat() result is cached
+        entry = PathEntry(filename)
+        self.assertIs(entry.lstat(), entry.lstat())
+
+        # delete() uses the cached entry
+        delete(filename, entry=entries[filename])
+        self.assertNotExists(filename)
+        delete(subdir, entry=entries[subdir])
+        self.assertNotExists(subdir)
+        delete(filename, ignore_missing=True, entry=PathEntry(filename))
+        self.assertRaises(OSError, delete, filename, entry=PathEntry(filename))
+
+        if 'posix' == os.name:
+            linkname = os.path.join(dirname, 'link')
+            os.symlink(dirname, linkname)
+            entry = PathEntry(linkname)
+            self.assertTrue(entry.is_symlink())
+            self.assertTrue(entry.is_dir())
+            # a symlink to a directory is listed but not followed
+            self.assertEqual(list(children_in_directory(dirname, True)), [linkname])
+            os.remove(linkname)
+
+        os.rmdir(dirname)
+
+    def test_WhitelistIndex(self):
+        """Unit test for class WhitelistIndex"""
+        sep = os.sep
+        whitelist = [('file', sep.join(['', 'Home', 'foo'])),
+                     ('folder', sep.join(['', 'Home', 'folder']))]
+        for case_sensitive in (True, False):
+            index = WhitelistIndex(whitelist, case_sensitive)
+            self.assertEqual(len(index), 2)
+            self.assertTrue(index.match(sep.join(['', 'Home', 'foo'])))
+            self.assertFalse(index.match(sep.join(['', 'Home', 'foo', 'bar'])))
+            self.assertTrue(index.match(sep.join(['', 'Home', 'folder'])))
+            self.assertTrue(index.match(sep.join(['', 'Home', 'folder', 'a', 'b'])))
+            self.assertFalse(index.match(sep.join(['', 'Home', 'folder2'])))
+            self.assertFalse(index.match(sep.join(['', 'Home'])))
+            self.assertEqual(not case_sensitive,
+                             index.match(sep.join(['', 'HOME', 'FOLDER', 'a'])))
+            # whether anything at or below a path is whitelisted
+            self.assertTrue(index.overlaps(sep.join(['', 'Home'])))
+            self.assertTrue(index.overlaps(sep.join(['', 'Home', 'folder', 'a'])))
+            self.assertFalse(index.overlaps(sep.join(['', 'Home', 'fo'])))
+            self.assertFalse(index.overlaps(sep.join(['', 'Other'])))
+
+        # empty index
+        index = WhitelistIndex([])
+        self.assertFalse(index)
+        self.assertFalse(index.match(sep.join(['', 'Home', 'foo'])))
+
+        # the cached index is rebuilt when the whitelist changes
+        old_whitelist = options.get_whitelist_paths()
+        options.set_whitelist_paths(whitelist)
+        index = get_whitelist_index()
+        self.assertIs(index, get_whitelist_index())
+        options.set_whitelist_paths([])
+        self.assertIsNot(index, get_whitelist_index())
+        self.assertFalse(get_whitelist_index())
+        options.set_whitelist_paths(old_whitelist)
+
     @unittest.skipUnless('posix' == os.name, 'skipping on non-POSIX platform')
     def test_whitelisted_posix_symlink(self):
         """Symlink test for whitelisted_posix()"""
@@ -893,6 +1255,19 @@ class FileUtilitiesTestCase(common.BleachbitTestCase):
                          time.time() - openfiles.last_scan_time,
                          openfiles.files))
 
+        # an unchanged descriptor is not read again
+        if sys.platform.startswith('linux'):
+            link = '/proc/%d/fd/%d' % (os.getpid(), f.fileno())
+            links = []
+            _readlink = os.readlink
+            os.readlink = lambda path: links.append(path) or _readlink(path)
+            try:
+                openfiles.scan()
+            finally:
+                os.readlink = _readlink
+            self.assertNotIn(link, links)
+            self.assertTrue(openfiles.is_open(filename))
+
         f.close()
         openfiles.scan()
         self.assertFalse(openfiles.is_open(filename))
@@ -901,5 +1276,27 @@ class FileUtilitiesTestCase(common.BleachbitTestCase):
         openfiles.scan()
         self.assertFalse(openfiles.is_open(filename))
 
+        # the same file by another name, and an explicit refresh
+        f = open(filename, 'w')
+        link = os.path.join(self.tempdir, 'bleachbit-test-open-files-link')
+        os.symlink(filename, link)
+        self.assertFalse(openfiles.is_open(link))
+        openfiles.refresh()
+        self.assertTrue(openfiles.is_open(link))
+        self.assertIn(os.path.realpath(filename), openfiles.files)
+        f.close()
+        os.unlink(link)
+        os.unlink(filename)
+
     def test_open_files_lsof(self):
         self.assertEqual(list(open_files_lsof(lambda: 'n/bar/foo\nn/foo/bar\nnoise')), ['/bar/foo', '/foo/bar'])
+
+
+if __name__ == '__main__':
+    if 1 < len(sys.argv) and 'benchmark' == sys.argv[1]:
+        n_files = 100000
+        if 3 == len(sys.argv):
+            n_files = int(sys.argv[2])
+        benchmark_delete_order(n_files)
+        sys.exit()
+    unittest.main()
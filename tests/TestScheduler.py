@@ -0,0 +1,155 @@
+# vim: ts=4:sw=4:expandtab
+# -*- coding: UTF-8 -*-
+
+# BleachBit
+# Copyright (C) 2008-2018 Andrew Ziem
+# https://www.bleachbit.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Test case for module Scheduler
+"""
+
+from __future__ import absolute_import, print_function
+
+from tests import common
+from bleachbit import Scheduler
+from bleachbit.Command import DeleteBatch
+from bleachbit.Options import options
+
+import os
+import threading
+import time
+import unittest
+
+
+@unittest.skipUnless('posix' == os.name, 'skipping on non-POSIX platform')
+class SchedulerTestCase(common.BleachbitTestCase):
+
+    """Test case for module Scheduler"""
+
+    def make_sysfs(self):
+        """Make a /sys/dev/block with a disk, its partition and an SSD"""
+        top = self.mkdtemp(prefix='bleachbit-test-sysfs')
+        sysfs = os.path.join(top, 'dev')
+        os.mkdir(sysfs)
+        for (name, rotational) in (('sda', '1'), ('nvme0n1', '0')):
+            os.makedirs(os.path.join(top, 'block', name, 'queue'))
+            self.write_file(os.path.join(top, 'block', name, 'queue', 'rotational'),
+                            rotational + '\n')
+        os.mkdir(os.path.join(top, 'block', 'sda', 'sda1'))
+        os.symlink(os.path.join(top, 'block', 'sda'), os.path.join(sysfs, '8:0'))
+        os.symlink(os.path.join(top, 'block', 'sda', 'sda1'), os.path.join(sysfs, '8:1'))
+        os.symlink(os.path.join(top, 'block', 'nvme0n1'), os.path.join(sysfs, '259:0'))
+        return sysfs
+
+    def test_device_class(self):
+        """Unit test for device_class()"""
+        sysfs = self.make_sysfs()
+        fstypes = {os.makedev(0, 50): 'nfs4', os.makedev(8, 1): 'ext4'}
+        tests = (((8, 0), 'rotational'),
+                 ((8, 1), 'rotational'),
+                 ((259, 0), 'ssd'),
+                 ((0, 50), 'network'),
+                 ((0, 51), 'unknown'))
+        for ((major, minor), expected) in tests:
+            self.assertEqual(Scheduler.device_class(os.makedev(major, minor), fstypes, sysfs),
+                             expected)
+
+    def test_DeviceScheduler(self):
+        """Unit test for DeviceScheduler"""
+        sysfs = self.make_sysfs()
+        disk = os.makedev(8, 1)
+        ssd = os.makedev(259, 0)
+        scheduler = Scheduler.DeviceScheduler(4, {}, sysfs)
+        self.assertEqual(scheduler.limit(disk), 1)
+        self.assertEqual(scheduler.limit(ssd), 4)
+        self.assertEqual(scheduler.limit(None), 2)
+
+        lock = threading.Lock()
+        running = {disk: 0, ssd: 0}
+        most = {disk: 0, ssd: 0}
+        done = []
+
+        def func(item):
+            with lock:
+                running[item[0]] += 1
+                most[item[0]] = max(most[item[0]], running[item[0]])
+            time.sleep(0.01)
+            with lock:
+                running[item[0]] -= 1
+                done.append(item)
+        items = [(disk if i % 2 else ssd, i) for i in range(40)]
+        for dummy in scheduler.run(items, lambda item: item[0], func, 0.01):
+            pass
+        self.assertEqual(sorted(done), sorted(items))
+        self.assertEqual(most[disk], 1)
+        self.assertGreater(most[ssd], 1)
+        self.assertLessEqual(most[ssd], 4)
+
+        # closing the generator stops early
+        del done[:]
+        run = scheduler.run(items, lambda item: item[0], func, 0.01)
+        run.next()
+        run.close()
+        self.assertLess(len(done), len(items))
+        self.assertEqual(scheduler.left, 0)
+        scheduler.close()
+        self.assertEqual(scheduler.threads, [])
+
+    def test_DeleteBatch(self):
+        """DeleteBatch deletes with the active scheduler"""
+        dirname = self.mkdtemp(prefix='bleachbit-test-scheduler')
+        batch = DeleteBatch()
+        for i in range(20):
+            batch.append(self.write_file(os.path.join(dirname, str(i)), 'x'))
+        batch.append(os.path.join(dirname, 'missing'))
+        self.assertIsNone(Scheduler.start_scheduler(1))
+        self.assertIsNotNone(Scheduler.start_scheduler(3))
+        try:
+            for dummy in batch.run(True):
+                pass
+        finally:
+            Scheduler.stop_scheduler()
+        self.assertIsNone(Scheduler.scheduler)
+        self.assertEqual(list(batch.status), [DeleteBatch.DELETED] * 20 + [DeleteBatch.FAILED])
+        self.assertEqual(os.listdir(dirname), [])
+        os.rmdir(dirname)
+
+    def test_DeleteBatch_dirs(self):
+        """A directory in a DeleteBatch waits for its children"""
+        top = self.mkdtemp(prefix='bleachbit-test-scheduler')
+        batch = DeleteBatch()
+        for i in range(100):
+            subdir = os.path.join(top, str(i))
+            os.mkdir(subdir)
+            for name in ('a', 'b'):
+                batch.append(self.write_file(os.path.join(subdir, name), 'x'))
+            batch.append(subdir)
+        scheduler = Scheduler.start_scheduler(4)
+        # as if the temporary directory were on an SSD
+        scheduler.limits[os.lstat(top).st_dev] = 4
+        old_shred = options.get('shred')
+        options.set('shred', False, commit=False)
+        try:
+            for dummy in batch.run(True):
+                pass
+        finally:
+            Scheduler.stop_scheduler()
+            options.set('shred', old_shred, commit=False)
+        self.assertEqual(list(batch.status), [DeleteBatch.DELETED] * 300)
+        self.assertEqual(os.listdir(top), [])
+        os.rmdir(top)
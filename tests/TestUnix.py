@@ -104,6 +104,14 @@ root               531   0.0  0.0  2501712    588   ??  Ss   20May16   0:02.40 s
         self.assertTrue(is_running(exe))
         self.assertFalse(is_running('does-not-exist'))
 
+    def test_running_exenames(self):
+        """Unit test for running_exenames()"""
+        exe = os.path.basename(os.path.realpath(sys.executable))
+        names = running_exenames()
+        self.assertIsInstance(names, set)
+        self.assertIn(exe, names)
+        self.assertNotIn('does-not-exist', names)
+
     def test_journald_clean(self):
         if not FileUtilities.exe_exists('journalctl'):
             self.assertRaises(RuntimeError, journald_clean)
@@ -26,16 +26,57 @@ Test case for module Worker
 from __future__ import absolute_import, print_function
 
 from tests import TestCleaner, common
-from bleachbit import CLI, Command
+from bleachbit import CLI, Command, FileUtilities
 from bleachbit.Action import ActionProvider
 from bleachbit.Worker import *
 from bleachbit import expanduser
 
 import os
+import sys
 import tempfile
 import unittest
 
 
+def benchmark_execute(n_files=20000):
+    """Measure the overhead per file of Worker.execute() and of
+    Worker.execute_file() while previewing"""
+    import shutil
+    import time
+    print('benchmark of previewing %d files' % n_files)
+    dirname = tempfile.mkdtemp(prefix='bleachbit-worker-bench')
+    paths = []
+    for x in range(0, n_files):
+        paths.append(os.path.join(dirname, str(x)))
+        common.touch_file(paths[-1])
+
+    def generic(worker, cmd):
+        # the loop of clean_operation() before the fast path
+        for _ret in worker.execute(cmd, 'bench.files'):
+            pass
+        time.time()
+
+    def fused(worker, cmd):
+        worker.execute_file(cmd, 'bench.files')
+    ui = CLI.CliCallback()
+    ui.append_text = lambda msg, tag=None: None
+    rates = {}
+    for (name, func, quiet) in (('execute', generic, False),
+                                ('execute_file', fused, False),
+                                ('execute_file quiet', fused, True)):
+        ui.quiet = quiet
+        worker = Worker(ui, False, {'bench': ['files']})
+        commands = [Command.Delete(path) for path in paths]
+        start = time.time()
+        for cmd in commands:
+            func(worker, cmd)
+        elapsed_seconds = time.time() - start
+        rates[name] = n_files / elapsed_seconds
+        print('%s: %.2f microseconds/file, %.2f files/second' %
+              (name, 1e6 * elapsed_seconds / n_files, rates[name]))
+    shutil.rmtree(dirname)
+    return rates
+
+
 class AccessDeniedActionAction(ActionProvider):
     action_key = 'access.denied'
 
@@ -288,7 +329,10 @@ class WorkerTestCase(common.BleachbitTestCase):
         parent = self
 
         class MyDeepScan:
-            def add_search(self, dirname, regex):
+            def __init__(self, workers=1, ordered=True):
+                pass
+
+            def add_search(self, dirname, regex, cache=False, policy=None):
                 parent.assertEqual(dirname, expanduser('~'))
                 parent.assertIn(regex, ['^Thumbs\\.db$', '^Thumbs\\.db:encryptable$'])
 
@@ -329,3 +373,450 @@ class WorkerTestCase(common.BleachbitTestCase):
         self.assertEqual(worker.total_special, 0)
         self.assertEqual(worker.total_errors, 0)
         self.assertEqual(worker.total_deleted, 2)
+
+    def test_close(self):
+        """Closing a run early resets the run-wide state"""
+        from bleachbit.Options import options
+        from bleachbit import Action, Scheduler
+        filename = self.mkstemp(prefix='bleachbit-test-worker')
+        astr = '<action command="delete" search="file" path="%s"/>' % filename
+        backends['test'] = TestCleaner.action_to_cleaner(astr)
+        old_jobs = options.get('jobs')
+        options.set('jobs', 2, commit=False)
+        try:
+            run = Worker(CLI.CliCallback(), True, {'test': ['option1']}).run()
+            run.next()
+            self.assertIsNotNone(FileUtilities.glob_cache)
+            self.assertIsNotNone(Action.batch_size)
+            run.close()
+        finally:
+            options.set('jobs', old_jobs, commit=False)
+        self.assertIsNone(FileUtilities.glob_cache)
+        self.assertIsNone(FileUtilities.unlinker)
+        self.assertIsNone(Action.batch_size)
+        self.assertIsNone(Scheduler.scheduler)
+
+        # a preview keeps one pool of threads for the whole run
+        old_workers = options.get('preview_workers')
+        options.set('preview_workers', 2, commit=False)
+        try:
+            run = Worker(CLI.CliCallback(), False, {'test': ['option1']}).run()
+            run.next()
+            self.assertIsNotNone(FileUtilities.stat_pool)
+            run.close()
+        finally:
+            options.set('preview_workers', old_workers, commit=False)
+        self.assertIsNone(FileUtilities.stat_pool)
+
+    def test_PreviewPlan(self):
+        """Clean what a preview found without searching again"""
+        from bleachbit.Options import options
+        ui = CLI.CliCallback()
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-plan')
+        keep = self.write_file(os.path.join(dirname, 'keep'), '1')
+        same = self.write_file(os.path.join(dirname, 'same'), '1')
+        changed = self.write_file(os.path.join(dirname, 'changed'), '1')
+        gone = self.write_file(os.path.join(dirname, 'gone'), '1')
+        astr = '<action command="delete" search="glob" path="%s" regex="^[scg]"/>' % \
+            os.path.join(dirname, '*')
+        cleaner = TestCleaner.action_to_cleaner(astr)
+        backends['test'] = cleaner
+        operations = {'test': ['option1']}
+
+        old_reuse = options.get('reuse_preview')
+        options.set('reuse_preview', True, commit=False)
+        try:
+            worker = Worker(ui, False, operations)
+            run = worker.run()
+            while run.next():
+                pass
+        finally:
+            options.set('reuse_preview', old_reuse, commit=False)
+        plan = worker.preview_plan
+        self.assertIsInstance(plan, PreviewPlan)
+        self.assertTrue(plan.matches({'test': ['option1']}))
+        self.assertFalse(plan.matches({'test': ['option1', 'option2']}))
+        self.assertEqual(worker.total_deleted, 3)
+
+        # a new file is not found again, and changed files are kept
+        new = self.write_file(os.path.join(dirname, 'new'), '1')
+        os.remove(changed)
+        self.write_file(changed, '22')
+        os.remove(gone)
+
+        def get_commands(option_id):
+            raise AssertionError('the plan should be used instead')
+        cleaner.get_commands = get_commands
+        worker = Worker(ui, True, operations, plan)
+        run = worker.run()
+        while run.next():
+            pass
+        self.assertEqual(worker.total_deleted, 1)
+        self.assertEqual(worker.total_changed, 2)
+        self.assertEqual(worker.total_errors, 0)
+        self.assertNotExists(same)
+        for path in (keep, changed, new):
+            self.assertExists(path)
+
+        # a single Delete is kept as a file to check
+        worker = Worker(ui, False, operations, None, PreviewPlan(operations))
+        worker.record(Command.Delete(keep), 'test.option2', {'n_deleted': 1, 'size': 1})
+        (batch, ) = worker.preview_plan.get_commands('test.option2')
+        self.assertIsInstance(batch, Command.DeleteBatch)
+        self.assertEqual(batch.paths, [keep])
+
+        import shutil
+        shutil.rmtree(dirname)
+
+    def test_PreviewPlan_dirs(self):
+        """Directories found by a preview are deleted by the clean"""
+        from bleachbit.Options import options
+        ui = CLI.CliCallback()
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-plandirs')
+        inner = os.path.join(dirname, 'sub', 'inner')
+        operations = {'test': ['option1']}
+        # filtered, so each path is in a batch, and unfiltered, so the
+        # walk is one Command.DeleteTree
+        for (nregex, kept) in ((' nregex="^keep$"', ['keep', 'new']), ('', ['new'])):
+            self.write_file(os.path.join(dirname, 'keep'), '1')
+            os.makedirs(inner)
+            for name in ('a', 'b', 'c'):
+                self.write_file(os.path.join(inner, name), '1')
+            astr = '<action command="delete" search="walk.all" path="%s"%s/>' % \
+                (dirname, nregex)
+            backends['test'] = TestCleaner.action_to_cleaner(astr)
+            old_reuse = options.get('reuse_preview')
+            old_shred = options.get('shred')
+            options.set('reuse_preview', True, commit=False)
+            options.set('shred', False, commit=False)
+            try:
+                worker = Worker(ui, False, operations)
+                run = worker.run()
+                while run.next():
+                    pass
+                plan = worker.preview_plan
+                self.assertIsInstance(plan.get_commands('test.option1')[0],
+                                      Command.DeleteBatch)
+                # made after the preview, so kept
+                self.write_file(os.path.join(dirname, 'new'), '1')
+                worker = Worker(ui, True, operations, plan)
+                run = worker.run()
+                while run.next():
+                    pass
+            finally:
+                options.set('reuse_preview', old_reuse, commit=False)
+                options.set('shred', old_shred, commit=False)
+            self.assertEqual(worker.total_changed, 0)
+            self.assertEqual(worker.total_errors, 0)
+            self.assertEqual(sorted(os.listdir(dirname)), kept)
+            os.remove(os.path.join(dirname, 'new'))
+
+        import shutil
+        shutil.rmtree(dirname)
+
+    def test_PlanWriter(self):
+        """Clean what a preview wrote to a plan file"""
+        ui = CLI.CliCallback()
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-planfile')
+        keep = self.write_file(os.path.join(dirname, 'keep'), '1')
+        same = self.write_file(os.path.join(dirname, 'same'), '1')
+        changed = self.write_file(os.path.join(dirname, 'changed'), '1')
+        astr = '<action command="delete" search="glob" path="%s" regex="^[sc]"/>' % \
+            os.path.join(dirname, '*')
+        cleaner = TestCleaner.action_to_cleaner(astr)
+        backends['test'] = cleaner
+        operations = {'test': ['option1']}
+        plan_path = os.path.join(dirname, 'keep.plan')
+
+        writer = PlanWriter(plan_path, operations)
+        worker = Worker(ui, False, operations, None, writer)
+        run = worker.run()
+        while run.next():
+            pass
+        # a command that cannot be written makes the clean search again
+        writer.add_command('test.option2', Command.Function(None, lambda: 0, 'x'))
+        writer.close()
+        self.assertEqual(worker.total_deleted, 2)
+
+        reader = PlanReader(plan_path)
+        self.assertTrue(reader.matches(operations))
+        self.assertEqual(reader.index['test.option2'][0][1], True)
+        batches = list(reader.get_commands('test.option1'))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(sorted(batches[0].paths), [changed, same])
+        self.assertEqual(list(reader.get_commands('test.nothing')), [])
+
+        os.remove(changed)
+        self.write_file(changed, '22')
+
+        def get_commands(option_id):
+            raise AssertionError('the plan should be used instead')
+        cleaner.get_commands = get_commands
+        worker = Worker(ui, True, reader.operations, reader)
+        run = worker.run()
+        while run.next():
+            pass
+        reader.close()
+        self.assertEqual(worker.total_deleted, 1)
+        self.assertEqual(worker.total_changed, 1)
+        self.assertEqual(worker.total_errors, 0)
+        self.assertNotExists(same)
+        self.assertExists(keep)
+        self.assertExists(changed)
+
+        # not a plan
+        self.assertRaises(ValueError, PlanReader, keep)
+
+        import shutil
+        shutil.rmtree(dirname)
+
+    def test_PlanWriter_deepscan(self):
+        """The deep scan in a plan file is never searched again"""
+        ui = CLI.CliCallback()
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-plandeepscan')
+        found = self.write_file(os.path.join(dirname, 'found'), '1')
+        failed = os.path.join(dirname, 'failed')
+        plan_path = os.path.join(dirname, 'deepscan.plan')
+        astr = '<action command="delete" search="glob" path="%s"/>' % \
+            os.path.join(dirname, 'nothing')
+        backends['test'] = TestCleaner.action_to_cleaner(astr)
+        operations = {'test': ['option1']}
+
+        # a file the preview could not keep is left out
+        worker = Worker(ui, False, operations, None, PreviewPlan(operations))
+        worker.record(Command.Delete(failed), 'deepscan', None)
+        self.assertEqual(worker.preview_plan.get_commands('deepscan'), [])
+
+        writer = PlanWriter(plan_path, operations)
+        writer.add_file('deepscan', found,
+                        FileUtilities.PathEntry(found).identity(), 1)
+        writer.add_command('deepscan', Command.Delete(failed))
+        writer.close()
+
+        reader = PlanReader(plan_path)
+        self.assertEqual(reader.index['deepscan'][0][1], False)
+        worker = Worker(ui, True, reader.operations, reader)
+        run = worker.run()
+        while run.next():
+            pass
+        reader.close()
+        self.assertEqual(worker.total_deleted, 1)
+        self.assertEqual(worker.total_errors, 0)
+        self.assertNotExists(found)
+
+        import shutil
+        shutil.rmtree(dirname)
+
+    def test_PlanWriter_dirs(self):
+        """Directories and trees in a plan file are deleted by the clean"""
+        from bleachbit.Options import options
+        ui = CLI.CliCallback()
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-planfiledirs')
+        inner = os.path.join(dirname, 'sub', 'inner')
+        operations = {'test': ['option1']}
+        plan_path = os.path.join(self.tempdir, 'dirs.plan')
+        for (nregex, kept) in ((' nregex="^keep$"', ['keep', 'new']), ('', ['new'])):
+            self.write_file(os.path.join(dirname, 'keep'), '1')
+            os.makedirs(inner)
+            for name in ('a', 'b', 'c'):
+                self.write_file(os.path.join(inner, name), '1')
+            astr = '<action command="delete" search="walk.all" path="%s"%s/>' % \
+                (dirname, nregex)
+            backends['test'] = TestCleaner.action_to_cleaner(astr)
+            old_shred = options.get('shred')
+            options.set('shred', False, commit=False)
+            try:
+                writer = PlanWriter(plan_path, operations)
+                worker = Worker(ui, False, operations, None, writer)
+                run = worker.run()
+                while run.next():
+                    pass
+                writer.close()
+                reader = PlanReader(plan_path)
+                self.assertFalse(reader.index['test.option1'][0][1])
+                # made after the preview, so kept
+                self.write_file(os.path.join(dirname, 'new'), '1')
+                worker = Worker(ui, True, reader.operations, reader)
+                run = worker.run()
+                while run.next():
+                    pass
+                reader.close()
+            finally:
+                options.set('shred', old_shred, commit=False)
+            self.assertEqual(worker.total_deleted, 5 if nregex else 6)
+            self.assertEqual(worker.total_changed, 0)
+            self.assertEqual(sorted(os.listdir(dirname)), kept)
+            os.remove(os.path.join(dirname, 'new'))
+
+        import shutil
+        shutil.rmtree(dirname)
+        os.remove(plan_path)
+
+    @unittest.skipUnless('posix' == os.name, 'skipping without hard links')
+    def test_hard_links(self):
+        """The space of a file with hard links is counted once"""
+        ui = CLI.CliCallback()
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-links')
+        outside = self.mkdtemp(prefix='bleachbit-test-worker-links')
+        first = self.write_file(os.path.join(dirname, 'a'), 'x' * 10000)
+        os.link(first, os.path.join(dirname, 'b'))
+        os.link(first, os.path.join(outside, 'c'))
+        size = FileUtilities.getsize(first)
+        astr = '<action command="delete" search="walk.files" path="%s"/>' % dirname
+        backends['test'] = TestCleaner.action_to_cleaner(astr)
+        operations = {'test': ['option1']}
+
+        # a link outside the cleaning keeps the space in use
+        worker = Worker(ui, False, operations)
+        run = worker.run()
+        while run.next():
+            pass
+        self.assertEqual(worker.total_deleted, 2)
+        self.assertEqual(worker.total_bytes, 0)
+        self.assertEqual(worker.links.n_links, 2)
+        self.assertEqual(worker.links.pending_bytes(), size)
+
+        # with every link, the space is counted once, also while
+        # a clean lowers the link count (shredding one link would
+        # wipe the contents of the others)
+        os.rename(os.path.join(outside, 'c'), os.path.join(dirname, 'c'))
+        from bleachbit.Options import options
+        old_shred = options.get('shred')
+        options.set('shred', False, commit=False)
+        try:
+            for really_delete in (False, True):
+                worker = Worker(ui, really_delete, operations)
+                run = worker.run()
+                while run.next():
+                    pass
+                self.assertEqual(worker.total_deleted, 3)
+                self.assertEqual(worker.total_bytes, size)
+                self.assertEqual(worker.links.pending_bytes(), 0)
+        finally:
+            options.set('shred', old_shred, commit=False)
+        self.assertEqual(os.listdir(dirname), [])
+
+        import shutil
+        shutil.rmtree(dirname)
+        shutil.rmtree(outside)
+
+    def test_hard_links_order(self):
+        """Hard links count in the order the files were deleted"""
+        ui = CLI.CliCallback(quiet=True)
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-links-order')
+        first = self.write_file(os.path.join(dirname, 'a'), 'x' * 10000)
+        size = FileUtilities.getsize(first)
+        paths = [first]
+        for name in ('b', 'c'):
+            paths.append(os.path.join(dirname, name))
+            os.link(first, paths[-1])
+
+        class ReversedBatch(Command.DeleteBatch):
+            # like threads that delete the later files first
+            __slots__ = ()
+
+            def run(self, really_delete, step=256):
+                for i in reversed(xrange(len(self))):
+                    self._run_one(i, really_delete)
+                yield True
+
+        batch = ReversedBatch()
+        for path in paths:
+            batch.append(path)
+        from bleachbit.Options import options
+        old_shred = options.get('shred')
+        options.set('shred', False, commit=False)
+        try:
+            worker = Worker(ui, True, {'test': ['option1']})
+            for _ret in worker.execute_batch(batch, 'test.option1'):
+                pass
+        finally:
+            options.set('shred', old_shred, commit=False)
+        self.assertEqual([link[2] for (_i, link) in batch.links], [3, 2, 1])
+        self.assertEqual(worker.total_deleted, 3)
+        self.assertEqual(worker.total_bytes, size)
+        self.assertEqual(worker.links.pending_bytes(), 0)
+        self.assertEqual(worker.links.n_links, 3)
+        self.assertEqual(os.listdir(dirname), [])
+        os.rmdir(dirname)
+
+    def test_execute_file(self):
+        """Delete, Shred and Truncate run without a generator"""
+        texts = []
+        ui = CLI.CliCallback(quiet=True)
+        ui.append_text = lambda msg, tag=None: texts.append(msg)
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-file')
+        to_delete = self.write_file(os.path.join(dirname, 'delete'), 'x')
+        to_truncate = self.write_file(os.path.join(dirname, 'truncate'), 'x')
+        worker = Worker(ui, True, {'test': ['option1']})
+        self.assertIsNone(worker.execute_file(Command.Delete(to_delete), 'test.option1'))
+        self.assertNotExists(to_delete)
+        self.assertIsNone(worker.execute_file(Command.Truncate(to_truncate), 'test.option1'))
+        self.assertEqual(os.path.getsize(to_truncate), 0)
+        self.assertIsNone(worker.execute_file(Command.Delete(to_delete), 'test.option1'))
+        self.assertEqual(worker.total_deleted, 2)
+        self.assertEqual(worker.total_errors, 1)
+        self.assertEqual(texts, [])
+
+        # the line for the log
+        ui.quiet = False
+        worker = Worker(ui, False, {'test': ['option1']})
+        line = worker.execute_file(Command.Shred(to_truncate), 'test.option1')
+        self.assertEqual(line, u'Delete 0 %s\n' % to_truncate)
+        self.assertExists(to_truncate)
+
+        # the log of a quiet clean has only the totals
+        astr = '<action command="delete" search="glob" path="%s"/>' % \
+            os.path.join(dirname, '*')
+        backends['test'] = TestCleaner.action_to_cleaner(astr)
+        ui.quiet = True
+        worker = Worker(ui, True, {'test': ['option1']})
+        run = worker.run()
+        while run.next():
+            pass
+        self.assertEqual(worker.total_deleted, 1)
+        self.assertNotExists(to_truncate)
+        self.assertNotIn(to_truncate, u''.join(texts))
+
+        import shutil
+        shutil.rmtree(dirname)
+
+    def test_time_check(self):
+        """A clean looks at the clock after each file it truncates"""
+        from bleachbit.Options import options
+        import time
+        dirname = self.mkdtemp(prefix='bleachbit-test-worker-time')
+        astrs = ['<action command="truncate.test" path="%s"/>' %
+                 self.write_file(os.path.join(dirname, str(i)), 'x') for i in range(3)]
+        backends['test'] = TestCleaner.actions_to_cleaner(astrs)
+        operations = {'test': ['option1', 'option2', 'option3']}
+        worker = Worker(CLI.CliCallback(quiet=True), True, operations)
+        old_shred = options.get('shred')
+        options.set('shred', False, commit=False)
+        # each look at the clock is a second later
+        now = [time.time()]
+
+        def fake_time():
+            now[0] += 1
+            return now[0]
+        _time = time.time
+        time.time = fake_time
+        try:
+            yields = len(list(worker.clean_operation('test')))
+        finally:
+            time.time = _time
+            options.set('shred', old_shred, commit=False)
+        # after each Truncate, but not after each Delete
+        self.assertEqual(yields, 3)
+        self.assertEqual(os.listdir(dirname), [])
+        os.rmdir(dirname)
+
+
+if __name__ == '__main__':
+    if 1 < len(sys.argv) and 'benchmark' == sys.argv[1]:
+        n_files = 20000
+        if 3 == len(sys.argv):
+            n_files = int(sys.argv[2])
+        benchmark_execute(n_files)
+        sys.exit()
+    unittest.main()